@@ -0,0 +1,259 @@
+"""
+Local stand-ins for the PANTHER enrichment and UniProt ID mapping APIs, so
+the clients in utils can be benchmarked without the network. Both run in a
+separate process, so serving doesn't count towards the client's time or
+memory. Latency, job polling and pagination are configurable.
+
+Run directly to keep the services up for manual testing:
+    python mock_services.py --latency 0.05 --page_size 500
+
+Author: Serena G. Lotreck
+"""
+import json
+import gzip
+import time
+import argparse
+import itertools
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+import numpy as np
+import synthetic_data
+
+
+PANTHER_DEFAULTS = {'latency': 0.0, 'n_terms': 1000, 'n_payloads': 4, 'error_rate': 0.0,
+                    'seed': 0}
+UNIPROT_DEFAULTS = {'latency': 0.0, 'polls': 2, 'page_size': 500, 'max_page_size': 500,
+                    'failed_fraction': 0.01, 'seed': 0}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Shared response helpers. Keep-alive, so pooled sessions reuse connections
+    like they would with the real services.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body, headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj, headers=None):
+        self.send(200, json.dumps(obj).encode(),
+                  dict({'Content-Type': 'application/json'}, **(headers or {})))
+
+
+def panther_handler(config):
+    """
+    Handler for GET /services/oai/pantherdb/enrich/overrep. Every query gets
+    one of a few pregenerated payloads, chosen by the gene list, so repeated
+    queries get the same answer.
+    """
+    genes = synthetic_data.gene_ids(seed=config['seed'])
+    payloads = [json.dumps({'results': {'result': synthetic_data.panther_terms(
+        genes, config['n_terms'], seed=config['seed'] + i)}}).encode()
+        for i in range(config['n_payloads'])]
+    rng = np.random.default_rng(config['seed'])
+    lock = threading.Lock()
+
+    class PANTHERHandler(_Handler):
+        def do_GET(self):
+            time.sleep(config['latency'])
+            url = urlparse(self.path)
+            if not url.path.endswith('/enrich/overrep'):
+                return self.send(404, b'{}')
+            with lock:
+                fail = rng.random() < config['error_rate']
+            if fail:
+                return self.send(503, b'{"error": "Service unavailable"}')
+            gene_list = parse_qs(url.query).get('geneInputList', [''])[0]
+            payload = payloads[sum(gene_list.encode()) % len(payloads)]
+            self.send(200, payload, {'Content-Type': 'application/json'})
+
+    return PANTHERHandler
+
+
+def uniprot_handler(config, base_url):
+    """
+    Handler for the ID mapping endpoints: run, status, details, and paged and
+    streamed results in json, tsv or xml, optionally gzipped.
+    """
+    jobs = {}
+    counter = itertools.count()
+    rng = np.random.default_rng(config['seed'])
+    lock = threading.Lock()
+
+    class UniProtHandler(_Handler):
+        def do_POST(self):
+            time.sleep(config['latency'])
+            n_bytes = int(self.headers['Content-Length'])
+            data = parse_qs(self.rfile.read(n_bytes).decode())
+            ids = data['ids'][0].split(',')
+            # Requests are handled in parallel threads, so the shared job
+            # table and random state are only touched under the lock
+            with lock:
+                job_id = f'job{next(counter)}'
+                failed = rng.random(len(ids)) < config['failed_fraction']
+                jobs[job_id] = {'mapped': [i for i, f in zip(ids, failed) if not f],
+                                'failed': [i for i, f in zip(ids, failed) if f],
+                                'polls': 0}
+            self.send_json({'jobId': job_id})
+
+        def do_GET(self):
+            time.sleep(config['latency'])
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = url.path.strip('/').split('/')
+            if len(parts) < 3 or parts[0] != 'idmapping':
+                return self.send(404, b'{}')
+            with lock:
+                job = jobs.get(parts[-1])
+            if job is None:
+                return self.send(404, b'{"messages": ["Job not found"]}')
+            if parts[1] == 'status':
+                with lock:
+                    job['polls'] += 1
+                    polls = job['polls']
+                status = 'RUNNING' if polls <= config['polls'] else 'FINISHED'
+                return self.send_json({'jobStatus': status})
+            if parts[1] == 'details':
+                return self.send_json({'redirectURL':
+                                       f'{base_url()}/idmapping/results/{parts[-1]}'})
+            if parts[1] == 'results':
+                return self.send_results(job, url, query, stream=parts[2] == 'stream')
+            return self.send(404, b'{}')
+
+        def send_results(self, job, url, query, stream):
+            mapped = job['mapped']
+            file_format = query.get('format', ['json'])[0]
+            size = min(int(query.get('size', [config['page_size']])[0]),
+                       config['max_page_size'])
+            cursor = int(query.get('cursor', ['0'])[0])
+            page = mapped if stream else mapped[cursor:cursor + size]
+            headers = {'x-total-results': str(len(mapped))}
+            if not stream and cursor + size < len(mapped):
+                next_query = dict(query, cursor=[str(cursor + size)], size=[str(size)])
+                headers['Link'] = (f'<{base_url()}{url.path}?'
+                                   f'{urlencode(next_query, doseq=True)}>; rel="next"')
+            if file_format == 'tsv':
+                body = ('From\tTo\n' + ''.join(f'{i}\tAT{i}\n' for i in page)).encode()
+            elif file_format == 'xml':
+                body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                        '<uniprot xmlns="http://uniprot.org/uniprot">'
+                        + ''.join(f'<entry dataset="Swiss-Prot"><accession>{i}</accession>'
+                                  '</entry>' for i in page)
+                        + '<copyright>Synthetic</copyright></uniprot>').encode()
+            else:
+                results = {'results': [{'from': i, 'to': f'AT{i}'} for i in page]}
+                if cursor == 0 and job['failed']:
+                    results['failedIds'] = job['failed']
+                body = json.dumps(results).encode()
+            if query.get('compressed', ['false'])[0].lower() == 'true':
+                body = gzip.compress(body, compresslevel=1)
+            self.send(200, body, headers)
+
+    return UniProtHandler
+
+
+def _start_server(handler):
+    """
+    Serve a handler on a free local port in a daemon thread.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve(panther_config, uniprot_config, queue=None):
+    """
+    Start both services and block. The base URLs are put on queue if given,
+    otherwise printed.
+    """
+    urls = {}
+    urls['panther'] = 'http://127.0.0.1:{}/services/oai/pantherdb'.format(
+        _start_server(panther_handler(panther_config)).server_port)
+    uniprot = _start_server(uniprot_handler(uniprot_config, lambda: urls['uniprot']))
+    urls['uniprot'] = f'http://127.0.0.1:{uniprot.server_port}'
+    if queue is not None:
+        queue.put(urls)
+    else:
+        print(json.dumps(urls), flush=True)
+    threading.Event().wait()
+
+
+@contextmanager
+def mock_services(panther=None, uniprot=None):
+    """
+    Run the stand-ins in a child process for the duration of a with block.
+
+    parameters:
+        panther, dict: optional, overrides for PANTHER_DEFAULTS. latency is
+            seconds per request, n_terms the number of terms in each result,
+            error_rate the fraction of requests answered with a 503
+        uniprot, dict: optional, overrides for UNIPROT_DEFAULTS. latency is
+            seconds per request, polls the number of status checks a job is
+            RUNNING for, page_size the default and max_page_size the largest
+            allowed results page, failed_fraction the fraction of IDs that
+            don't map
+
+    yields:
+        urls, dict: keys panther and uniprot, values are base URLs. The
+            PANTHER URL replaces https://pantherdb.org/services/oai/pantherdb
+            and the UniProt one uniprot2araport.API_URL
+    """
+    panther_config = dict(PANTHER_DEFAULTS, **(panther or {}))
+    uniprot_config = dict(UNIPROT_DEFAULTS, **(uniprot or {}))
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=serve, args=(panther_config, uniprot_config, queue),
+                              daemon=True)
+    process.start()
+    try:
+        yield queue.get(timeout=120)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def panther_query(base_url, genes, aspect='GO:0008150', organism=3702):
+    """
+    PANTHER overrepresentation query URL for a gene list.
+    """
+    params = {'geneInputList': ','.join(genes), 'organism': organism,
+              'annotDataSet': aspect, 'enrichmentTestType': 'FISHER',
+              'correction': 'FDR'}
+    return f'{base_url}/enrich/overrep?{urlencode(params)}'
+
+
+def main(latency, page_size, n_terms):
+    serve(dict(PANTHER_DEFAULTS, latency=latency, n_terms=n_terms),
+          dict(UNIPROT_DEFAULTS, latency=latency, page_size=page_size,
+               max_page_size=max(page_size, UNIPROT_DEFAULTS['max_page_size'])))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run local PANTHER and UniProt '
+            'stand-ins')
+
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='Seconds to wait before answering each request')
+    parser.add_argument('--page_size', type=int, default=500,
+            help='Default number of ID mapping results per page')
+    parser.add_argument('--n_terms', type=int, default=1000,
+            help='Number of terms in each PANTHER result')
+
+    args = parser.parse_args()
+
+    main(args.latency, args.page_size, args.n_terms)
@@ -0,0 +1,431 @@
+"""
+Time and peak memory benchmarks for the entry points in utils, on synthetic
+Arabidopsis-scale data and local stand-ins for the PANTHER and UniProt APIs.
+Results are compared against baselines stored per machine in
+baselines.json (written only with --save, and not tracked by git since
+they're machine specific), so slowdowns show up from one run to the next.
+
+Usage:
+    python run_benchmarks.py                  # run all, compare to baseline
+    python run_benchmarks.py -only uniprot    # benchmarks with uniprot in the name
+    python run_benchmarks.py --save           # store the results as the baseline
+    python run_benchmarks.py -scale 0.1       # quick run on smaller data
+
+Time is the median over -repeat runs. Peak memory is the peak of memory
+allocated through Python (including numpy arrays) during one extra run,
+measured with tracemalloc, so it doesn't include memory allocated directly
+by C libraries (e.g. the matplotlib renderer).
+
+Author: Serena G. Lotreck
+"""
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from os import makedirs
+from os.path import abspath, dirname, isfile
+from datetime import date
+from contextlib import ExitStack, redirect_stdout
+import numpy as np
+
+BENCHMARK_DIR = dirname(abspath(__file__))
+sys.path.insert(0, f'{dirname(BENCHMARK_DIR)}/utils')
+sys.path.insert(0, BENCHMARK_DIR)
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import synthetic_data
+from mock_services import mock_services, panther_query
+
+BENCHMARKS = {}
+
+
+def benchmark(name, services=False):
+    """
+    Register a benchmark. The decorated function takes the run context and
+    returns the function to time, doing any setup that shouldn't be timed
+    before returning it.
+    """
+    def register(setup):
+        BENCHMARKS[name] = {'setup': setup, 'services': services}
+        return setup
+    return register
+
+
+class Context:
+    """
+    Shared state for one benchmark run: the scale, a scratch directory, the
+    service URLs and data that several benchmarks use, generated on first
+    use.
+    """
+
+    def __init__(self, scale, tmp_dir, urls=None):
+        self.scale = scale
+        self.tmp_dir = tmp_dir
+        self.urls = urls
+        self._data = {}
+
+    def n(self, size, minimum=1):
+        return synthetic_data.scaled(size, self.scale, minimum)
+
+    def data(self, key, make):
+        if key not in self._data:
+            self._data[key] = make()
+        return self._data[key]
+
+    @property
+    def genes(self):
+        return self.data('genes', lambda: synthetic_data.gene_ids(self.n(27000, 100)))
+
+    @property
+    def deg_dfs(self):
+        return self.data('deg_dfs', lambda: synthetic_data.deg_tables(
+            self.genes, self.n(48, 2), self.n(3000, 10)))
+
+
+def _quiet(run):
+    """
+    Wrap a function so its printing doesn't end up in the benchmark output.
+    """
+    def quiet_run():
+        with redirect_stdout(io.StringIO()):
+            return run()
+    return quiet_run
+
+
+def _deg_figure_run(ctx, render):
+    """
+    Draw and save the bar layout of makeDEGfigure, for comparing the default
+    bars with the collection mode on the same data.
+    """
+    from make_DEG_figure import makeDEGfigure
+
+    deg_dfs = dict(list(ctx.deg_dfs.items())[:ctx.n(16, 2)])
+    sets, colors = synthetic_data.gene_sets(ctx.genes, [ctx.n(s) for s in (150, 60, 40, 30)])
+    names = {c: c.replace('_', ' ') for c in deg_dfs}
+    tair2gene = synthetic_data.gene_names(ctx.genes)
+
+    def run():
+        makeDEGfigure(deg_dfs, sets, colors, names, tair2gene, show_all_x=False,
+                      separate_columns=True, render=render)
+        plt.savefig(io.BytesIO(), format='png', dpi=50)
+        plt.close('all')
+    return run
+
+
+@benchmark('make_DEG_figure_bars')
+def bench_deg_figure_bars(ctx):
+    return _deg_figure_run(ctx, 'bars')
+
+
+@benchmark('make_DEG_figure_collection')
+def bench_deg_figure_collection(ctx):
+    return _deg_figure_run(ctx, 'collection')
+
+
+@benchmark('make_DEG_figure_heatmap')
+def bench_deg_figure_heatmap(ctx):
+    from make_DEG_figure import makeDEGfigure
+
+    sets, colors = synthetic_data.gene_sets(ctx.genes,
+                                            [ctx.n(s) for s in (1500, 600, 400, 300)])
+    names = {c: c.replace('_', ' ') for c in ctx.deg_dfs}
+    tair2gene = synthetic_data.gene_names(ctx.genes)
+
+    def run():
+        makeDEGfigure(ctx.deg_dfs, sets, colors, names, tair2gene, show_all_x=False,
+                      separate_columns=True, render='heatmap')
+        plt.savefig(io.BytesIO(), format='png', dpi=50)
+        plt.close('all')
+    return run
+
+
+@benchmark('plot_opposite_expression_pdf')
+def bench_opposite_expression(ctx):
+    from plot_opposite_expression import plot_opposite_expression
+
+    opposites = synthetic_data.opposite_table(ctx.genes, ctx.n(2000, 10))
+    cols = {'2% O2': 'log2FoldChange_2o2', '40% O2': 'log2FoldChange_40o2'}
+    tair2gene = synthetic_data.gene_names(ctx.genes)
+    pdf_path = f'{ctx.tmp_dir}/opposites.pdf'
+
+    def run():
+        plot_opposite_expression(opposites, cols, tair2gene, normalize=True,
+                                 title='Opposites', pdf_path=pdf_path, rows_per_page=100)
+    return run
+
+
+def _descriptions_inputs(ctx):
+    metadata_paths = ctx.data('metadata_paths', lambda: synthetic_data.write_metadata(
+        ctx.genes, f'{ctx.tmp_dir}/metadata'))
+    gene2GO = ctx.data('gene2GO', lambda: synthetic_data.gene2GO_table(ctx.genes))
+    gene_lists = {c: df['gene_id'].tolist() for c, df in ctx.deg_dfs.items()}
+    return metadata_paths, gene2GO, gene_lists
+
+
+@benchmark('get_arabidopsis_descriptions_files')
+def bench_descriptions_files(ctx):
+    import get_arabidopsis_descriptions as gad
+
+    metadata_paths, gene2GO, gene_lists = _descriptions_inputs(ctx)
+
+    def run():
+        # Parse the source files every time
+        gad._METADATA_CACHE.clear()
+        gad.get_arabidopsis_descriptions_batch(gene_lists, metadata_paths, gene2GO)
+    return run
+
+
+@benchmark('get_arabidopsis_descriptions_store')
+def bench_descriptions_store(ctx):
+    import get_arabidopsis_descriptions as gad
+
+    metadata_paths, gene2GO, gene_lists = _descriptions_inputs(ctx)
+    store_path = f'{ctx.tmp_dir}/annotations.feather'
+    gad.build_annotation_store(metadata_paths, store_path)
+
+    def run():
+        # Read the store every time instead of reusing the in-process copy
+        gad._METADATA_CACHE.clear()
+        gad.get_arabidopsis_descriptions_batch(gene_lists, metadata_paths, gene2GO,
+                                               store_path=store_path)
+    return run
+
+
+@benchmark('processGOenrichments')
+def bench_process_go(ctx):
+    from GO_enrichment_API_functions import processGOenrichments
+
+    groups = list(ctx.deg_dfs)
+    enrichments = synthetic_data.enrichments(groups, ctx.genes, ctx.n(1000, 10))
+    data = {g: df['gene_id'].tolist() for g, df in ctx.deg_dfs.items()}
+    names = {g: g.replace('_', ' ') for g in groups}
+
+    return _quiet(lambda: processGOenrichments(enrichments, data, names, long_form=True))
+
+
+@benchmark('getPANTHERbatch', services=True)
+def bench_panther_batch(ctx):
+    from GO_enrichment_API_functions import getPANTHERbatch
+
+    aspects = {'biological_process': 'GO:0008150', 'molecular_function': 'GO:0003674',
+               'cellular_component': 'GO:0005575'}
+    queries = {c: {a: panther_query(ctx.urls['panther'], df['gene_id'].iloc[:200], go_id)
+                   for a, go_id in aspects.items()}
+               for c, df in ctx.deg_dfs.items()}
+
+    return lambda: getPANTHERbatch(queries, max_workers=8)
+
+
+@benchmark('make_samplesheet_main')
+def bench_samplesheet(ctx):
+    import make_samplesheet
+
+    run_dirs = ctx.data('fastq_dirs', lambda: synthetic_data.write_fastq_tree(
+        f'{ctx.tmp_dir}/fastq', ctx.n(2000, 4)))
+    out_loc = f'{ctx.tmp_dir}/samplesheet'
+    makedirs(out_loc, exist_ok=True)
+
+    return _quiet(lambda: make_samplesheet.main(run_dirs, '', True, out_loc))
+
+
+def _uniprot_job(ctx, n_ids):
+    """
+    Submit a mapping job to the stand-in and wait for it, returning the
+    results URL.
+    """
+    import uniprot2araport
+
+    uniprot2araport.API_URL = ctx.urls['uniprot']
+    job_id = uniprot2araport.submit_id_mapping('UniProtKB_AC-ID', 'Araport',
+                                               synthetic_data.uniprot_ids(n_ids))
+    while True:
+        status = uniprot2araport.session.get(
+            f'{ctx.urls["uniprot"]}/idmapping/status/{job_id}').json()
+        if status.get('jobStatus') == 'FINISHED':
+            break
+        time.sleep(0.01)
+    return uniprot2araport.get_id_mapping_results_link(job_id)
+
+
+@benchmark('uniprot_paged_results', services=True)
+def bench_uniprot_paged(ctx):
+    from uniprot2araport import get_id_mapping_results_search
+
+    link = _uniprot_job(ctx, ctx.n(100000, 1000))
+    return _quiet(lambda: get_id_mapping_results_search(f'{link}?format=json&size=500'))
+
+
+@benchmark('uniprot_xml_stream_merge', services=True)
+def bench_uniprot_xml(ctx):
+    from uniprot2araport import get_id_mapping_results_search
+
+    link = _uniprot_job(ctx, ctx.n(50000, 1000))
+    out_path = f'{ctx.tmp_dir}/mapping.xml'
+    return _quiet(lambda: get_id_mapping_results_search(
+        f'{link}?format=xml&size=500&compressed=true', xml_sink=out_path))
+
+
+@benchmark('uniprot_stream_to_parquet', services=True)
+def bench_uniprot_stream(ctx):
+    from uniprot2araport import write_id_mapping_results_stream
+
+    link = _uniprot_job(ctx, ctx.n(100000, 1000))
+    out_path = f'{ctx.tmp_dir}/mapping.parquet'
+    return lambda: write_id_mapping_results_stream(
+        f'{link}?format=tsv&compressed=true', out_path)
+
+
+@benchmark('uniprot_map_ids', services=True)
+def bench_uniprot_map_ids(ctx):
+    import uniprot2araport
+
+    uniprot2araport.API_URL = ctx.urls['uniprot']
+    ids = synthetic_data.uniprot_ids(ctx.n(100000, 1000))
+    id_sets = {'2_vs_21': ids[:len(ids)//2], '40_vs_21': ids[len(ids)//2:]}
+
+    return _quiet(lambda: uniprot2araport.map_ids(
+        id_sets, 'UniProtKB_AC-ID', 'Araport', chunk_size=max(len(ids)//8, 1)))
+
+
+def measure(run, repeat):
+    """
+    Median time over repeat runs, then the peak traced memory of one more.
+
+    returns:
+        result, dict: time (seconds), times (every run) and peak_mb
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time': float(np.median(times)), 'times': times, 'peak_mb': peak / 2**20}
+
+
+def machine_name():
+    """
+    Key for this machine's baselines.
+    """
+    return f'{platform.node()}-{platform.machine()}-py{platform.python_version()}'
+
+
+def load_baselines(path):
+    if isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def compare(result, baseline, time_tolerance, memory_tolerance):
+    """
+    Ratios of a result to its baseline, and whether either is a regression.
+    """
+    time_ratio = result['time'] / baseline['time'] if baseline['time'] > 0 else np.nan
+    memory_ratio = (result['peak_mb'] / baseline['peak_mb'] if baseline['peak_mb'] > 0
+                    else np.nan)
+    regressions = []
+    if time_ratio > 1 + time_tolerance:
+        regressions.append('time')
+    if memory_ratio > 1 + memory_tolerance:
+        regressions.append('memory')
+    return time_ratio, memory_ratio, regressions
+
+
+def main(only, scale, repeat, save, baseline_path, time_tolerance, memory_tolerance,
+         latency):
+
+    names = [n for n in BENCHMARKS if not only or any(o in n for o in only)]
+    baselines = load_baselines(baseline_path)
+    machine = machine_name()
+    stored = baselines.get(machine, {}).get(str(scale), {})
+    print(f'\nRunning {len(names)} benchmarks at scale {scale} on {machine}...')
+
+    results = {}
+    n_regressions = 0
+    tmp_dir = tempfile.mkdtemp(prefix='utils_benchmarks_')
+    try:
+        with ExitStack() as stack:
+            urls = None
+            if any(BENCHMARKS[n]['services'] for n in names):
+                urls = stack.enter_context(mock_services(
+                    panther={'latency': latency, 'n_terms': synthetic_data.scaled(1000, scale, 10)},
+                    uniprot={'latency': latency}))
+            ctx = Context(scale, tmp_dir, urls)
+            print(f'\n{"benchmark":<38}{"time (s)":>10}{"vs base":>9}'
+                  f'{"peak (MB)":>11}{"vs base":>9}')
+            for name in names:
+                run = BENCHMARKS[name]['setup'](ctx)
+                result = measure(run, repeat)
+                results[name] = dict(result, date=str(date.today()))
+                line = f'{name:<38}{result["time"]:>10.3f}'
+                if name in stored:
+                    time_ratio, memory_ratio, regressions = compare(
+                        result, stored[name], time_tolerance, memory_tolerance)
+                    line += (f'{time_ratio:>8.2f}x{result["peak_mb"]:>11.1f}'
+                             f'{memory_ratio:>8.2f}x')
+                    if regressions:
+                        n_regressions += 1
+                        line += f'  REGRESSION ({", ".join(regressions)})'
+                else:
+                    line += f'{"-":>9}{result["peak_mb"]:>11.1f}{"-":>9}  (new)'
+                print(line, flush=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Baselines are only written when asked, so a plain run never changes
+    # what later runs are compared against
+    if save:
+        baselines.setdefault(machine, {}).setdefault(str(scale), {}).update(results)
+        with open(baseline_path, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print(f'\nSaved baselines for {len(results)} benchmarks to {baseline_path}')
+    elif any(n not in stored for n in results):
+        print('\nRun with --save to store baselines for the new benchmarks')
+    if n_regressions and not save:
+        print(f'\n{n_regressions} benchmarks regressed')
+        return 1
+    print('\nDone!')
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the utils entry points')
+
+    parser.add_argument('-only', type=str, nargs='+', default=None,
+            help='Only run benchmarks with one of these strings in their name')
+    parser.add_argument('-scale', type=float, default=1.0,
+            help='Multiplier for the data sizes, 1 is Arabidopsis scale. '
+            'Baselines are stored separately for each scale')
+    parser.add_argument('-repeat', type=int, default=3,
+            help='Number of timed runs of each benchmark')
+    parser.add_argument('--save', action='store_true',
+            help='Whether or not to store these results as the baseline')
+    parser.add_argument('-baselines', type=abspath,
+            default=f'{BENCHMARK_DIR}/baselines.json',
+            help='JSON file with the stored baselines')
+    parser.add_argument('-time_tolerance', type=float, default=0.25,
+            help='Fraction slower than baseline that counts as a regression')
+    parser.add_argument('-memory_tolerance', type=float, default=0.10,
+            help='Fraction more peak memory than baseline that counts as a '
+            'regression')
+    parser.add_argument('-latency', type=float, default=0.02,
+            help='Seconds the API stand-ins wait before each response')
+
+    args = parser.parse_args()
+
+    sys.exit(main(args.only, args.scale, args.repeat, args.save, args.baselines,
+                  args.time_tolerance, args.memory_tolerance, args.latency))
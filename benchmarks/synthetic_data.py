@@ -0,0 +1,242 @@
+"""
+Synthetic data at Arabidopsis scale for the benchmarks: DESeq2 outputs,
+gene sets, annotation files, gene2GO tables, FASTQ file trees, PANTHER
+enrichment results and UniProt IDs. Everything is generated from a seed, so
+the same scale always gives the same data.
+
+Author: Serena G. Lotreck
+"""
+from os import makedirs
+from os.path import abspath
+import pandas as pd
+import numpy as np
+
+
+# Approximate number of nuclear protein coding genes per chromosome
+CHROMOSOME_GENES = {'1': 7000, '2': 4300, '3': 5600, '4': 4300, '5': 6300,
+                    'C': 90, 'M': 120}
+ASPECTS = ['biological_process', 'molecular_function', 'cellular_component']
+TIMES = ['1h', '7h', '24h', '48h']
+OXYGEN = ['2', '21', '40']
+
+
+def scaled(n, scale, minimum=1):
+    """
+    Scale a size, keeping at least minimum.
+    """
+    return max(int(round(n*scale)), minimum)
+
+
+def gene_ids(n_genes=27000, seed=0):
+    """
+    Upper-cased TAIR-style locus IDs, spread over the chromosomes in
+    proportion to their gene numbers.
+
+    returns:
+        genes, array of str: sorted gene IDs
+    """
+    rng = np.random.default_rng(seed)
+    chroms = list(CHROMOSOME_GENES)
+    weights = np.array(list(CHROMOSOME_GENES.values()), dtype=float)
+    counts = rng.multinomial(n_genes, weights / weights.sum())
+    genes = []
+    for chrom, n in zip(chroms, counts):
+        numbers = np.sort(rng.choice(99999, n, replace=False) + 1)
+        genes.extend(f'AT{chrom}G{num:05d}' for num in numbers)
+    return np.array(sorted(genes))
+
+
+def comparison_names(n_comparisons):
+    """
+    DESeq2 comparison names following the output file naming convention,
+    time comparisons first, then oxygen comparisons, repeated with a
+    replicate suffix if more are asked for than there are conditions.
+    """
+    base = [f'{t1}_vs_{t2}_{o}o2' for i, t1 in enumerate(TIMES) for t2 in TIMES[i + 1:]
+            for o in OXYGEN]
+    base += [f'{t}_o2_{o1}_{o2}' for t in TIMES for i, o1 in enumerate(OXYGEN)
+             for o2 in OXYGEN[i + 1:]]
+    names = base[:n_comparisons]
+    rep = 2
+    while len(names) < n_comparisons:
+        names += [f'{n}_rep{rep}' for n in base[:n_comparisons - len(names)]]
+        rep += 1
+    return names
+
+
+def deg_tables(genes, n_comparisons=48, degs_per_comparison=3000, seed=0):
+    """
+    Significant DEGs for each comparison, with the DESeq2 output columns.
+
+    returns:
+        deg_dfs, dict: keys are comparison names, values are dfs
+    """
+    rng = np.random.default_rng(seed)
+    deg_dfs = {}
+    n = min(degs_per_comparison, len(genes))
+    for name in comparison_names(n_comparisons):
+        chosen = np.sort(rng.choice(len(genes), n, replace=False))
+        lfc = rng.normal(0, 2, n)
+        lfc += np.sign(lfc)*0.5
+        se = rng.uniform(0.1, 0.6, n)
+        pvalue = rng.uniform(0, 1e-3, n)
+        deg_dfs[name] = pd.DataFrame({
+            'gene_id': genes[chosen], 'baseMean': rng.lognormal(6, 1.5, n),
+            'log2FoldChange': lfc, 'lfcSE': se, 'stat': lfc / se,
+            'pvalue': pvalue, 'padj': np.minimum(pvalue*20, 0.049)})
+    return deg_dfs
+
+
+def gene_sets(genes, sizes=(150, 60, 40, 30), seed=0):
+    """
+    Lower-cased gene sets (e.g. photosynthesis categories), the first sizes
+    genes of a shuffle so sets don't overlap.
+
+    returns:
+        sets, dict: keys are set names, values are lists of gene IDs
+        colors, dict: keys are set names, values are colors
+    """
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permutation(genes)
+    bounds = np.cumsum((0,) + tuple(sizes))
+    names = [f'set_{i}' for i in range(len(sizes))]
+    sets = {n: [g.lower() for g in shuffled[start:stop]]
+            for n, start, stop in zip(names, bounds[:-1], bounds[1:])}
+    palette = ['#1b9e77', '#d95f02', '#7570b3', '#e7298a', '#66a61e', '#e6ab02']
+    colors = {n: palette[i % len(palette)] for i, n in enumerate(names)}
+    return sets, colors
+
+
+def gene_names(genes, fraction=0.3, seed=0):
+    """
+    Symbols for a fraction of the genes, keyed by lower-cased ID, like
+    tair2gene in the notebooks.
+    """
+    rng = np.random.default_rng(seed)
+    named = rng.choice(genes, int(len(genes)*fraction), replace=False)
+    return {g.lower(): f'GEN{i}' for i, g in enumerate(named)}
+
+
+def opposite_table(genes, n_genes=2000, seed=0):
+    """
+    Genes with opposite log2 fold changes in two comparisons, in the format
+    plot_opposite_expression takes.
+    """
+    rng = np.random.default_rng(seed)
+    chosen = rng.choice(genes, min(n_genes, len(genes)), replace=False)
+    first = rng.normal(0, 2, len(chosen))
+    second = -np.sign(first)*np.abs(rng.normal(0, 2, len(chosen)))
+    return pd.DataFrame({'gene_id': chosen, 'log2FoldChange_2o2': first,
+                         'log2FoldChange_40o2': second})
+
+
+def write_metadata(genes, out_dir, n_sources=2, max_isoforms=3, seed=0):
+    """
+    Write TAIR-style gene description files, one row per isoform, as
+    tab-separated Windows-1252 files like the real ones.
+
+    returns:
+        metadata_paths, dict: keys are annotation names, values are paths
+    """
+    rng = np.random.default_rng(seed)
+    out_dir = abspath(out_dir)
+    makedirs(out_dir, exist_ok=True)
+    n_isoforms = rng.integers(1, max_isoforms + 1, len(genes))
+    names = [f'{g}.{i + 1}' for g, n in zip(genes, n_isoforms) for i in range(n)]
+    words = np.array(['protein', 'kinase', 'family', 'binding', 'domain', 'chloroplast',
+                      'putative', 'transporter', 'subunit', 'oxidoreductase'])
+    metadata_paths = {}
+    for s in range(n_sources):
+        description = [' '.join(w) for w in rng.choice(words, (len(names), 6))]
+        df = pd.DataFrame({'name': names, 'type': 'protein_coding',
+                           'short_description': description,
+                           'Curator_summary': description,
+                           'Computational_description': description})
+        path = f'{out_dir}/annotation_{s}.txt'
+        df.to_csv(path, sep='\t', index=False, encoding='Windows-1252')
+        metadata_paths[f'source_{s}'] = path
+    return metadata_paths
+
+
+def gene2GO_table(genes, terms_per_gene=8, n_terms=8000, seed=0):
+    """
+    Gene to GO term table with columns object_name, GO_term and GO_ID.
+    """
+    rng = np.random.default_rng(seed)
+    term_ids = np.array([f'GO:{i:07d}' for i in rng.choice(9999999, n_terms, replace=False)])
+    per_gene = rng.poisson(terms_per_gene, len(genes)) + 1
+    picks = rng.integers(0, n_terms, per_gene.sum())
+    return pd.DataFrame({'object_name': np.repeat(genes, per_gene),
+                         'GO_term': np.char.add('term ', picks.astype(str)),
+                         'GO_ID': term_ids[picks]})
+
+
+def write_fastq_tree(out_dir, n_pairs=2000, n_runs=4, lanes=2, seed=0):
+    """
+    Write empty paired fastq.gz files named like the sequencing core's, spread
+    over several run directories and lanes.
+
+    returns:
+        run_dirs, list of str: one directory per run
+    """
+    rng = np.random.default_rng(seed)
+    out_dir = abspath(out_dir)
+    run_dirs = [f'{out_dir}/run_{r}' for r in range(n_runs)]
+    per_run = np.array_split(np.arange(n_pairs), n_runs)
+    for run_dir, pairs in zip(run_dirs, per_run):
+        for lane in range(1, lanes + 1):
+            makedirs(f'{run_dir}/L00{lane}', exist_ok=True)
+        for i in pairs:
+            lane = i % lanes + 1
+            sample = f'{rng.choice(OXYGEN)}{i}-{rng.choice(TIMES)}'
+            for read in (1, 2):
+                name = f'{sample}_S{i + 1}_L00{lane}_R{read}_001.fastq.gz'
+                open(f'{run_dir}/L00{lane}/{name}', 'wb').close()
+    return run_dirs
+
+
+def panther_terms(genes, n_terms=3000, mapped_fraction=0.5, max_genes=40, seed=0):
+    """
+    Terms in the format of the PANTHER enrichment API's results['result'].
+    """
+    rng = np.random.default_rng(seed)
+    fdr = rng.beta(0.3, 1, n_terms)
+    number_in_list = rng.integers(1, max_genes, n_terms)
+    fold = rng.lognormal(0, 1, n_terms)
+    expected = rng.uniform(0, 20, n_terms)
+    number_in_reference = rng.integers(1, 3000, n_terms)
+    mapped = rng.random(n_terms) < mapped_fraction
+    gene_picks = rng.integers(0, len(genes), (n_terms, max_genes))
+    terms = []
+    for i in range(n_terms):
+        term = {'number_in_list': int(number_in_list[i]),
+                'fold_enrichment': float(fold[i]), 'fdr': float(fdr[i]),
+                'expected': float(expected[i]),
+                'number_in_reference': int(number_in_reference[i]),
+                'pValue': float(fdr[i] / 10), 'plus_minus': '+',
+                'term': {'id': f'GO:{i:07d}', 'label': f'term {i}'}}
+        if mapped[i]:
+            term['input_list'] = {
+                'mapped_ids': genes[gene_picks[i, :number_in_list[i]]].tolist()}
+        terms.append(term)
+    return terms
+
+
+def enrichments(groups, genes, n_terms=3000, seed=0):
+    """
+    Nested PANTHER results, keys are groups, then aspects, in the form
+    processGOenrichments takes.
+    """
+    rng = np.random.default_rng(seed)
+    return {g: {a: {'result': panther_terms(genes, n_terms, seed=int(rng.integers(2**31)))}
+                for a in ASPECTS} for g in groups}
+
+
+def uniprot_ids(n_ids=100000, seed=0):
+    """
+    UniProt-style accessions.
+    """
+    rng = np.random.default_rng(seed)
+    numbers = rng.choice(10**6, n_ids, replace=False)
+    prefixes = rng.choice(['P', 'Q', 'O'], n_ids)
+    return [f'{p}{n:06d}' for p, n in zip(prefixes, numbers)]
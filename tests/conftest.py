@@ -0,0 +1,6 @@
+import sys
+from os.path import abspath, dirname
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.append(f'{ROOT}/utils')
+sys.path.append(f'{ROOT}/benchmarks')
@@ -0,0 +1,87 @@
+"""
+Tests for the cached, concurrent PANTHER client against the local PANTHER
+stand-in in benchmarks/mock_services.py.
+
+Author: Serena G. Lotreck
+"""
+import os
+import time
+import pytest
+from GO_enrichment_API_functions import (getPANTHERbatch, evictPANTHERcache,
+                                         makePANTHERsession, _cache_path)
+from mock_services import mock_services, panther_query
+
+
+@pytest.fixture(scope='module')
+def panther_url():
+    with mock_services(panther={'n_terms': 50}) as urls:
+        yield urls['panther']
+
+
+@pytest.fixture
+def session():
+    session = makePANTHERsession(max_workers=2)
+    session.requested = []
+    get = session.get
+
+    def record(url, **kwargs):
+        session.requested.append(url)
+        return get(url, **kwargs)
+
+    session.get = record
+    return session
+
+
+def queries(base_url):
+    return {'up': panther_query(base_url, ['AT1G01010', 'AT1G01020']),
+            'down': panther_query(base_url, ['AT2G01010']),
+            'both': panther_query(base_url, ['AT3G01010', 'AT3G01020', 'AT3G01030'])}
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_cache_hits_skip_requests(panther_url, session, tmp_path):
+    batch = queries(panther_url)
+    # Same query with its parameters reordered and padded
+    batch['up_again'] = ' ' + batch['up'].replace('&organism=3702', '') + '&organism=3702 '
+    first = getPANTHERbatch(batch, max_workers=2, cache_dir=tmp_path, session=session)
+    assert len(session.requested) == 3
+    assert first['up_again'] == first['up']
+
+    session.requested.clear()
+    second = getPANTHERbatch(batch, max_workers=2, cache_dir=tmp_path, session=session)
+    assert session.requested == []
+    assert second == first
+
+    batch['new'] = panther_query(panther_url, ['AT4G01010'])
+    getPANTHERbatch(batch, max_workers=2, cache_dir=tmp_path, session=session)
+    assert session.requested == [batch['new']]
+
+
+def test_expired_entries_are_refetched(panther_url, session, tmp_path):
+    batch = queries(panther_url)
+    getPANTHERbatch(batch, cache_dir=tmp_path, session=session)
+    age(_cache_path(tmp_path, batch['down']), 120)
+
+    session.requested.clear()
+    getPANTHERbatch(batch, cache_dir=tmp_path, cache_ttl=60, session=session)
+    assert session.requested == [batch['down']]
+    assert evictPANTHERcache(tmp_path, ttl=60) == 0
+
+
+def test_size_limit_evicts_least_recently_used(panther_url, session, tmp_path):
+    batch = queries(panther_url)
+    getPANTHERbatch(batch, cache_dir=tmp_path, session=session)
+    paths = {name: _cache_path(tmp_path, query) for name, query in batch.items()}
+    for seconds, name in zip([300, 200, 100], ['up', 'down', 'both']):
+        age(paths[name], seconds)
+    # Reading 'up' makes it the most recently used
+    getPANTHERbatch({'up': batch['up']}, cache_dir=tmp_path, session=session)
+
+    total = sum(os.path.getsize(p) for p in paths.values())
+    assert evictPANTHERcache(tmp_path, max_size=total - 1) == 1
+    assert not os.path.exists(paths['down'])
+    assert os.path.exists(paths['up']) and os.path.exists(paths['both'])
@@ -0,0 +1,133 @@
+"""
+Tests for the DEG bitset engine, against plain Python sets.
+
+Author: Serena G. Lotreck
+"""
+from collections import Counter
+import numpy as np
+import pandas as pd
+import pytest
+from comparison_sets import (build_comparison_bitsets, genes_in, pair_counts,
+                             filter_concordant, comparison_frame, opposite_table,
+                             upset_counts)
+
+
+def random_degs(n_comparisons=5, n_genes=300, seed=0):
+    """
+    DEG tables with overlapping genes, both signs, a padj column, and a
+    duplicated gene.
+    """
+    rng = np.random.default_rng(seed)
+    deg_dfs = {}
+    for c in range(n_comparisons):
+        genes = rng.choice(n_genes, size=rng.integers(20, 120), replace=False)
+        deg_dfs[f'comp{c}'] = pd.DataFrame({
+            'gene_id': [f'AT1G{g:05d}' for g in genes],
+            'log2FoldChange': rng.normal(size=len(genes)),
+            'padj': rng.random(len(genes))*0.1})
+    first = deg_dfs['comp0']
+    deg_dfs['comp0'] = pd.concat([first, first.iloc[:1]], ignore_index=True)
+    return deg_dfs
+
+
+def as_sets(deg_dfs, padj_col=None):
+    sets = {}
+    for name, df in deg_dfs.items():
+        df = df.drop_duplicates('gene_id')
+        if padj_col is not None:
+            df = df[df[padj_col] < 0.05]
+        lfc = dict(zip(df['gene_id'], df['log2FoldChange']))
+        sets[name] = {'sig': set(lfc), 'up': {g for g, v in lfc.items() if v > 0},
+                      'down': {g for g, v in lfc.items() if v < 0}, 'lfc': lfc}
+    return sets
+
+
+@pytest.mark.parametrize('padj_col', [None, 'padj'])
+def test_genes_in_and_pair_counts(padj_col):
+    deg_dfs = random_degs()
+    sets = as_sets(deg_dfs, padj_col)
+
+    bitsets = build_comparison_bitsets(deg_dfs, padj_col=padj_col)
+    counts = pair_counts(bitsets)
+
+    for a in deg_dfs:
+        for kind in ('sig', 'up', 'down'):
+            assert genes_in(bitsets, a, kind) == sorted(sets[a][kind])
+        for b in deg_dfs:
+            assert counts['shared'].loc[a, b] == len(sets[a]['sig'] & sets[b]['sig'])
+            assert counts['concordant'].loc[a, b] == (len(sets[a]['up'] & sets[b]['up'])
+                                                      + len(sets[a]['down'] & sets[b]['down']))
+            assert counts['opposite'].loc[a, b] == (len(sets[a]['up'] & sets[b]['down'])
+                                                    + len(sets[a]['down'] & sets[b]['up']))
+    subset = pair_counts(bitsets, ['comp3', 'comp1'])
+    pd.testing.assert_frame_equal(subset['shared'],
+                                  counts['shared'].loc[['comp3', 'comp1'], ['comp3', 'comp1']])
+
+
+def test_filter_concordant_and_frames():
+    deg_dfs = random_degs()
+    sets = as_sets(deg_dfs)
+    bitsets = build_comparison_bitsets(deg_dfs)
+
+    filtered = filter_concordant(bitsets, ['comp1', 'comp2'], 'comp0')
+
+    assert filtered['comparisons'] == list(deg_dfs) + ['comp1_filtered', 'comp2_filtered']
+    ref = sets['comp0']
+    for name in ('comp1', 'comp2'):
+        s = sets[name]
+        expected = s['sig'] - (s['up'] & ref['up']) - (s['down'] & ref['down'])
+        frame = comparison_frame(filtered, f'{name}_filtered')
+        assert frame['gene_id'].tolist() == sorted(expected)
+        assert frame['log2FoldChange'].tolist() == [s['lfc'][g] for g in sorted(expected)]
+    # The original comparisons are unchanged
+    assert genes_in(filtered, 'comp1') == genes_in(bitsets, 'comp1')
+
+
+def test_opposite_table():
+    deg_dfs = random_degs()
+    sets = as_sets(deg_dfs)
+    bitsets = build_comparison_bitsets(deg_dfs)
+
+    opposites = opposite_table(bitsets, {'comp0': '2o2', 'comp3': '40o2'})
+
+    a, b = sets['comp0'], sets['comp3']
+    expected = sorted((a['up'] & b['down']) | (a['down'] & b['up']))
+    assert opposites.columns.tolist() == ['gene_id', 'log2FoldChange_2o2',
+                                          'log2FoldChange_40o2']
+    assert opposites['gene_id'].tolist() == expected
+    assert opposites['log2FoldChange_2o2'].tolist() == [a['lfc'][g] for g in expected]
+    assert (np.sign(opposites['log2FoldChange_2o2'])
+            == -np.sign(opposites['log2FoldChange_40o2'])).all()
+
+
+def upset_reference(sets, names, kind):
+    """
+    Exclusive intersection counts straight from the membership of each gene.
+    """
+    genes = set().union(*(sets[n][kind] for n in names))
+    return Counter(tuple(g in sets[n][kind] for n in names) for g in genes)
+
+
+@pytest.mark.parametrize('n_comparisons', [5, 64])
+def test_upset_counts(n_comparisons):
+    deg_dfs = random_degs(n_comparisons)
+    sets = as_sets(deg_dfs)
+    bitsets = build_comparison_bitsets(deg_dfs)
+
+    for kind in ('sig', 'up'):
+        counts = upset_counts(bitsets, kind=kind)
+
+        assert dict(counts) == upset_reference(sets, list(deg_dfs), kind)
+        assert list(counts.index.names) == list(deg_dfs)
+        assert counts.index.is_monotonic_increasing
+
+
+def test_upset_counts_subset_and_names():
+    deg_dfs = random_degs()
+    sets = as_sets(deg_dfs)
+    bitsets = build_comparison_bitsets(deg_dfs)
+
+    counts = upset_counts(bitsets, ['comp2', 'comp0'], names={'comp0': '2% 1h'})
+
+    assert list(counts.index.names) == ['comp2', '2% 1h']
+    assert dict(counts) == upset_reference(sets, ['comp2', 'comp0'], 'sig')
@@ -0,0 +1,91 @@
+"""
+Tests for the long-format DESeq2 Parquet store.
+
+Author: Serena G. Lotreck
+"""
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from deseq2_store import (parse_comparison_name, build_deseq2_store, open_deseq2_store,
+                          read_deseq2_store, comparison_frames, wide_log2fc)
+
+
+def write_degs(path, genes, log2fc, padj):
+    pd.DataFrame({'gene_id': genes, 'baseMean': 10.0, 'log2FoldChange': log2fc,
+                  'pvalue': padj, 'padj': padj}).to_csv(path, index=False)
+
+
+@pytest.fixture
+def deseq2_dir(tmp_path):
+    out = tmp_path / 'deseq2_output'
+    out.mkdir()
+    write_degs(out / '1h_vs_7h_2o2_Araport11_DEGs.csv',
+               ['AT1G03000', 'AT1G01000', 'AT1G02000'], [1.5, -2.0, 0.5], [0.01, 0.2, 0.04])
+    write_degs(out / '7h_o2_2_21_Araport11_DEGs.csv',
+               ['AT1G01000', 'AT1G04000'], [1.0, -1.0], [0.001, 0.5])
+    (out / 'README_notes.csv').write_text('note\nnot a comparison\n')
+    return out
+
+
+def test_parse_comparison_name():
+    assert parse_comparison_name('1h_vs_7h_21o2_Araport11_DEGs.csv') == {
+        'comparison': '1h_vs_7h_21o2', 'comparison_type': 'time', 'time_1': '1h',
+        'time_2': '7h', 'oxygen_1': '21', 'oxygen_2': '21'}
+    assert parse_comparison_name('7h_o2_2_21_DEGs.csv')['oxygen_2'] == '21'
+    assert parse_comparison_name('README_notes.csv')['comparison_type'] is None
+
+
+def test_store_reads_push_down(deseq2_dir, tmp_path):
+    store = str(tmp_path / 'degs.parquet')
+    comparisons = build_deseq2_store(deseq2_dir, store)
+
+    assert list(comparisons['comparison']) == ['1h_vs_7h_2o2', '7h_o2_2_21']
+    assert pq.ParquetFile(store).num_row_groups == 2
+    everything = read_deseq2_store(store)
+    assert list(everything['gene_id'].astype(str)) == ['AT1G01000', 'AT1G02000',
+                                                       'AT1G03000', 'AT1G01000',
+                                                       'AT1G04000']
+
+    subset = read_deseq2_store(store, columns=['padj'], genes=['at1g01000'],
+                               comparison_type='oxygen')
+    assert list(subset.columns) == ['comparison', 'gene_id', 'padj']
+    assert subset.astype({'comparison': str, 'gene_id': str}).to_dict('records') == [
+        {'comparison': '7h_o2_2_21', 'gene_id': 'AT1G01000', 'padj': 0.001}]
+    significant = read_deseq2_store(store, filters=[('padj', '<', 0.05)])
+    assert len(significant) == 3
+
+    frames = comparison_frames(store, comparisons=['7h_o2_2_21', '1h_vs_7h_2o2'])
+    assert list(frames) == ['7h_o2_2_21', '1h_vs_7h_2o2']
+    assert list(frames['1h_vs_7h_2o2']['log2FoldChange']) == [-2.0, 0.5, 1.5]
+
+
+def test_wide_log2fc(deseq2_dir, tmp_path):
+    store = open_deseq2_store(deseq2_dir, tmp_path / 'degs.parquet')
+    comparisons = {'1h_vs_7h_2o2': 'time', '7h_o2_2_21': 'oxygen'}
+
+    inner = wide_log2fc(store, comparisons)
+    assert inner.to_dict('records') == [
+        {'gene_id': 'AT1G01000', 'log2FoldChange_time': -2.0, 'log2FoldChange_oxygen': 1.0}]
+    outer = wide_log2fc(store, comparisons, how='outer')
+    assert sorted(outer['gene_id']) == ['AT1G01000', 'AT1G02000', 'AT1G03000', 'AT1G04000']
+
+
+def test_store_is_rebuilt_when_outputs_change(deseq2_dir, tmp_path):
+    store = open_deseq2_store(deseq2_dir, tmp_path / 'degs.parquet')
+    write_degs(deseq2_dir / '1h_vs_7h_40o2_Araport11_DEGs.csv', ['AT1G01000'], [3.0], [0.01])
+    open_deseq2_store(deseq2_dir, store)
+    assert '1h_vs_7h_40o2' in set(read_deseq2_store(store)['comparison'].astype(str))
+
+
+def test_bad_directories_raise(deseq2_dir, tmp_path):
+    write_degs(deseq2_dir / '1h_vs_7h_2o2_Araport11_DEGs_b.csv', ['AT1G01000'], [3.0], [0.01])
+    with pytest.raises(ValueError, match='1h_vs_7h_2o2_Araport11_DEGs_b.csv'):
+        build_deseq2_store(deseq2_dir, tmp_path / 'degs.parquet')
+
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+    with pytest.raises(ValueError, match='No DESeq2 output'):
+        build_deseq2_store(empty, tmp_path / 'degs.parquet')
+    (empty / 'README_notes.csv').write_text('note\n')
+    with pytest.raises(ValueError, match='named like'):
+        build_deseq2_store(empty, tmp_path / 'degs.parquet')
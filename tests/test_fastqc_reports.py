@@ -0,0 +1,147 @@
+"""
+Tests for reading FastQC reports from fastqc_data.txt.
+
+Author: Serena G. Lotreck
+"""
+import os
+import zipfile
+import pandas as pd
+import pytest
+import fastqc_reports
+from fastqc_reports import (parse_fastqc_data, load_fastqc_reports,
+                            write_overrepresented_fasta)
+
+
+def fastqc_data(filename, length, per_base, overrep=''):
+    """
+    fastqc_data.txt as written by FastQC 0.12, with a subset of the modules.
+    An empty overrep gives a passing module with no rows.
+    """
+    if overrep:
+        overrep = f'#Sequence\tCount\tPercentage\tPossible Source\n{overrep}'
+    return (f'##FastQC\t0.12.1\n'
+            f'>>Basic Statistics\tpass\n'
+            f'#Measure\tValue\n'
+            f'Filename\t{filename}\n'
+            f'File type\tConventional base calls\n'
+            f'Total Sequences\t1000\n'
+            f'Sequences flagged as poor quality\t0\n'
+            f'Sequence length\t{length}\n'
+            f'%GC\t45\n'
+            f'>>END_MODULE\n'
+            f'>>Per base sequence quality\twarn\n'
+            f'#Base\tMean\tMedian\tLower Quartile\tUpper Quartile\t10th Percentile\t90th Percentile\n'
+            f'{per_base}'
+            f'>>END_MODULE\n'
+            f'>>Sequence Duplication Levels\tfail\n'
+            f'#Total Deduplicated Percentage\t80.5\n'
+            f'#Duplication Level\tPercentage of deduplicated\tPercentage of total\n'
+            f'1\t90.0\t80.0\n'
+            f'>10\t1.0\t2.0\n'
+            f'>>END_MODULE\n'
+            f'>>Overrepresented sequences\t{"warn" if overrep else "pass"}\n'
+            f'{overrep}'
+            f'>>END_MODULE\n')
+
+
+PER_BASE = ('1\t32.1\t33.0\t32.0\t34.0\t31.0\t34.0\n'
+            '2\t32.2\t33.0\t32.0\t34.0\t31.0\t34.0\n'
+            '10-14\t30.5\t31.0\t30.0\t32.0\t28.0\t33.0\n')
+OVERREP = ('AGATCGGAAGAGCACACGTCTGAACTCCAGTCA\t25\t2.5\tTruSeq Adapter, Index 1\n'
+           'GATCGGAAGAGCACACGTCTGAACTCCAGTCAC\t12\t1.2\tNo Hit\n')
+
+
+def test_parse_fastqc_data():
+    modules = parse_fastqc_data(fastqc_data('a.fastq.gz', '151', PER_BASE, OVERREP))
+
+    assert {n: m['status'] for n, m in modules.items()} == {
+        'Basic Statistics': 'pass', 'Per base sequence quality': 'warn',
+        'Sequence Duplication Levels': 'fail', 'Overrepresented sequences': 'warn'}
+    per_base = modules['Per base sequence quality']['table']
+    assert per_base['Base'].tolist() == ['1', '2', '10-14']
+    assert per_base['base_start'].tolist() == [1, 2, 10]
+    assert per_base['base_end'].tolist() == [1, 2, 14]
+    assert per_base['Mean'].tolist() == [32.1, 32.2, 30.5]
+    duplication = modules['Sequence Duplication Levels']
+    assert duplication['meta'] == {'Total Deduplicated Percentage': '80.5'}
+    assert duplication['table']['Duplication Level'].tolist() == ['1', '>10']
+    assert duplication['table']['Percentage of total'].tolist() == [80.0, 2.0]
+    overrep = modules['Overrepresented sequences']['table']
+    assert overrep['Count'].tolist() == [25, 12]
+    assert overrep['Possible Source'].tolist() == ['TruSeq Adapter, Index 1', 'No Hit']
+
+
+def test_parse_untyped_and_empty_module():
+    modules = parse_fastqc_data(fastqc_data('a.fastq.gz', '151', PER_BASE), typed=False)
+
+    assert modules['Per base sequence quality']['table']['Mean'].tolist() == [
+        '32.1', '32.2', '30.5']
+    assert modules['Overrepresented sequences']['table'].empty
+
+
+def write_reports(qc_dir):
+    os.makedirs(qc_dir, exist_ok=True)
+    reports = {'a_R1': ('151', OVERREP), 'b_R1': ('35-151', ''),
+               'c_R1': ('151', OVERREP.splitlines(True)[0])}
+    for sample, (length, overrep) in reports.items():
+        text = fastqc_data(f'{sample}.fastq.gz', length, PER_BASE, overrep)
+        if sample == 'c_R1':
+            # Extracted output directory without a zip
+            os.makedirs(f'{qc_dir}/{sample}_fastqc')
+            with open(f'{qc_dir}/{sample}_fastqc/fastqc_data.txt', 'w') as f:
+                f.write(text)
+            continue
+        with zipfile.ZipFile(f'{qc_dir}/{sample}_fastqc.zip', 'w') as zf:
+            zf.writestr(f'{sample}_fastqc/fastqc_data.txt', text)
+
+
+def test_load_fastqc_reports(tmp_path):
+    write_reports(tmp_path / 'qc')
+
+    tables = load_fastqc_reports(str(tmp_path / 'qc'), n_jobs=2)
+
+    basic = tables['basic_statistics'].set_index('sample')
+    assert list(basic.index) == ['a_R1', 'b_R1', 'c_R1']
+    assert basic['Total Sequences'].tolist() == [1000]*3
+    # One trimmed sample makes the whole column a range
+    assert basic['Sequence length'].tolist() == ['151', '35-151', '151']
+    assert basic['sequence_length_start'].tolist() == [151, 35, 151]
+    assert basic['sequence_length_end'].tolist() == [151, 151, 151]
+    status = tables['module_status']
+    assert status.loc[status['module'] == 'Sequence Duplication Levels', 'status'].eq('fail').all()
+    duplication = tables['sequence_duplication_levels']
+    assert duplication['Total Deduplicated Percentage'].eq(80.5).all()
+    assert len(tables['per_base_sequence_quality']) == 9
+    assert tables['overrepresented_sequences']['sample'].tolist() == ['a_R1', 'a_R1', 'c_R1']
+
+
+def test_cached_tables_are_reused_until_a_report_changes(tmp_path, monkeypatch):
+    qc_dir, cache_dir = str(tmp_path / 'qc'), str(tmp_path / 'cache')
+    write_reports(qc_dir)
+    first = load_fastqc_reports(qc_dir, n_jobs=1, cache_dir=cache_dir)
+
+    class NoPool:
+        def __init__(self, *args, **kwargs):
+            raise AssertionError('reports were parsed again')
+
+    monkeypatch.setattr(fastqc_reports, 'ProcessPoolExecutor', NoPool)
+    cached = load_fastqc_reports(qc_dir, n_jobs=1, cache_dir=cache_dir)
+    assert list(cached) == list(first)
+    for name in first:
+        pd.testing.assert_frame_equal(cached[name], first[name], check_dtype=False)
+
+    stat = os.stat(f'{qc_dir}/a_R1_fastqc.zip')
+    os.utime(f'{qc_dir}/a_R1_fastqc.zip', (stat.st_atime, stat.st_mtime + 10))
+    with pytest.raises(AssertionError, match='parsed again'):
+        load_fastqc_reports(qc_dir, n_jobs=1, cache_dir=cache_dir)
+
+
+def test_write_overrepresented_fasta(tmp_path):
+    write_reports(tmp_path / 'qc')
+    overrep = load_fastqc_reports(str(tmp_path / 'qc'), n_jobs=1)['overrepresented_sequences']
+
+    seq_ids = write_overrepresented_fasta(overrep, str(tmp_path / 'overrep.fasta'))
+
+    assert list(seq_ids) == ['a_R1|0', 'a_R1|1', 'c_R1|0']
+    with open(tmp_path / 'overrep.fasta') as f:
+        assert f.read().split('\n')[:2] == ['>a_R1|0', 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCA']
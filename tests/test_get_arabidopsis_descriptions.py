@@ -0,0 +1,88 @@
+"""
+Tests for the annotation store and gene metadata lookups.
+
+Author: Serena G. Lotreck
+"""
+import os
+import pandas as pd
+import pytest
+import pyarrow.feather as feather
+import get_arabidopsis_descriptions as gad
+
+
+@pytest.fixture
+def metadata_paths(tmp_path):
+    path = tmp_path / 'annotation.txt'
+    path.write_text('name\ttype\tshort_description\n'
+                    'AT1G01020.1\tprotein_coding\tARV1\n'
+                    'AT1G01010.1\tprotein_coding\tNAC domain containing protein 1\n')
+    return {'araport': str(path)}
+
+
+def test_store_hit_does_not_read_the_file(tmp_path, metadata_paths, monkeypatch):
+    store_path = str(tmp_path / 'store.feather')
+    gad._METADATA_CACHE.clear()
+    gad.build_annotation_store(metadata_paths, store_path)
+    gad._METADATA_CACHE.clear()
+    read_table = feather.read_table
+    reads = []
+
+    def record(*args, **kwargs):
+        reads.append(args[0])
+        return read_table(*args, **kwargs)
+
+    monkeypatch.setattr(feather, 'read_table', record)
+    first, sources = gad.load_annotation_store(store_path)
+    second, _ = gad.load_annotation_store(store_path)
+    assert len(reads) == 1
+    assert second is first
+    assert list(first['gene_id']) == ['AT1G01010', 'AT1G01020']
+    assert sources == list(gad._source_key(metadata_paths))
+
+    # A rewritten store is read again
+    stat = os.stat(store_path)
+    os.utime(store_path, (stat.st_atime, stat.st_mtime + 10))
+    gad.load_annotation_store(store_path)
+    assert len(reads) == 2
+
+
+def test_take_genes_matches_left_merge():
+    all_metadata = pd.DataFrame({
+        'name': ['AT1G01010.1', 'AT1G01010.2', 'AT1G01020.1', 'AT1G01030.1',
+                 'AT1G01030.2', 'AT1G01030.3', 'AT5G00010.1'],
+        'short_description': list('abcdefg')})
+    all_metadata['gene_id'] = all_metadata['name'].str.split('.').str[0]
+    # Not in the metadata, repeated, out of order and a novel gene that
+    # sorts between and after the known ones
+    genes = pd.Series(['AT1G01030', 'novel', 'AT1G01010', 'AT1G01030', 'AT1G01025',
+                       'AT5G00010', 'AT1G01020'], name='gene_id', dtype=object)
+
+    gene_df, n_rows = gad._take_genes(all_metadata, genes)
+
+    expected = pd.merge(genes, all_metadata, how='left', on='gene_id')
+    pd.testing.assert_frame_equal(gene_df, expected, check_dtype=False)
+    assert n_rows.tolist() == [3, 1, 2, 3, 1, 1, 1]
+
+
+def test_batch_matches_single_lists(metadata_paths):
+    gad._METADATA_CACHE.clear()
+    gene2GO = pd.DataFrame({'object_name': ['AT1G01010', 'AT1G01010', 'novel'],
+                            'GO_term': ['nucleus', 'DNA binding', 'cytosol'],
+                            'GO_ID': ['GO:0005634', 'GO:0003677', 'GO:0005829']})
+    gene_lists = {'up': ['AT1G01020', 'novel', 'AT1G01010'], 'down': [],
+                  'other': ['AT1G01010']}
+
+    batch = gad.get_arabidopsis_descriptions_batch(gene_lists, metadata_paths, gene2GO)
+
+    assert list(batch) == list(gene_lists)
+    for name, genes in gene_lists.items():
+        single = gad.get_arabidopsis_descriptions(genes, metadata_paths, gene2GO)
+        if not genes:
+            assert batch[name].empty and list(batch[name].columns) == list(single.columns)
+            continue
+        pd.testing.assert_frame_equal(batch[name], single)
+        assert batch[name].index.get_level_values('gene_id').tolist() == genes
+    up = batch['up'].reset_index().set_index('gene_id')
+    assert up.loc['AT1G01010', 'GO_ID'] == ['GO:0005634', 'GO:0003677']
+    # Only genes with metadata get GO terms
+    assert up['GO_ID'].isna().tolist() == [True, True, False]
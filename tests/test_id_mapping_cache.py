@@ -0,0 +1,85 @@
+"""
+Tests for the persistent ID mapping cache.
+
+Author: Serena G. Lotreck
+"""
+import gzip
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from id_mapping_cache import IDMappingCache
+
+FROM_DB, TO_DB = 'UniProtKB_AC-ID', 'Araport'
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with IDMappingCache(tmp_path / 'mappings.sqlite') as cache:
+        yield cache
+
+
+def results(rows):
+    return pd.DataFrame(rows, columns=['from', 'to', 'failed'])
+
+
+def as_records(hits):
+    return sorted(((f, None if pd.isna(t) else t, fl) for f, t, fl in
+                   hits[['from', 'to', 'failed']].itertuples(index=False, name=None)),
+                  key=str)
+
+
+def test_round_trip(cache):
+    cache.store(results([('P1', 'AT1G01010', False), ('P1', 'AT1G01020', False),
+                         ('P2', {'primaryAccession': 'Q9XYZ1', 'genes': []}, False),
+                         ('P3', np.nan, True)]),
+                FROM_DB, TO_DB, submitted=['P1', 'P2', 'P3', 'P4'])
+    hits, misses = cache.lookup(['P1', 'P2', 'P3', 'P4', 'P5'], FROM_DB, TO_DB)
+
+    assert misses == ['P5']
+    assert as_records(hits) == [('P1', 'AT1G01010', False), ('P1', 'AT1G01020', False),
+                                ('P2', 'Q9XYZ1', False), ('P3', None, True),
+                                ('P4', None, True)]
+    assert cache.stats() == {'hits': 4, 'misses': 1, 'hit_rate': 0.8}
+    # Mappings are kept per pair of databases
+    assert cache.lookup(['P1'], FROM_DB, 'Ensembl')[1] == ['P1']
+
+
+def test_success_replaces_earlier_failure(cache):
+    cache.store(results([('P1', None, True)]), FROM_DB, TO_DB)
+    cache.store(results([('P1', 'AT1G01010', False)]), FROM_DB, TO_DB)
+    hits, _ = cache.lookup(['P1'], FROM_DB, TO_DB)
+
+    assert as_records(hits) == [('P1', 'AT1G01010', False)]
+
+
+def test_failures_expire(tmp_path):
+    with IDMappingCache(tmp_path / 'mappings.sqlite', failed_ttl=60) as cache:
+        cache.store(results([('P1', None, True), ('P2', 'AT1G01010', False)]),
+                    FROM_DB, TO_DB)
+        with cache.conn:
+            cache.conn.execute('UPDATE mappings SET updated = ?', (time.time() - 120,))
+        hits, misses = cache.lookup(['P1', 'P2'], FROM_DB, TO_DB)
+
+    assert misses == ['P1']
+    assert as_records(hits) == [('P2', 'AT1G01010', False)]
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_import_idmapping_dump(cache, tmp_path, reverse):
+    dump = tmp_path / 'idmapping.dat.gz'
+    with gzip.open(dump, 'wt') as f:
+        f.write('P1\tAraport\tAT1G01010\n'
+                'P1\tGene_Name\tNAC001\n'
+                'P2\tAraport\tAT1G01020\n'
+                'P3\tAraport\tAT1G01030\n')
+    n_imported = cache.import_idmapping_dump(str(dump), 'Araport', FROM_DB, TO_DB,
+                                             reverse=reverse, batch_size=2)
+    query = ['AT1G01010', 'AT1G01030'] if reverse else ['P1', 'P3']
+    hits, misses = cache.lookup(query, FROM_DB, TO_DB)
+
+    assert n_imported == 3
+    assert misses == []
+    expected = [('AT1G01010', 'P1'), ('AT1G01030', 'P3')] if reverse else \
+        [('P1', 'AT1G01010'), ('P3', 'AT1G01030')]
+    assert as_records(hits) == [(f, t, False) for f, t in expected]
@@ -0,0 +1,126 @@
+"""
+Tests for the offline GO enrichment engine.
+
+Author: Serena G. Lotreck
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import hypergeom
+from local_GO_enrichment import (build_GO_index, hypergeom_pvalues, local_GO_enrichment,
+                                 permutation_GO_pvalues)
+from multiple_testing import bh_fdr
+
+GENES = [f'AT1G{i:05d}' for i in range(40)]
+
+
+def toy_gene2GO():
+    """
+    gene2GO table with terms of different sizes in two aspects, and a
+    duplicated annotation.
+    """
+    rows = []
+    terms = {'GO:0000001': ('response to stress', 'P', GENES[:10]),
+             'GO:0000002': ('photosynthesis', 'P', GENES[5:25]),
+             'GO:0000003': ('kinase activity', 'F', GENES[::3]),
+             'GO:0000004': ('binding', 'F', GENES[30:]),
+             'GO:0000005': ('transport', 'P', GENES[20:22])}
+    for go_id, (term, aspect, genes) in terms.items():
+        rows.extend({'object_name': g, 'GO_term': term, 'GO_ID': go_id, 'aspect': aspect}
+                    for g in genes)
+    rows.append(rows[0])
+    return pd.DataFrame(rows)
+
+
+def gene_lists():
+    return {'up': GENES[:8] + GENES[30:32] + ['not_in_gene2GO'],
+            'down': GENES[10:30:2],
+            'empty': []}
+
+
+def results_table(enrichments):
+    rows = []
+    for group, aspects in enrichments.items():
+        for aspect, res in aspects.items():
+            rows.extend({'group': group, 'aspect': aspect, 'GO_ID': r['term']['id'],
+                         'k': r['number_in_list'], 'K': r['number_in_reference'],
+                         'p': r['pValue'], 'fdr': r['fdr'],
+                         'genes': r.get('input_list', {}).get('mapped_ids')}
+                        for r in res['result'])
+    return pd.DataFrame(rows)
+
+
+def test_build_GO_index():
+    index = build_GO_index(toy_gene2GO(), aspect_col='aspect')
+
+    terms = index['terms'].set_index('GO_ID')
+    # Genes 25, 26, 28 and 29 have no annotations
+    assert len(index['genes']) == 36
+    assert index['matrix'].shape == (36, 5)
+    assert terms.loc['GO:0000001', 'number_in_reference'] == 10
+    assert terms.loc['GO:0000003', 'aspect'] == 'molecular_function'
+
+
+@pytest.mark.parametrize('background', [None, GENES + [f'extra{i}' for i in range(60)]])
+def test_pvalues_match_scipy(background):
+    index = build_GO_index(toy_gene2GO(), background=background, aspect_col='aspect')
+    lists = gene_lists()
+
+    table = results_table(local_GO_enrichment(lists, go_index=index))
+
+    # Unannotated background genes count towards the reference
+    N = 36 if background is None else 100
+    for group, genes in lists.items():
+        n = len(set(genes) & set(index['genes']))
+        sub = table[table['group'] == group]
+        assert len(sub) == 5
+        np.testing.assert_allclose(sub['p'], hypergeom.sf(sub['k'] - 1, N, sub['K'], n))
+        # Sorted by p-value within each aspect, FDR within each aspect
+        for _, aspect in sub.groupby('aspect'):
+            assert aspect['p'].is_monotonic_increasing
+            np.testing.assert_allclose(aspect['fdr'], bh_fdr(aspect['p'].to_numpy()))
+
+
+def test_mapped_ids_and_counts():
+    table = results_table(local_GO_enrichment(gene_lists(), toy_gene2GO(),
+                                              aspect_col='aspect'))
+
+    stress = table[(table['group'] == 'up') & (table['GO_ID'] == 'GO:0000001')].iloc[0]
+    assert stress['k'] == 8
+    assert sorted(stress['genes']) == GENES[:8]
+    assert table.loc[table['group'] == 'empty', 'k'].eq(0).all()
+    assert table.loc[table['group'] == 'empty', 'p'].eq(1).all()
+
+
+@pytest.mark.parametrize('alternative', ['less', 'two-sided'])
+def test_other_alternatives_match_scipy(alternative):
+    k, N, K, n = np.array([0, 1, 3, 7]), 50, np.array([10, 10, 20, 8]), 12
+
+    pvals = hypergeom_pvalues(k, N, K, n, alternative)
+
+    lower, upper = hypergeom.cdf(k, N, K, n), hypergeom.sf(k - 1, N, K, n)
+    expected = lower if alternative == 'less' else np.minimum(1, 2*np.minimum(lower, upper))
+    np.testing.assert_allclose(pvals, expected)
+    with pytest.raises(ValueError):
+        hypergeom_pvalues(k, N, K, n, 'bigger')
+
+
+def test_permutation_pvalues():
+    index = build_GO_index(toy_gene2GO(), aspect_col='aspect')
+    lists = gene_lists()
+    n_perm = 2000
+
+    perm = permutation_GO_pvalues(lists, index, n_permutations=n_perm, n_jobs=2, seed=0)
+
+    again = permutation_GO_pvalues(lists, index, n_permutations=n_perm, n_jobs=2, seed=0)
+    pd.testing.assert_frame_equal(perm, again)
+    assert list(perm.index) == list(lists)
+    assert (perm.values >= 1/(n_perm + 1)).all() and (perm.values <= 1).all()
+    # A random set does at least as well as the list exactly as often as
+    # the hypergeometric upper tail says
+    table = results_table(local_GO_enrichment(lists, go_index=index)).set_index(['group', 'GO_ID'])
+    for (group, go_id), row in table.iterrows():
+        if group == 'empty':
+            assert perm.loc[group, go_id] == 1
+            continue
+        assert abs(perm.loc[group, go_id] - row['p']) < 4*np.sqrt(0.25/n_perm) + 1/n_perm
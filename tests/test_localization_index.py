@@ -0,0 +1,133 @@
+"""
+Tests for the SUBA localization index, against the cleaning code in
+protein_localization.ipynb.
+
+Author: Serena G. Lotreck
+"""
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from localization_index import (build_localization_index, open_localization_index,
+                                cleaning_strategies, compartment_mask, gene_mask,
+                                loci_where, overlap_counts, compartment_values)
+
+# location_ms, location_consensus
+PEROX_ROWS = {
+    'AT1G01010.1': ('peroxisome:ref1', 'peroxisome'),
+    'AT1G01020.1': ('peroxisome:ref1;peroxisome:ref2', 'peroxisome'),
+    'AT1G01030.1': ('cytosol:ref1;peroxisome:ref2', 'peroxisome;cytosol'),
+    'AT1G01040.1': ('peroxisome', 'peroxisome:ref1'),
+    'AT1G01050.1': ('cytosol:ref1', 'cytosol'),
+    'AT1G01060.1': (np.nan, 'peroxisome'),
+    'AT1G01070.1': ('peroxisome:ref1;', np.nan),
+}
+MITO_ROWS = {
+    'AT1G01050.1': ('cytosol:ref1', 'cytosol'),
+    'AT2G01010.1': ('mitochondrion:ref1', 'mitochondrion'),
+    'AT2G01020.1': ('mitochondrion:ref1;plastid:ref2', 'mitochondrion'),
+}
+
+
+def write_suba(path, rows):
+    pd.DataFrame({'locus': list(rows), 'location_ms': [v[0] for v in rows.values()],
+                  'location_consensus': [v[1] for v in rows.values()],
+                  'location_gfp': 'nucleus'}).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.fixture
+def suba_paths(tmp_path):
+    return {'perox': write_suba(tmp_path / 'perox.csv', PEROX_ROWS),
+            'mito': write_suba(tmp_path / 'mito.csv', MITO_ROWS)}
+
+
+def notebook_cleaning(perox):
+    """
+    The cleaning cell from protein_localization.ipynb.
+    """
+    return {
+        'perox_only_one_ms': perox[(perox['location_ms'].str.split(';').str.len() == 1) & (perox['location_ms'].str.split(':').str[0] == 'peroxisome')],
+        'perox_any_perox_ms': perox[perox['location_ms'].str.contains('peroxisome')],
+        'perox_consensus': perox[perox['location_consensus'] == 'peroxisome']
+    }
+
+
+def test_cleaning_strategies_match_notebook(suba_paths):
+    index = build_localization_index(suba_paths)
+    perox = pd.read_csv(suba_paths['perox'])
+
+    masks = cleaning_strategies(index, 'peroxisome', source='perox')
+
+    expected = notebook_cleaning(perox)
+    for name, notebook_name in [('only_one_ms', 'perox_only_one_ms'),
+                                ('any_ms', 'perox_any_perox_ms'),
+                                ('consensus', 'perox_consensus')]:
+        assert loci_where(index, masks[name]) == sorted(expected[notebook_name]['locus'])
+    assert loci_where(index, masks['only_one_ms']) == ['AT1G01010.1', 'AT1G01040.1']
+    assert loci_where(index, masks['consensus']) == ['AT1G01010.1', 'AT1G01020.1',
+                                                     'AT1G01060.1']
+
+
+def test_any_ms_ignores_names_in_references(tmp_path):
+    rows = {'AT3G01010.1': ('cytosol:peroxisome_screen', 'cytosol'),
+            'AT3G01020.1': ('peroxisome:ref1', 'peroxisome')}
+    path = write_suba(tmp_path / 'perox.csv', rows)
+    index = build_localization_index({'perox': path})
+
+    any_ms = cleaning_strategies(index, 'peroxisome')['any_ms']
+
+    # The notebook's substring search also picks up the reference
+    notebook = notebook_cleaning(pd.read_csv(path))['perox_any_perox_ms']
+    assert sorted(notebook['locus']) == ['AT3G01010.1', 'AT3G01020.1']
+    assert loci_where(index, any_ms) == ['AT3G01020.1']
+    with pytest.raises(ValueError):
+        compartment_mask(index, 'peroxisome', match='only')
+
+
+def test_index_queries(suba_paths):
+    index = build_localization_index(suba_paths)
+
+    assert list(index['compartments']) == ['cytosol', 'mitochondrion', 'peroxisome', 'plastid']
+    # A locus in two exports is in both
+    assert loci_where(index, compartment_mask(index, 'cytosol', source='mito')) == ['AT1G01050.1']
+    assert loci_where(index, compartment_mask(index, 'cytosol', source='perox')) == [
+        'AT1G01030.1', 'AT1G01050.1']
+    assert loci_where(index, gene_mask(index, ['at2g01010', 'AT1G01010.2', 'AT9G99999'])) == [
+        'AT1G01010.1', 'AT2G01010.1']
+    overlaps = overlap_counts(index)
+    assert overlaps.loc['peroxisome', 'peroxisome'] == 5
+    assert overlaps.loc['cytosol', 'peroxisome'] == 1
+    assert overlaps.loc['mitochondrion', 'plastid'] == 1
+
+    df = pd.DataFrame({'base_accession_num': ['at1g01010', 'AT2G01010', 'at1g01050'],
+                       'lfc': [1.0, 2.0, 3.0]})
+    values = compartment_values(index, {'perox': compartment_mask(index, 'peroxisome'),
+                                        'mito': compartment_mask(index, 'mitochondrion')},
+                                df, 'lfc')
+    assert values['perox'].tolist() == [1.0]
+    assert values['mito'].tolist() == [2.0]
+
+
+def test_saved_index_is_reused_until_stale(suba_paths, tmp_path):
+    out_dir = str(tmp_path / 'index')
+    built = open_localization_index(suba_paths, out_dir)
+
+    loaded = open_localization_index(suba_paths, out_dir)
+
+    for key in ('loci', 'compartments', 'sources'):
+        assert list(loaded[key]) == list(built[key])
+    for key in ('ms', 'ms_single', 'consensus_exact', 'source'):
+        assert (loaded[key] != built[key]).nnz == 0
+    np.testing.assert_array_equal(cleaning_strategies(loaded, 'peroxisome')['consensus'],
+                                  cleaning_strategies(built, 'peroxisome')['consensus'])
+
+    # An index saved by another version is rebuilt
+    with open(f'{out_dir}/localization_ids.json') as f:
+        ids = json.load(f)
+    ids['version'] = 1
+    ids['matrices'] = ['source', 'ms', 'consensus']
+    with open(f'{out_dir}/localization_ids.json', 'w') as f:
+        json.dump(ids, f)
+    rebuilt = open_localization_index(suba_paths, out_dir)
+    assert 'ms_single' in rebuilt
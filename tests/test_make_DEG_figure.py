@@ -0,0 +1,152 @@
+"""
+Tests for the DEG figure data and render modes.
+
+Author: Serena G. Lotreck
+"""
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import to_rgba
+import numpy as np
+import pandas as pd
+import pytest
+from make_DEG_figure import buildDEGmatrix, makeDEGfigure
+
+COLORS = {'PSI': 'tab:green', 'PSII': 'tab:orange'}
+SEMANTIC = {'1h': '1 hour', '7h': '7 hours', 'none': 'No overlap'}
+TAIR2GENE = {'at1g01010': 'NAC001'}
+
+
+def toy_degs():
+    deg_dfs = {
+        '1h': pd.DataFrame({'gene_id': ['AT1G01010', 'AT2G01010', 'AT9G99999', 'AT1G01010'],
+                            'log2FoldChange': [1.5, -2.0, 3.0, 1.5]}),
+        '7h': pd.DataFrame({'gene_id': ['AT3G01010', 'AT1G01010'],
+                            'log2FoldChange': [0.5, -1.0]}),
+        'none': pd.DataFrame({'gene_id': ['AT9G99999'], 'log2FoldChange': [2.0]})
+    }
+    photosynth_sets = {'PSI': ['at1g01010', 'AT2G01010', 'AT4G01010'],
+                       'PSII': ['AT3G01010', 'AT2G01010']}
+    return deg_dfs, photosynth_sets
+
+
+def test_buildDEGmatrix():
+    deg_dfs, photosynth_sets = toy_degs()
+
+    deg_matrix = buildDEGmatrix(deg_dfs, photosynth_sets)
+
+    # Genes in set order, only if DE somewhere, comparisons in input order
+    expected = pd.DataFrame({'1h': [1.5, -2.0, 0.0], '7h': [-1.0, 0.0, 0.5],
+                             'none': [0.0, 0.0, 0.0]},
+                            index=pd.Index(['at1g01010', 'at2g01010', 'at3g01010'],
+                                           name='gene_id'))
+    pd.testing.assert_frame_equal(deg_matrix['lfc'], expected, check_names=False,
+                                  check_index_type=False)
+    assert deg_matrix['lfc'].index.name == 'gene_id'
+    assert deg_matrix['membership'].to_numpy().tolist() == [[True, False], [True, True],
+                                                            [False, True]]
+    assert list(deg_matrix['membership'].columns) == ['PSI', 'PSII']
+    # A gene in two sets is colored by the last one
+    assert deg_matrix['category'].tolist() == ['PSI', 'PSII', 'PSII']
+
+
+def test_buildDEGmatrix_id_col_and_no_overlap():
+    deg_dfs, photosynth_sets = toy_degs()
+    deg_dfs = {name: df.rename(columns={'gene_id': 'tair'}) for name, df in deg_dfs.items()}
+
+    deg_matrix = buildDEGmatrix({'none': deg_dfs['none']}, photosynth_sets, id_col='tair')
+
+    assert deg_matrix['lfc'].shape == (0, 1)
+    assert deg_matrix['lfc'].index.name == 'tair'
+    assert deg_matrix['membership'].shape == (0, 2)
+    assert deg_matrix['category'].empty
+
+
+def draw(render, separate_columns=False, **kwargs):
+    deg_dfs, photosynth_sets = toy_degs()
+    plt.close('all')
+    makeDEGfigure(deg_dfs, photosynth_sets, COLORS, SEMANTIC, TAIR2GENE,
+                  separate_columns=separate_columns, render=render, **kwargs)
+    fig = plt.gcf()
+    fig.canvas.draw()
+    return fig
+
+
+def bar_heights(ax):
+    """
+    Heights and colors of the bars in an axis, from patches or a collection.
+    """
+    if ax.patches:
+        return ([p.get_height() for p in ax.patches],
+                [p.get_facecolor() for p in ax.patches])
+    bars = next(c for c in ax.collections if isinstance(c, PolyCollection))
+    return ([path.vertices[1, 1] for path in bars.get_paths()],
+            [tuple(c) for c in bars.get_facecolors()])
+
+
+@pytest.mark.parametrize('separate_columns', [False, True])
+def test_collection_draws_the_same_bars(separate_columns):
+    bars = draw('bars', separate_columns)
+    collection = draw('collection', separate_columns)
+
+    assert len(bars.axes) == len(collection.axes)
+    for bar_ax, coll_ax in zip(bars.axes, collection.axes):
+        assert bar_heights(bar_ax) == bar_heights(coll_ax)
+        assert bar_ax.get_title() == coll_ax.get_title()
+        assert ([t.get_text() for t in bar_ax.get_xticklabels()]
+                == [t.get_text() for t in coll_ax.get_xticklabels()])
+    heights, colors = bar_heights(collection.axes[0])
+    # The first column has the PSI genes if the sets are separate
+    n = 2 if separate_columns else 3
+    assert heights == [1.5, -2.0, 0.0][:n]
+    assert colors == [to_rgba(COLORS[c]) for c in ['PSI', 'PSII', 'PSII']][:n]
+    assert collection.axes[0].get_xticklabels()[0].get_text() == r'AT1G01010 ($\bf{NAC001}$)'
+
+
+def test_collection_rasterizes_large_panels():
+    fig = draw('collection', rasterize_threshold=2)
+
+    assert all(c.get_rasterized() for ax in fig.axes for c in ax.collections)
+
+
+@pytest.mark.parametrize('separate_columns', [False, True])
+def test_heatmap(separate_columns):
+    deg_dfs, photosynth_sets = toy_degs()
+    lfc = buildDEGmatrix(deg_dfs, photosynth_sets)['lfc']
+
+    fig = draw('heatmap', separate_columns)
+
+    images = [ax.images[0].get_array() for ax in fig.axes if ax.images]
+    n_columns = 2 if separate_columns else 1
+    # A color strip and a heatmap per column
+    assert len(images) == 2*n_columns
+    heatmaps = images[n_columns:]
+    if separate_columns:
+        np.testing.assert_array_equal(heatmaps[0], lfc.iloc[:2].to_numpy().T)
+        np.testing.assert_array_equal(heatmaps[1], lfc.iloc[1:].to_numpy().T)
+    else:
+        np.testing.assert_array_equal(heatmaps[0], lfc.to_numpy().T)
+        # Category codes in photosynth_colors order
+        np.testing.assert_array_equal(images[0], [[0, 1, 1]])
+
+
+def test_heatmap_drops_gene_labels_above_limit():
+    fig = draw('heatmap', max_gene_labels=2)
+
+    heatmap_ax = [ax for ax in fig.axes if ax.images][1]
+    assert heatmap_ax.get_xticks().size == 0
+    assert heatmap_ax.get_xlabel() == '3 genes'
+
+
+@pytest.mark.parametrize('threshold, kind', [(2, 'heatmap'), (3, 'collection')])
+def test_auto_picks_by_gene_count(threshold, kind):
+    fig = draw('auto', heatmap_threshold=threshold)
+
+    has_images = any(ax.images for ax in fig.axes)
+    assert has_images == (kind == 'heatmap')
+
+
+def test_unknown_render_mode():
+    with pytest.raises(ValueError, match='Unknown render mode'):
+        draw('svg')
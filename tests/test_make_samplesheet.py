@@ -0,0 +1,178 @@
+"""
+Tests for pairing and validating fastq files for a samplesheet.
+
+Author: Serena G. Lotreck
+"""
+import gzip
+import json
+import hashlib
+import pandas as pd
+import pytest
+import make_samplesheet
+from make_samplesheet import (parse_fastq_name, pair_fastq, _pair_sorted_names,
+                              validate_fastq_pair, validate_samplesheet)
+
+
+def touch(directory, names):
+    paths = []
+    for name in names:
+        path = directory / name
+        with gzip.open(path, 'wt') as f:
+            f.write('@read0\nACGT\n+\nFFFF\n')
+        paths.append(str(path))
+    return paths
+
+
+def write_fastq(path, read_ids, mate):
+    with gzip.open(path, 'wt') as f:
+        for read_id in read_ids:
+            f.write(f'@{read_id}/{mate} extra\nACGTACGT\n+\nFFFFFFFF\n')
+    return str(path)
+
+
+def md5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+@pytest.mark.parametrize('filename, expected', [
+    ('2-1h_S1_L001_R1_001.fastq.gz', ('2-1h', '2-1h_S1_L001_R?_001.fastq.gz', 1)),
+    ('2-1h_S1_L001_R2_001.fastq.gz', ('2-1h', '2-1h_S1_L001_R?_001.fastq.gz', 2)),
+    ('2-1h.R1.fastq.gz', ('2-1h', '2-1h.R?.fastq.gz', 1)),
+    ('2-1h_R2.fastq.gz', ('2-1h', '2-1h_R?.fastq.gz', 2)),
+    # The read number is the last token, not one in the sample name
+    ('R1_S1_L001_R2_001.fastq.gz', ('R1', 'R1_S1_L001_R?_001.fastq.gz', 2)),
+    ('2-1h_S1_L001_1.fastq.gz', None),
+    ('2-1h_S1_L001_R1_001.fastq', None),
+])
+def test_parse_fastq_name(filename, expected):
+    assert parse_fastq_name(filename) == expected
+
+
+def test_lane_split_files_pair_within_their_lane(tmp_path):
+    paths = touch(tmp_path, [f'2-1h_S1_L00{lane}_R{read}_001.fastq.gz'
+                             for lane in (1, 2) for read in (1, 2)])
+
+    pairs, unpaired = pair_fastq(paths, skip_missing=False)
+
+    assert unpaired == []
+    assert pairs == [('2-1h', paths[0], paths[1]), ('2-1h', paths[2], paths[3])]
+
+
+def test_pairs_with_same_names_in_different_runs_stay_apart(tmp_path):
+    names = ['2-1h.R1.fastq.gz', '2-1h.R2.fastq.gz']
+    (tmp_path / 'run1').mkdir()
+    (tmp_path / 'run2').mkdir()
+    run1 = touch(tmp_path / 'run1', names)
+    run2 = touch(tmp_path / 'run2', names)
+
+    pairs, _ = pair_fastq(run2 + run1, skip_missing=False)
+
+    assert pairs == [('2-1h', *run1), ('2-1h', *run2)]
+
+
+def test_sorted_name_fallback(tmp_path):
+    paths = touch(tmp_path, ['b_S2_L001_2.fastq.gz', 'a_S1_L001_1.fastq.gz',
+                             'b_S2_L001_1.fastq.gz', 'a_S1_L001_2.fastq.gz',
+                             'c_S3_L001_1.fastq.gz'])
+
+    pairs, unpaired = _pair_sorted_names(paths)
+
+    assert pairs == [('a', paths[1], paths[3]), ('b', paths[2], paths[0])]
+    assert unpaired == [paths[4]]
+
+
+def test_missing_mate_only_affects_its_sample(tmp_path):
+    paths = touch(tmp_path, ['a_S1_L001_R1_001.fastq.gz', 'a_S1_L001_R2_001.fastq.gz',
+                             'b_S2_L001_R1_001.fastq.gz', 'c_S3_L001_1.fastq.gz'])
+
+    with pytest.raises(ValueError, match='b_S2_L001_R1_001'):
+        pair_fastq(paths, skip_missing=False)
+    with pytest.warns(UserWarning):
+        pairs, unpaired = pair_fastq(paths, skip_missing=True)
+    assert pairs == [('a', paths[0], paths[1])]
+    assert sorted(unpaired) == [paths[2], paths[3]]
+
+
+def test_incremental_rewrites_sheet_with_unchanged_and_new_pairs(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    first = touch(data, ['a_S1_L001_R1_001.fastq.gz', 'a_S1_L001_R2_001.fastq.gz',
+                         'b_S2_L001_R1_001.fastq.gz', 'b_S2_L001_R2_001.fastq.gz'])
+    make_samplesheet.main(str(data), '', False, str(tmp_path), incremental=True)
+
+    # Re-deliver one mate of b and add a new sample
+    with gzip.open(first[3], 'wt') as f:
+        f.write('@read0\nACGT\n+\nFFFF\n@read1\nACGT\n+\nFFFF\n')
+    new = touch(data, ['c_S3_L001_R1_001.fastq.gz', 'c_S3_L001_R2_001.fastq.gz'])
+    make_samplesheet.main(str(data), '', False, str(tmp_path), incremental=True)
+
+    sheet = pd.read_csv(tmp_path / 'samplesheet.csv')
+    assert sheet['sample'].tolist() == ['a', 'b', 'c']
+    assert sheet['fastq_1'].tolist() == [first[0], first[2], new[0]]
+    with open(tmp_path / 'samplesheet_manifest.json') as f:
+        assert sorted(json.load(f)) == sorted(first + new)
+
+
+def test_validate_good_pair(tmp_path):
+    ids = [f'read{i}' for i in range(1000)]
+    fastq_1 = write_fastq(tmp_path / 'a_R1_001.fastq.gz', ids, 1)
+    fastq_2 = write_fastq(tmp_path / 'a_R2_001.fastq.gz', ids, 2)
+
+    # A small buffer, so part of each file is hashed after decompression
+    result = validate_fastq_pair(fastq_1, fastq_2, chunk_size=64)
+
+    assert result == {'reads_1': 1000, 'reads_2': 1000, 'md5_1': md5(fastq_1),
+                      'md5_2': md5(fastq_2), 'status': 'ok'}
+
+
+def test_validate_mismatched_read_ids(tmp_path):
+    ids = [f'read{i}' for i in range(10)]
+    fastq_1 = write_fastq(tmp_path / 'a_R1_001.fastq.gz', ids, 1)
+    fastq_2 = write_fastq(tmp_path / 'a_R2_001.fastq.gz', ids[:3] + ids[4:] + ids[3:4], 2)
+
+    result = validate_fastq_pair(fastq_1, fastq_2)
+
+    assert result['status'] == 'read ID mismatch at read 4'
+    assert result['md5_2'] == md5(fastq_2)
+
+
+def test_validate_truncated_mate(tmp_path):
+    ids = [f'read{i}' for i in range(1000)]
+    fastq_1 = write_fastq(tmp_path / 'a_R1_001.fastq.gz', ids, 1)
+    fastq_2 = write_fastq(tmp_path / 'a_R2_001.fastq.gz', ids, 2)
+    with open(fastq_2, 'rb') as f:
+        data = f.read()
+    with open(fastq_2, 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    result = validate_fastq_pair(fastq_1, fastq_2)
+
+    assert result['status'].startswith('truncated or corrupt gzip in R2')
+    assert result['md5_2'] == md5(fastq_2)
+
+
+def test_validate_missing_reads(tmp_path):
+    ids = [f'read{i}' for i in range(10)]
+    fastq_1 = write_fastq(tmp_path / 'a_R1_001.fastq.gz', ids, 1)
+    fastq_2 = write_fastq(tmp_path / 'a_R2_001.fastq.gz', ids[:8], 2)
+
+    result = validate_fastq_pair(fastq_1, fastq_2)
+
+    assert (result['reads_1'], result['reads_2']) == (10, 8)
+    assert result['status'] == 'read count mismatch'
+
+
+def test_validate_samplesheet(tmp_path):
+    ids = [f'read{i}' for i in range(10)]
+    good = [write_fastq(tmp_path / f'a_R{m}_001.fastq.gz', ids, m) for m in (1, 2)]
+    bad = [write_fastq(tmp_path / f'b_R{m}_001.fastq.gz', ids[:10 - m], m) for m in (1, 2)]
+    sheet = pd.DataFrame({'sample': ['a', 'b'], 'fastq_1': [good[0], bad[0]],
+                          'fastq_2': [good[1], bad[1]], 'strandedness': 'auto'})
+
+    with pytest.warns(UserWarning, match='Sample b failed validation'):
+        validated = validate_samplesheet(sheet, n_jobs=2)
+
+    assert validated['status'].tolist() == ['ok', 'read count mismatch']
+    assert validated['md5_1'].tolist() == [md5(good[0]), md5(bad[0])]
+    assert validated['reads_2'].tolist() == [10, 8]
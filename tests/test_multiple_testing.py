@@ -0,0 +1,69 @@
+"""
+Tests for the Benjamini-Hochberg corrections.
+
+Author: Serena G. Lotreck
+"""
+import numpy as np
+import pytest
+from multiple_testing import bh_fdr, bh_fdr_blocks
+
+
+def bh_reference(pvals):
+    """
+    Benjamini-Hochberg straight from the definition: the q-value of the
+    p-value at rank i is the minimum of p_j*m/j over ranks j >= i.
+    """
+    pvals = np.asarray(pvals, dtype=float)
+    m = len(pvals)
+    order = np.argsort(pvals)
+    q = np.empty(m)
+    for i in range(m):
+        q[order[i]] = min(1, min(pvals[order[j]]*m/(j + 1) for j in range(i, m)))
+    return q
+
+
+def test_bh_fdr_matches_definition():
+    rng = np.random.default_rng(0)
+    pvals = np.concatenate([rng.random(50), rng.random(10)*1e-3, [0.5, 0.5, 0.0, 1.0]])
+
+    np.testing.assert_allclose(bh_fdr(pvals), bh_reference(pvals))
+
+
+def test_bh_fdr_along_axis():
+    rng = np.random.default_rng(1)
+    pvals = rng.random((3, 20))
+
+    expected = np.array([bh_reference(row) for row in pvals])
+    np.testing.assert_allclose(bh_fdr(pvals, axis=1), expected)
+    np.testing.assert_allclose(bh_fdr(pvals.T, axis=0), expected.T)
+    assert bh_fdr(np.empty((2, 0)), axis=1).shape == (2, 0)
+
+
+@pytest.mark.parametrize('max_values', [2**22, 7])
+def test_bh_fdr_blocks_equals_bh_fdr(max_values):
+    rng = np.random.default_rng(2)
+    p = rng.random((30, 30))**4
+    p[rng.random(p.shape) < 0.1] = np.nan
+    # Ties, including across block and group boundaries
+    p[5, :10] = 0.01
+    p[20, :] = 1.0
+    tested_mask = np.triu(np.ones(p.shape, dtype=bool), k=1)
+    q = np.zeros_like(p)
+
+    # max_values=7 forces many groups of bins
+    bh_fdr_blocks(p, q, [(0, 7), (7, 19), (19, 30)],
+                  lambda start, stop: tested_mask[start:stop], max_values)
+
+    use = tested_mask & ~np.isnan(p)
+    expected = np.full(p.shape, np.nan)
+    expected[use] = bh_fdr(p[use])
+    np.testing.assert_allclose(q, expected, rtol=1e-12)
+
+
+def test_bh_fdr_blocks_nothing_tested():
+    p = np.full((4, 4), 0.5)
+    q = np.zeros_like(p)
+
+    bh_fdr_blocks(p, q, [(0, 4)], lambda start, stop: np.zeros((stop - start, 4), dtype=bool))
+
+    assert np.isnan(q).all()
@@ -0,0 +1,141 @@
+"""
+Tests for the DAG runner and its step cache, with toy steps in a temporary
+project module.
+
+Author: Serena G. Lotreck
+"""
+import re
+import sys
+import importlib
+import pytest
+from pipeline import Pipeline
+
+STEPS = '''
+import toy_helper
+
+
+def load(path):
+    with open(path) as f:
+        return int(f.read())
+
+
+def scale(x, factor):
+    return toy_helper.multiply(x, factor)
+
+
+def add(values):
+    return sum(values.values())
+
+
+def write(x, out_dir):
+    with open(f'{out_dir}/x.txt', 'w') as f:
+        f.write(str(x))
+    return x
+
+
+def fail(x):
+    raise RuntimeError('step failed')
+'''
+
+HELPER = '''
+def multiply(x, factor):
+    return x*factor
+'''
+
+
+@pytest.fixture
+def steps(tmp_path, monkeypatch):
+    (tmp_path / 'toy_steps.py').write_text(STEPS)
+    (tmp_path / 'toy_helper.py').write_text(HELPER)
+    (tmp_path / 'input.txt').write_text('3')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for name in ('toy_steps', 'toy_helper'):
+        sys.modules.pop(name, None)
+    yield importlib.import_module('toy_steps')
+    for name in ('toy_steps', 'toy_helper'):
+        sys.modules.pop(name, None)
+
+
+def build(steps, tmp_path, factor=2, fail=False):
+    pipe = Pipeline(tmp_path / 'cache')
+    pipe.add('load', steps.load, params={'path': str(tmp_path / 'input.txt')},
+             files=('path',))
+    pipe.add('double', steps.scale, deps={'x': 'load'}, params={'factor': factor})
+    pipe.add('triple', steps.scale, deps={'x': 'load'}, params={'factor': 3})
+    pipe.add('total', steps.add, deps={'values': ['double', 'triple']})
+    pipe.add('write', steps.write, deps={'x': 'total'}, writes_files=True)
+    if fail:
+        pipe.add('fail', steps.fail, deps={'x': 'double'})
+        pipe.add('after_fail', steps.add, deps={'values': ['fail']})
+    return pipe
+
+
+def counts(capsys):
+    """
+    Number of steps cached and run, from the summary Pipeline.run prints.
+    """
+    summary = re.findall(r'(\d+) steps, (\d+) cached, (\d+) to run', capsys.readouterr().out)
+    _, cached, to_run = map(int, summary[-1])
+    return cached, to_run
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_runs_then_hits_cache(steps, tmp_path, capsys, n_jobs):
+    pipe = build(steps, tmp_path)
+    keys = pipe.run(n_jobs=n_jobs)
+    assert counts(capsys) == (0, 5)
+    assert pipe.load('total', keys) == 15
+    with open(f'{pipe.output_dir("write", keys["write"])}/x.txt') as f:
+        assert f.read() == '15'
+
+    assert build(steps, tmp_path).run(n_jobs=n_jobs) == keys
+    assert counts(capsys) == (5, 0)
+
+
+def test_keys_follow_params_files_code_and_version(steps, tmp_path):
+    keys = build(steps, tmp_path).keys()
+
+    changed = build(steps, tmp_path, factor=4).keys()
+    assert [n for n in keys if keys[n] != changed[n]] == ['double', 'total', 'write']
+
+    (tmp_path / 'input.txt').write_text('5')
+    changed = build(steps, tmp_path).keys()
+    assert all(keys[n] != changed[n] for n in keys)
+    (tmp_path / 'input.txt').write_text('3')
+
+    # A change in a project module a step uses, not only the step itself
+    (tmp_path / 'toy_helper.py').write_text(HELPER + '\n# changed\n')
+    changed = build(steps, tmp_path).keys()
+    assert [n for n in keys if keys[n] != changed[n]] == ['double', 'triple', 'total',
+                                                          'write']
+    (tmp_path / 'toy_helper.py').write_text(HELPER)
+
+    pipe = build(steps, tmp_path)
+    pipe.steps['triple']['version'] = 2
+    changed = pipe.keys()
+    assert [n for n in keys if keys[n] != changed[n]] == ['triple', 'total', 'write']
+    assert build(steps, tmp_path).keys() == keys
+
+
+def test_force_reruns_step(steps, tmp_path, capsys):
+    pipe = build(steps, tmp_path)
+    pipe.run(n_jobs=1)
+    capsys.readouterr()
+
+    pipe.run(n_jobs=1, force=['triple'])
+    assert counts(capsys) == (4, 1)
+    pipe.run(n_jobs=1, targets=['double'], dry_run=True)
+    assert counts(capsys) == (2, 0)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_failure_stops_the_run(steps, tmp_path, capsys, n_jobs):
+    pipe = build(steps, tmp_path, fail=True)
+    with pytest.raises(RuntimeError, match='step failed'):
+        pipe.run(n_jobs=n_jobs)
+
+    keys = pipe.keys()
+    for name in ('fail', 'after_fail'):
+        with pytest.raises(FileNotFoundError):
+            pipe.load(name, keys)
+    assert pipe.load('double', keys) == 6
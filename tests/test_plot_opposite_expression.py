@@ -0,0 +1,43 @@
+"""
+Tests for the opposite expression arrow table.
+
+Author: Serena G. Lotreck
+"""
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from plot_opposite_expression import (plot_opposite_expression, normalize_log2fc,
+                                      ArrowCollection)
+
+
+def test_labels_and_arrows_share_rows_after_resize():
+    df = pd.DataFrame({'gene_id': [f'AT1G0{i}010' for i in range(5)],
+                       'a': [1.0, -0.5, 0.25, np.nan, -1.0],
+                       'b': [-1.0, 0.5, 0.1, 0.2, 1.0]})
+    plot_opposite_expression(df, {'2%': 'a', '40%': 'b'},
+                             gene_name_map={'AT1G00010': 'NAC001'})
+    fig = plt.gcf()
+    ax = fig.axes[0]
+    labels = {t.get_text(): t.get_position()[1] for t in ax.texts}
+    assert labels[r'$\bf{NAC001}$ (AT1G00010)'] == 0
+    assert [labels[f'AT1G0{i}010'] for i in range(1, 5)] == [1, 2, 3, 4]
+
+    arrows = next(c for c in ax.collections if isinstance(c, ArrowCollection))
+    for size in [(8, 6), (4, 12)]:
+        fig.set_size_inches(*size)
+        fig.canvas.draw()
+        verts = np.array([p.vertices[:7] for p in arrows.get_paths()])
+        centers = (verts[:, :, 1].max(1) + verts[:, :, 1].min(1)) / 2
+        # Arrows are centred on their row, NaN leaves a gap
+        np.testing.assert_allclose(np.round(centers), [0, 0, 1, 1, 2, 2, 3, 4, 4])
+        assert np.all(np.abs(centers - np.round(centers)) < 0.3)
+    plt.close(fig)
+
+
+def test_normalize_tolerates_empty_table():
+    empty = pd.DataFrame({'gene_id': [], 'a': [], 'b': []})
+    normalized, cols = normalize_log2fc(empty, {'x': 'a', 'y': 'b'})
+    assert cols == {'x': 'a_NORMALIZED', 'y': 'b_NORMALIZED'}
+    assert normalized.empty
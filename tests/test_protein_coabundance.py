@@ -0,0 +1,73 @@
+"""
+Tests for the blocked co-abundance index.
+
+Author: Serena G. Lotreck
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from protein_coabundance import intensity_matrix, build_coabundance_index
+from multiple_testing import bh_fdr
+
+SAMPLES = [f'{o2}{rep}' for o2 in (21, 40, 2) for rep in 'ABCD']
+
+
+def normalized_intensity_export(n_proteins=40, seed=0):
+    """
+    Table shaped like the normalized intensity export after the Std Dev
+    columns are renamed in the notebook, including its non-sample columns.
+    """
+    rng = np.random.default_rng(seed)
+    ids = [f'AT1G{i:05d}' for i in range(n_proteins)]
+    df = pd.DataFrame({'#': np.arange(1, n_proteins + 1),
+                       'Visible?': 'True', 'Starred?': 'False',
+                       'Identified Proteins': [f'Protein {i}' for i in range(n_proteins)],
+                       'Accession Number': [f'{i}.1' for i in ids],
+                       'Alternate ID': ids,
+                       'Molecular Weight': rng.integers(10, 200, n_proteins).astype(str)})
+    base = rng.normal(size=(n_proteins, 1))
+    for sample in SAMPLES:
+        values = (base + rng.normal(size=(n_proteins, 1))).ravel()
+        df[sample] = values.astype(str)
+        df[f'Std Dev({sample})'] = rng.random(n_proteins)
+    df.loc[3, '40B'] = 'No data'
+    df['base_accession_num'] = ids
+    return df
+
+
+def test_intensity_matrix_only_uses_sample_columns():
+    df = normalized_intensity_export()
+    matrix = intensity_matrix(df)
+
+    assert list(matrix.columns) == SAMPLES
+    assert np.isnan(matrix.iloc[3]['40B'])
+    with pytest.raises(ValueError):
+        intensity_matrix(df[['base_accession_num', '#', 'Molecular Weight']])
+
+
+def distinct_pair_q(r_p, proteins, panel):
+    """
+    BH over each distinct pair once, computed directly.
+    """
+    pairs = {}
+    for i, a in enumerate(proteins):
+        for j, b in enumerate(panel):
+            if a != b:
+                pairs.setdefault(frozenset((a, b)), r_p[i, j])
+    keys = list(pairs)
+    q = dict(zip(keys, bh_fdr(np.array([pairs[k] for k in keys]))))
+    return np.array([[np.nan if a == b else q[frozenset((a, b))] for b in panel]
+                     for a in proteins])
+
+
+@pytest.mark.parametrize('panel', [None, ['AT1G00002', 'AT1G00005', 'AT1G00030',
+                                          'AT1G00005', 'missing']])
+def test_fdr_counts_each_pair_once(tmp_path, panel):
+    matrix = intensity_matrix(normalized_intensity_export())
+    index = build_coabundance_index(matrix, tmp_path, panel=panel, block_size=7,
+                                    top_k=5, n_jobs=1, max_fdr_values=50)
+
+    proteins, columns = list(index['proteins']), list(index['panel'])
+    assert len(columns) == (len(proteins) if panel is None else 3)
+    p = np.asarray(index['p'])
+    np.testing.assert_allclose(np.asarray(index['q']), distinct_pair_q(p, proteins, columns))
@@ -0,0 +1,110 @@
+"""
+Tests for parsing the proteomics software exports.
+
+Author: Serena G. Lotreck
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import proteomics_exports
+from proteomics_exports import (find_header_row, coerce_numeric, parse_proteomics_export,
+                                read_proteomics_export, export_columns)
+
+EXPORT = (
+    'Experiment: O2 time course,,,,\n'
+    '"Notes: compared with the Accession Number, Fold Change\n'
+    'and p-value columns",,,,\n'
+    'Display options:,Accession Number only,,,\n'
+    ',,,,\n'
+    '#,Identified Proteins,Accession Number,"Log2 Fold Change by Category (40/21)",'
+    '"Permutation Test (p-value) Benjamini-Hochberg (p < 0.00290)",\n'
+    '1,Rubisco large subunit,ATCG00490.1,-1.25,< 0.0001,\n'
+    '2,Rubisco activase,AT2G39730.1,0.5,0.0123,\n'
+    '3,Unknown protein,AT1G01010.2,--,No data,\n'
+    '4,Chlorophyll a-b binding protein,AT1G29920.1,2.0,0.5,\n'
+    ',Filtered by the software,,,,\n'
+)
+
+
+@pytest.fixture
+def export_path(tmp_path):
+    path = tmp_path / 'O2_40_vs_21.csv'
+    path.write_text(EXPORT)
+    return str(path)
+
+
+def test_find_header_row(export_path, tmp_path):
+    # A quoted field spanning two lines counts as two, and a field that only
+    # mentions the marker isn't the header
+    assert find_header_row(export_path) == 5
+
+    no_table = tmp_path / 'no_table.csv'
+    no_table.write_text('Experiment: O2 time course\n' * 5)
+    with pytest.raises(ValueError, match='No line with a Accession Number column'):
+        find_header_row(str(no_table))
+    with pytest.raises(ValueError):
+        find_header_row(export_path, max_lines=3)
+
+
+def test_coerce_numeric():
+    df = pd.DataFrame({'pval': ['< 0.0001', '0.5', ' <1e-5 ', '--'],
+                       'lfc': ['1.5', '--', '-2', '0'],
+                       'name': ['a', '1', '< 0.1', 'b'],
+                       'count': [1, 2, 3, 4]})
+
+    coerced = coerce_numeric(df)
+
+    np.testing.assert_allclose(coerced['pval'], [0.00009, 0.5, 0.9e-5, np.nan])
+    assert coerced['pval_censored'].tolist() == [True, False, True, False]
+    np.testing.assert_allclose(coerced['lfc'], [1.5, np.nan, -2, 0])
+    assert 'lfc_censored' not in coerced
+    # Text columns and numeric columns are left alone
+    assert coerced['name'].tolist() == ['a', '1', '< 0.1', 'b']
+    assert coerced['count'].tolist() == [1, 2, 3, 4]
+    assert df['pval'].tolist()[0] == '< 0.0001'
+    np.testing.assert_allclose(coerce_numeric(df, censored_factor=1)['pval'][:1], [0.0001])
+
+
+def test_parse_proteomics_export(export_path):
+    export = parse_proteomics_export(export_path)
+
+    # The 'No data' row and the trailing note are dropped, as is the empty
+    # last column
+    assert export['Accession Number'].tolist() == ['ATCG00490.1', 'AT2G39730.1', 'AT1G29920.1']
+    assert export['base_accession_num'].tolist() == ['ATCG00490', 'AT2G39730', 'AT1G29920']
+    columns = export_columns(export)
+    assert columns == {'lfc_name': 'Log2 Fold Change by Category (40/21)',
+                       'pval_col_name': 'Permutation Test (p-value) Benjamini-Hochberg '
+                                        '(p < 0.00290)',
+                       'pval_cutoff': 0.0029}
+    np.testing.assert_allclose(export[columns['pval_col_name']], [0.00009, 0.0123, 0.5])
+    assert export[f"{columns['pval_col_name']}_censored"].tolist() == [True, False, False]
+    assert export['#'].tolist() == [1.0, 2.0, 4.0]
+
+    kept = parse_proteomics_export(export_path, drop_no_data=False, lower_accessions=True)
+    assert kept['base_accession_num'].tolist()[2] == 'at1g01010'
+    assert kept['Identified Proteins'].tolist()[2] == 'Unknown protein'
+
+
+def test_cache_is_keyed_on_content_and_options(export_path, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    first = read_proteomics_export(export_path, cache_dir=cache_dir)
+    parse = proteomics_exports.parse_proteomics_export
+    calls = []
+
+    def record(*args, **kwargs):
+        calls.append(kwargs)
+        return parse(*args, **kwargs)
+
+    monkeypatch.setattr(proteomics_exports, 'parse_proteomics_export', record)
+    cached = read_proteomics_export(export_path, cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(cached, first)
+    assert calls == []
+
+    read_proteomics_export(export_path, cache_dir=cache_dir, lower_accessions=True)
+    assert len(calls) == 1
+    with open(export_path, 'a') as f:
+        f.write('5,Extra protein,AT5G00010.1,1.0,0.01,\n')
+    changed = read_proteomics_export(export_path, cache_dir=cache_dir)
+    assert len(calls) == 2
+    assert changed['base_accession_num'].tolist()[-1] == 'AT5G00010'
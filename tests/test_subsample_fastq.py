@@ -0,0 +1,79 @@
+"""
+Tests for paired FASTQ subsampling.
+
+Author: Serena G. Lotreck
+"""
+import gzip
+import pandas as pd
+import pytest
+import subsample_fastq
+from subsample_fastq import subsample_pair
+
+
+def write_pair(tmp_path, n_reads, n_reads_2=None, name='sample'):
+    paths = []
+    for mate, n in [(1, n_reads), (2, n_reads if n_reads_2 is None else n_reads_2)]:
+        path = tmp_path / f'{name}_R{mate}_001.fastq.gz'
+        with gzip.open(path, 'wt') as f:
+            for i in range(n):
+                f.write(f'@read{i} {mate}:N:0:ACGT\nACGTACGT\n+\nFFFFFFFF\n')
+        paths.append(str(path))
+    return paths
+
+
+def read_ids(path):
+    with gzip.open(path, 'rt') as f:
+        return [line.split()[0] for i, line in enumerate(f) if i % 4 == 0]
+
+
+@pytest.mark.parametrize('kwargs, expected', [({'n_reads': 25}, 25),
+                                              ({'fraction': 0.3}, None)])
+def test_seeded_output_is_reproducible_and_paired(tmp_path, kwargs, expected):
+    fastq_1, fastq_2 = write_pair(tmp_path, 200)
+    outputs = []
+    for run in ('a', 'b'):
+        # Same file names, they're in the gzip header
+        (tmp_path / run).mkdir()
+        out_1, out_2 = str(tmp_path / run / '1.fastq.gz'), str(tmp_path / run / '2.fastq.gz')
+        n_kept, n_total = subsample_pair(fastq_1, fastq_2, out_1, out_2, seed='s', **kwargs)
+        assert n_total == 200
+        assert read_ids(out_1) == read_ids(out_2)
+        assert len(read_ids(out_1)) == n_kept
+        if expected is not None:
+            assert n_kept == expected
+        with open(out_1, 'rb') as f1, open(out_2, 'rb') as f2:
+            outputs.append((f1.read(), f2.read()))
+
+    assert outputs[0] == outputs[1]
+    ids = read_ids(str(tmp_path / 'a' / '1.fastq.gz'))
+    # Kept reads stay in input order
+    assert ids == sorted(ids, key=lambda i: int(i[5:]))
+    other_seed = str(tmp_path / 'c_1.fastq.gz')
+    subsample_pair(fastq_1, fastq_2, other_seed, str(tmp_path / 'c_2.fastq.gz'),
+                   seed='t', **kwargs)
+    assert read_ids(other_seed) != ids
+
+
+def test_invalid_arguments_and_inputs_raise(tmp_path):
+    fastq_1, fastq_2 = write_pair(tmp_path, 10, 9)
+    out = [str(tmp_path / 'out_1.fastq.gz'), str(tmp_path / 'out_2.fastq.gz')]
+    with pytest.raises(ValueError, match='exactly one'):
+        subsample_pair(fastq_1, fastq_2, *out)
+    with pytest.raises(ValueError, match='exactly one'):
+        subsample_pair(fastq_1, fastq_2, *out, fraction=0.5, n_reads=2)
+    with pytest.raises(ValueError, match='different numbers of reads'):
+        subsample_pair(fastq_1, fastq_2, *out, fraction=0.5)
+
+
+def test_refuses_to_overwrite_inputs(tmp_path):
+    fastq_1, fastq_2 = write_pair(tmp_path, 10)
+    sheet = tmp_path / 'samplesheet.csv'
+    pd.DataFrame({'sample': ['s1'], 'fastq_1': [fastq_1], 'fastq_2': [fastq_2],
+                  'strandedness': ['auto']}).to_csv(sheet, index=False)
+
+    with pytest.raises(ValueError, match='overwrite'):
+        subsample_fastq.main(str(sheet), str(tmp_path), n_reads=5, n_jobs=1)
+    with pytest.raises(ValueError, match='overwrite'):
+        subsample_pair(fastq_1, fastq_2, str(tmp_path / 'out.fastq.gz'),
+                       str(tmp_path / '.' / 'sample_R2_001.fastq.gz'), n_reads=5)
+    assert len(read_ids(fastq_1)) == len(read_ids(fastq_2)) == 10
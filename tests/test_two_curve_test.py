@@ -0,0 +1,108 @@
+"""
+Tests for the vectorized two-curve test.
+
+Author: Serena G. Lotreck
+"""
+from itertools import combinations
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import t, chi2
+from two_curve_test import two_curve_test
+
+
+def notebook_pval(curves, x, measurement, condition, cond_1, cond_2):
+    """
+    calculate_pval from the photosynthetic measurement notebook, for one
+    pair of conditions, before its division by the number of comparisons.
+    """
+    stats = [curves[curves[condition] == c].groupby(x)[measurement].agg(['count', 'mean', 'sem'])
+             for c in (cond_1, cond_2)]
+    comp_df = pd.merge(stats[0], stats[1], left_index=True, right_index=True,
+                       suffixes=('_1', '_2'))
+    difference = abs(comp_df['mean_1'] - comp_df['mean_2'])
+    se_difference = np.sqrt(comp_df['sem_1']**2 + comp_df['sem_2']**2)
+    t_value = difference/se_difference
+    dF = 2*comp_df[['count_1', 'count_2']].min(axis=1) - 2
+    prob = 2*(1 - t.cdf(abs(t_value), dF))
+    sum_chi2 = chi2.ppf(1 - prob, 1).sum()
+    return 1 - chi2.cdf(sum_chi2, len(comp_df))
+
+
+def toy_curves(seed=0, shift=0.3):
+    """
+    Three conditions measured at 6 time points with 4 replicates, one
+    shifted up, and a time point missing from one condition.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for cond, offset in [('21%', 0), ('2%', shift), ('40%', 0)]:
+        for time in range(6):
+            if cond == '40%' and time == 5:
+                continue
+            for _ in range(4):
+                rows.append({'time': time, 'O2': cond,
+                             'A': np.sin(time) + offset + rng.normal(scale=0.3),
+                             'gsw': time*0.1 + rng.normal(scale=0.05)})
+    return pd.DataFrame(rows)
+
+
+def test_matches_notebook():
+    curves = toy_curves()
+
+    results = two_curve_test(curves, 'time', ['A', 'gsw'], 'O2')
+
+    assert len(results) == 6
+    for (measurement, cond_1, cond_2), row in results.set_index(
+            ['measurement', 'condition_1', 'condition_2']).iterrows():
+        expected = notebook_pval(curves, 'time', measurement, 'O2', cond_1, cond_2)
+        assert row['pval'] == pytest.approx(expected, rel=1e-6)
+        assert row['chi2_df'] == (5 if '40%' in (cond_1, cond_2) else 6)
+        assert row['pval_bonferroni'] == pytest.approx(min(3*row['pval'], 1))
+    pairs = set(zip(results['condition_1'], results['condition_2']))
+    assert pairs == set(combinations(sorted(curves['O2'].unique()), 2))
+
+
+def test_windows_and_pairs():
+    curves = toy_curves()
+
+    results = two_curve_test(curves, 'time', 'A', 'O2', windows={'early': (None, 3),
+                                                                 'late': (3, None)},
+                             pairs=[('21%', '2%')])
+
+    assert results['window'].tolist() == ['early', 'late']
+    for window, (start, stop) in [('early', (0, 3)), ('late', (3, 6))]:
+        subset = curves[(curves['time'] >= start) & (curves['time'] < stop)]
+        row = results[results['window'] == window].iloc[0]
+        assert row['chi2_df'] == 3
+        assert row['pval'] == pytest.approx(
+            notebook_pval(subset, 'time', 'A', 'O2', '21%', '2%'), rel=1e-6)
+        # One pair, so nothing to correct
+        assert row['pval_bonferroni'] == row['pval']
+
+
+@pytest.mark.parametrize('method', ['permutation', 'bootstrap'])
+def test_resampled_pvalues(method):
+    curves = toy_curves(shift=2)
+    n_resamples = 199
+
+    results = two_curve_test(curves, 'time', 'A', 'O2', n_resamples=n_resamples,
+                             method=method, n_jobs=2, seed=1, batch_size=50)
+
+    again = two_curve_test(curves, 'time', 'A', 'O2', n_resamples=n_resamples,
+                           method=method, n_jobs=2, seed=1, batch_size=50)
+    pd.testing.assert_frame_equal(results, again)
+    resampled = results.set_index(['condition_1', 'condition_2'])['pval_resampled']
+    assert resampled.between(1/(n_resamples + 1), 1).all()
+    # The shifted condition is always more different than any resample, the
+    # other two are the same curve
+    assert resampled[('2%', '21%')] == 1/(n_resamples + 1)
+    assert resampled[('2%', '40%')] == 1/(n_resamples + 1)
+    assert resampled[('21%', '40%')] > 0.05
+    np.testing.assert_allclose(results['pval_resampled_bonferroni'],
+                               np.minimum(3*results['pval_resampled'], 1))
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError, match='method'):
+        two_curve_test(toy_curves(), 'time', 'A', 'O2', method='jackknife')
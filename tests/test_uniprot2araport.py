@@ -0,0 +1,162 @@
+"""
+Tests for the concurrent ID mapping client against the local UniProt
+stand-in in benchmarks/mock_services.py.
+
+Author: Serena G. Lotreck
+"""
+import io
+import asyncio
+from xml.etree import ElementTree
+import pytest
+import uniprot2araport
+from mock_services import mock_services
+
+
+@pytest.fixture(scope='module')
+def uniprot_url():
+    with mock_services(uniprot={'polls': 2, 'failed_fraction': 0.05,
+                                'page_size': 5000, 'max_page_size': 5000}) as urls:
+        yield urls['uniprot']
+
+
+@pytest.fixture
+def client(uniprot_url, monkeypatch):
+    monkeypatch.setattr(uniprot2araport, 'API_URL', uniprot_url)
+    return uniprot2araport
+
+
+def ids(n, prefix='P'):
+    return [f'{prefix}{i:06d}' for i in range(n)]
+
+
+def test_chunks_above_id_mapping_limit(client, monkeypatch):
+    submitted = []
+    submit = client.submit_id_mapping
+
+    def record(from_db, to_db, chunk):
+        submitted.append(len(chunk))
+        return submit(from_db, to_db, chunk)
+
+    monkeypatch.setattr(client, 'submit_id_mapping', record)
+    query = ids(client.ID_MAPPING_LIMIT + 1)
+    table = client.map_ids(query + query[:10], 'UniProtKB_AC-ID', 'Araport')
+
+    assert sorted(submitted) == [1, client.ID_MAPPING_LIMIT]
+    assert len(table) == len(query)
+    assert set(table['from']) == set(query)
+
+
+def test_polling_backs_off_until_finished(client, monkeypatch):
+    intervals = []
+    sleep = asyncio.sleep
+
+    async def record(delay):
+        intervals.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(client.asyncio, 'sleep', record)
+    job_id = client.submit_id_mapping('UniProtKB_AC-ID', 'Araport', ids(10))
+    finished = asyncio.run(client.wait_for_id_mapping_async(
+        job_id, min_interval=0.25, max_interval=0.5, backoff=1.5))
+
+    # The stand-in reports RUNNING for two polls
+    assert finished
+    assert intervals == [0.25, 0.375]
+
+
+def test_merges_results_and_failed_ids_across_jobs(client):
+    id_sets = {'plastid': ids(2500, 'P'), 'peroxisome': ids(1200, 'Q')}
+    table = client.map_ids(id_sets, 'UniProtKB_AC-ID', 'Araport',
+                           max_concurrent_jobs=3, chunk_size=1000)
+
+    assert list(table.columns) == ['id_set', 'from', 'to', 'failed']
+    for name, query in id_sets.items():
+        rows = table[table['id_set'] == name]
+        assert len(rows) == len(query)
+        assert set(rows['from']) == set(query)
+    failed = table[table['failed']]
+    mapped = table[~table['failed']]
+    assert len(failed) > 0
+    assert failed['to'].isna().all()
+    assert (mapped['to'] == 'AT' + mapped['from']).all()
+
+
+@pytest.mark.parametrize('chunk_size, compressed', [(7, 'false'), (7, 'true'), (2**16, 'true')])
+def test_streams_json_results_in_small_chunks(client, chunk_size, compressed):
+    query = ids(3000)
+    job_id = client.submit_id_mapping('UniProtKB_AC-ID', 'Araport', query)
+    url = f'{client.get_id_mapping_results_link(job_id)}?format=json&compressed={compressed}'
+    rows = list(client.iter_id_mapping_results_stream(url, chunk_size=chunk_size))
+
+    mapped = [r for r in rows if not r.get('failed')]
+    failed = [r['from'] for r in rows if r.get('failed')]
+    assert len(failed) > 0
+    assert sorted(failed + [r['from'] for r in mapped]) == query
+    assert all(r['to'] == 'AT' + r['from'] for r in mapped)
+
+
+def test_stream_writer_fails_on_fields_missing_from_first_chunk(client, monkeypatch, tmp_path):
+    rows = [{'from': 'P1', 'to': 'AT1'}, {'from': 'P2', 'to': 'AT2', 'score': 1}]
+    monkeypatch.setattr(client, 'iter_id_mapping_results_stream',
+                        lambda url, chunk_size: iter(rows))
+
+    with pytest.raises(ValueError, match='score'):
+        client.write_id_mapping_results_stream('url', str(tmp_path / 'out.parquet'),
+                                               chunk_rows=1)
+    n_rows = client.write_id_mapping_results_stream('url', str(tmp_path / 'out.tsv'),
+                                                    chunk_rows=2)
+    assert n_rows == 2
+
+
+def test_paged_results_match_get_batch(client):
+    query = ids(1200)
+    job_id = client.submit_id_mapping('UniProtKB_AC-ID', 'Araport', query)
+    url = f'{client.get_id_mapping_results_link(job_id)}?format=json&size=500'
+    results = client.get_id_mapping_results_search(url)
+
+    first = client.session.get(url)
+    pages = [client.decode_results(first, 'json', False)]
+    pages += list(client.get_batch(first, 'json', False))
+    assert [len(p['results']) for p in pages] == [500, 500, len(results['results']) - 1000]
+    assert [r for p in pages for r in p['results']] == results['results']
+    assert sorted(results['failedIds'] + [r['from'] for r in results['results']]) == query
+
+
+def xml_page(accessions):
+    entries = ''.join(
+        f'<entry dataset="Swiss-Prot" created="2000-01-01"><accession>{a}</accession>'
+        f'<name>{a}_ARATH</name><sequence length="3">M&amp;K</sequence></entry>'
+        for a in accessions)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<uniprot xmlns="http://uniprot.org/uniprot" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'xsi:schemaLocation="http://uniprot.org/uniprot '
+            'http://www.uniprot.org/support/docs/uniprot.xsd">'
+            f'{entries}<copyright>Copyrighted by the UniProt Consortium</copyright>'
+            '</uniprot>')
+
+
+@pytest.mark.parametrize('as_bytes', [False, True])
+def test_stream_merge_matches_in_memory_merge(tmp_path, as_bytes):
+    pages = [xml_page(ids(3)), xml_page(ids(2, 'Q')), xml_page([]), xml_page(ids(1, 'R'))]
+    expected = uniprot2araport.merge_xml_results(pages)
+
+    path = str(tmp_path / 'merged.xml')
+    stream_pages = [p.encode('utf-8') for p in pages] if as_bytes else pages
+    n_entries = uniprot2araport.merge_xml_results_stream(iter(stream_pages), path)
+    buffer = io.BytesIO()
+    uniprot2araport.merge_xml_results_stream(iter(stream_pages), buffer)
+
+    assert n_entries == 6
+    with open(path, 'rb') as f:
+        written = f.read()
+    assert written == buffer.getvalue()
+    assert (ElementTree.canonicalize(written.decode('utf-8'))
+            == ElementTree.canonicalize(expected.decode('utf-8')))
+    root = ElementTree.fromstring(written)
+    ns = '{http://uniprot.org/uniprot}'
+    assert ([e.findtext(f'{ns}accession') for e in root.findall(f'{ns}entry')]
+            == ids(3) + ids(2, 'Q') + ids(1, 'R'))
+    # The copyright comes once, after the entries
+    assert root[-1].tag == f'{ns}copyright'
+    assert len(root.findall(f'{ns}copyright')) == 1
@@ -3,71 +3,337 @@ Function sfor making and processing calls to the PANTHER API GO tools.
 
 Author: Serena G. Lotreck
 """
+import os
+import time
+import json
+import hashlib
+from os.path import abspath, join, getmtime
+from urllib.parse import urlparse, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter, Retry
 import pandas as pd
 import numpy as np
 
 
-def getPANTHER(query, checkPageInfo=True):
+def makePANTHERsession(max_workers=8, total_retries=5, backoff_factor=0.5):
+    """
+    Make a requests session with a connection pool big enough for
+    max_workers concurrent queries, that retries on server errors and rate
+    limiting with exponential backoff.
+
+    parameters:
+        max_workers, int: number of connections to keep in the pool
+        total_retries, int: number of times to retry a failed request
+        backoff_factor, float: base for the exponential backoff between
+            retries, in seconds
+
+    returns:
+        session, requests.Session: pooled, retrying session
+    """
+    retries = Retry(total=total_retries, backoff_factor=backoff_factor,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=max_workers,
+                          pool_maxsize=max_workers, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def normalizePANTHERquery(query):
+    """
+    Normalize a query URL so that queries that ask for the same thing map to
+    the same cache key, regardless of parameter order or whitespace.
+
+    parameters:
+        query, str: PANTHER API query URL
+
+    returns:
+        normalized, str: normalized query URL
+    """
+    parsed = urlparse(query.strip())
+    params = sorted((k, v.strip()) for k, v in parse_qsl(parsed.query,
+                                                         keep_blank_values=True))
+    parsed = parsed._replace(scheme=parsed.scheme.lower(),
+                             netloc=parsed.netloc.lower(),
+                             query=urlencode(params), fragment='')
+    return parsed.geturl()
+
+
+def _cache_path(cache_dir, query):
+    """
+    Get the path of the cache file for a query.
+    """
+    key = hashlib.sha256(normalizePANTHERquery(query).encode('utf-8')).hexdigest()
+    return join(cache_dir, f'{key}.json')
+
+
+def _read_cache(cache_dir, query, ttl):
+    """
+    Return the cached results for a query, or None if there is no cache
+    entry or it is older than ttl seconds.
+    """
+    path = _cache_path(cache_dir, query)
+    try:
+        if ttl is not None and time.time() - getmtime(path) > ttl:
+            os.remove(path)
+            return None
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Touch the access time so size eviction drops least recently used first
+    os.utime(path, (time.time(), getmtime(path)))
+    return cached['results']
+
+
+def _write_cache(cache_dir, query, results):
+    """
+    Write results for a query to the cache. Written to a temporary file first
+    so that concurrent readers never see a partial entry.
+    """
+    path = _cache_path(cache_dir, query)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'query': normalizePANTHERquery(query), 'results': results}, f)
+    os.replace(tmp_path, path)
+
+
+def evictPANTHERcache(cache_dir, ttl=None, max_size=None):
+    """
+    Remove expired cache entries, then remove least recently used entries
+    until the cache is no bigger than max_size.
+
+    parameters:
+        cache_dir, str: path to the cache directory
+        ttl, float: maximum age of an entry in seconds, None to keep all
+        max_size, int: maximum total size of the cache in bytes, None for no
+            limit
+
+    returns:
+        n_removed, int: number of entries removed
+    """
+    cache_dir = abspath(cache_dir)
+    if not os.path.isdir(cache_dir):
+        return 0
+    now = time.time()
+    entries = []
+    n_removed = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.json'):
+            continue
+        stat = entry.stat()
+        if ttl is not None and now - stat.st_mtime > ttl:
+            os.remove(entry.path)
+            n_removed += 1
+        else:
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+    if max_size is not None:
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            os.remove(path)
+            total -= size
+            n_removed += 1
+    return n_removed
+
+
+def getPANTHER(query, checkPageInfo=True, session=None, cache_dir=None,
+               cache_ttl=None):
     """
     Get GO terms from a mmultiple-page search result.
+
+    parameters:
+        query, str: PANTHER API query URL
+        checkPageInfo, bool: unused, kept for backwards compatibility
+        session, requests.Session: optional session to make the request
+            with, a bare request is made if not provided
+        cache_dir, str: optional, directory of cached responses. If the query
+            has been cached, no request is made
+        cache_ttl, float: maximum age of a cached response in seconds, None
+            for no expiry
+
+    returns:
+        overall_jsons, list or dict: the 'results' from the response
     """
+    if cache_dir is not None:
+        cached = _read_cache(cache_dir, query, cache_ttl)
+        if cached is not None:
+            return cached
     # Check number of pages
-    r = requests.get(query, headers={ "Accept" : "application/json"})
-    if not r.ok:
-      r.raise_for_status()
-      sys.exit()
+    getter = requests if session is None else session
+    r = getter.get(query, headers={ "Accept" : "application/json"})
+    r.raise_for_status()
     responseBody = r.json()
     overall_jsons = responseBody['results']
+    if cache_dir is not None:
+        _write_cache(cache_dir, query, overall_jsons)
 
     return overall_jsons
 
-def processGOenrichments(enrichments, data, conditions_semantic):
+
+def getPANTHERbatch(queries, max_workers=8, cache_dir=None, cache_ttl=None,
+                    max_cache_size=None, session=None):
+    """
+    Run many PANTHER queries concurrently over one pooled, retrying session,
+    with an optional persistent on-disk cache so that re-running only
+    requests queries that haven't been seen.
+
+    parameters:
+        queries, dict or list: if a dict, keys are names (e.g. comparison
+            groups) and values are query URLs, or dicts of aspect name to
+            query URL, so that the output can be passed straight to
+            processGOenrichments; if a list, the query URLs
+        max_workers, int: maximum number of requests in flight at once
+        cache_dir, str: optional, directory to cache responses in. Created if
+            it doesn't exist
+        cache_ttl, float: maximum age of a cached response in seconds, None
+            for no expiry
+        max_cache_size, int: maximum size of the cache in bytes, least
+            recently used entries are evicted after the batch. None for no
+            limit
+        session, requests.Session: optional session to use, one is made with
+            makePANTHERsession if not provided
+
+    returns:
+        results, dict or list: results for each query, in the same structure
+            as queries
+    """
+    if isinstance(queries, dict):
+        names, urls = [], []
+        for name, query in queries.items():
+            if isinstance(query, dict):
+                for aspect, url in query.items():
+                    names.append((name, aspect))
+                    urls.append(url)
+            else:
+                names.append((name,))
+                urls.append(query)
+    else:
+        names, urls = None, list(queries)
+    if cache_dir is not None:
+        cache_dir = abspath(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+    if session is None:
+        session = makePANTHERsession(max_workers)
+
+    # Only make one request for queries that are duplicates once normalized
+    unique = {}
+    for url in urls:
+        unique.setdefault(normalizePANTHERquery(url), url)
+
+    def fetch(url):
+        return getPANTHER(url, session=session, cache_dir=cache_dir,
+                          cache_ttl=cache_ttl)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fetched = dict(zip(unique.keys(), executor.map(fetch, unique.values())))
+    if cache_dir is not None and (cache_ttl is not None or max_cache_size is not None):
+        evictPANTHERcache(cache_dir, ttl=cache_ttl, max_size=max_cache_size)
+
+    results = [fetched[normalizePANTHERquery(url)] for url in urls]
+    if names is None:
+        return results
+    nested = {}
+    for name, result in zip(names, results):
+        if len(name) == 1:
+            nested[name[0]] = result
+        else:
+            nested.setdefault(name[0], {})[name[1]] = result
+    return nested
+
+
+def flattenGOenrichments(enrichments):
+    """
+    Flatten the nested PANTHER enrichment results into one row per term in a
+    single bulk pass.
+
+    parameters:
+        enrichments, dict: keys are comparison groups, values are dicts where
+            keys are GO aspects and values are the PANTHER results for that
+            group and aspect
+
+    returns:
+        flat, df: columns group, aspect, term, GOid, p_value_fdr,
+            associated_gene_IDs and plus_minus, for all terms regardless of
+            FDR
+    """
+    # Collect the term dicts and their keys without touching the terms
+    term_lists = [(group, aspect, res[aspect]['result'])
+                  for group, res in enrichments.items() for aspect in res]
+    lengths = [len(terms) for _, _, terms in term_lists]
+    all_terms = [t for _, _, terms in term_lists for t in terms]
+
+    flat = pd.json_normalize(all_terms, max_level=1)
+    flat = flat.reindex(columns=['term.label', 'term.id', 'fdr',
+                                 'input_list.mapped_ids'])
+    flat.columns = ['term', 'GOid', 'p_value_fdr', 'associated_gene_IDs']
+    flat.insert(0, 'group', np.repeat([g for g, _, _ in term_lists], lengths))
+    flat.insert(1, 'aspect', np.repeat([a for _, a, _ in term_lists], lengths))
+    flat['p_value_fdr'] = flat['p_value_fdr'].astype(float)
+    flat['plus_minus'] = np.where(flat['associated_gene_IDs'].notna(), '+', '-')
+
+    return flat
+
+
+def explodeGOgenes(go_results):
+    """
+    Make a long-form table with one row per group, GO term and associated
+    gene, so that downstream code doesn't need to re-parse the
+    associated_gene_IDs lists.
+
+    parameters:
+        go_results, df: output of processGOenrichments
+
+    returns:
+        gene_go, df: columns group, aspect, GOid, term and gene_id
+    """
+    gene_go = go_results.reset_index()[['group', 'aspect', 'GOid', 'term',
+                                        'associated_gene_IDs']]
+    gene_go = gene_go.explode('associated_gene_IDs', ignore_index=True)
+    gene_go = gene_go.dropna(subset='associated_gene_IDs')
+    gene_go = gene_go.rename(columns={'associated_gene_IDs': 'gene_id'})
+
+    return gene_go.reset_index(drop=True)
+
+
+def processGOenrichments(enrichments, data, conditions_semantic,
+                         fdr_threshold=0.05, long_form=False):
     """
     Make a summary dataframe with GO terms from each aspect that are enriched
     in each group, and print a summary of the numbers.
+
+    parameters:
+        enrichments, dict: keys are comparison groups, values are dicts where
+            keys are GO aspects and values are the PANTHER results for that
+            group and aspect
+        data, dict: keys are comparison groups, values are the genes in
+            that comparison
+        conditions_semantic, dict: keys are comparison groups, values are
+            semantic names to use in the summary
+        fdr_threshold, float: terms with an FDR below this are kept
+        long_form, bool: whether or not to also return the exploded
+            (group, GO id, gene) table from explodeGOgenes
+
+    returns:
+        go_results, df: enriched terms indexed by group and aspect
+        gene_go, df: only returned if long_form is True
     """
-    processed_go = {
-        'group': [],
-        'aspect': [],
-        'term': [],
-        'GOid': [],
-        'p_value_fdr': [],
-        'associated_gene_IDs': [],
-        'plus_minus': []
-    }
-    for group, res in enrichments.items():
-        for aspect in res:
-            for termDict in res[aspect]['result']:
-                if termDict['fdr'] < 0.05:
-                    processed_go['group'].append(group)
-                    processed_go['aspect'].append(aspect)
-                    processed_go['term'].append(termDict['term']['label'])
-                    try:
-                        processed_go['GOid'].append(termDict['term']['id'])
-                    except KeyError:
-                        processed_go['GOid'].append(np.nan)
-                    processed_go['p_value_fdr'].append(termDict['fdr'])
-                    try:
-                        processed_go['associated_gene_IDs'].append(termDict['input_list']['mapped_ids'])
-                        processed_go['plus_minus'].append('+')
-                    except KeyError:
-                        processed_go['associated_gene_IDs'].append(np.nan)
-                        processed_go['plus_minus'].append('-')
-                        
-
-    go_results = pd.DataFrame(processed_go)
+    go_results = flattenGOenrichments(enrichments)
+    go_results = go_results[go_results['p_value_fdr'] < fdr_threshold]
     go_results = go_results.set_index(['group', 'aspect']).sort_index()
 
+    # Count all groups and aspects at once
+    counts = go_results.groupby(level=['group', 'aspect']).size().to_dict()
     for group in data:
         print(f'\nFor comparison group {conditions_semantic[group]}, there are...')
         for aspect in ['biological_process', 'molecular_function', 'cellular_component']:
-            try:
-                print(f'{len(go_results.loc[(group, aspect)])} {aspect} GO terms')
-            except KeyError:
-                print(f'0 {aspect} GO terms')
+            print(f'{counts.get((group, aspect), 0)} {aspect} GO terms')
         print(f'... enriched, for a total of {len(data[group])} genes in the comparison.\n')
 
+    if long_form:
+        return go_results, explodeGOgenes(go_results)
     return go_results
-
-
@@ -0,0 +1,232 @@
+"""
+Compare the DEG sets of many comparisons at once. Each comparison's
+significant, up- and down-regulated genes are stored as packed bitsets over
+one shared gene index, so sign concordance between every pair of
+comparisons and all UpSet intersection counts are a few array operations.
+
+Author: Serena G. Lotreck
+"""
+import pandas as pd
+import numpy as np
+
+
+# Number of set bits in every byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed, axis=-1):
+    """
+    Number of set bits along an axis of a packed bitset array.
+    """
+    return _POPCOUNT[packed].sum(axis=axis, dtype=np.int64)
+
+
+def build_comparison_bitsets(deg_dfs, id_col='gene_id', lfc_col='log2FoldChange',
+                             padj_col=None, alpha=0.05):
+    """
+    Encode the DEGs of every comparison as bitsets over the union of their
+    genes.
+
+    parameters:
+        deg_dfs, dict: keys are comparison names, values are dfs of DEGs
+            with id_col and lfc_col (e.g. from deseq2_store.comparison_frames)
+        id_col, str: name of the column with the gene IDs
+        lfc_col, str: name of the column with the log2 fold changes
+        padj_col, str: optional, if given only genes with padj_col < alpha
+            count as significant, otherwise every gene in a df does
+        alpha, float: significance threshold for padj_col
+
+    returns:
+        bitsets, dict: with keys
+            genes, Index: shared gene index
+            comparisons, list of str: comparison names
+            sig, up, down, arrays: comparisons x packed genes (uint8) bits
+            lfc, array: genes x comparisons log2 fold changes, NaN where the
+                gene isn't in the comparison
+    """
+    comparisons = list(deg_dfs.keys())
+    genes = pd.Index(pd.unique(np.concatenate(
+        [df[id_col].astype(str).to_numpy() for df in deg_dfs.values()]))).sort_values()
+    lfc = np.full((len(genes), len(comparisons)), np.nan)
+    sig = np.zeros((len(comparisons), len(genes)), dtype=bool)
+    for j, df in enumerate(deg_dfs.values()):
+        df = df.drop_duplicates(id_col)
+        rows = genes.get_indexer(df[id_col].astype(str))
+        lfc[rows, j] = df[lfc_col].to_numpy(dtype=float)
+        sig[j, rows] = True if padj_col is None else (df[padj_col] < alpha).to_numpy()
+    return _pack(genes, comparisons, sig, lfc)
+
+
+def _pack(genes, comparisons, sig, lfc):
+    """
+    Pack boolean comparisons x genes significance and the matching log2
+    fold changes into a bitsets dict.
+    """
+    with np.errstate(invalid='ignore'):
+        up = sig & (lfc.T > 0)
+        down = sig & (lfc.T < 0)
+    return {'genes': genes, 'comparisons': list(comparisons), 'lfc': lfc,
+            'sig': np.packbits(sig, axis=1), 'up': np.packbits(up, axis=1),
+            'down': np.packbits(down, axis=1)}
+
+
+def _rows(bitsets, comparisons):
+    """
+    Row positions of comparisons in the bitsets.
+    """
+    if comparisons is None:
+        return list(range(len(bitsets['comparisons'])))
+    return [bitsets['comparisons'].index(c) for c in comparisons]
+
+
+def _unpack(bitsets, kind, rows):
+    """
+    Boolean comparisons x genes matrix for some rows of a bitset.
+    """
+    return np.unpackbits(bitsets[kind][rows], axis=1,
+                         count=len(bitsets['genes'])).astype(bool)
+
+
+def genes_in(bitsets, comparison, kind='sig'):
+    """
+    Genes set in one comparison's bitset.
+
+    parameters:
+        bitsets, dict: output of build_comparison_bitsets
+        comparison, str: comparison name
+        kind, str: 'sig', 'up' or 'down'
+
+    returns:
+        genes, list of str
+    """
+    row = _rows(bitsets, [comparison])
+    return bitsets['genes'][_unpack(bitsets, kind, row)[0]].tolist()
+
+
+def pair_counts(bitsets, comparisons=None):
+    """
+    For every pair of comparisons, how many significant genes they share,
+    and how many of those change in the same and in opposite directions.
+
+    parameters:
+        bitsets, dict: output of build_comparison_bitsets
+        comparisons, list of str: optional, comparisons to include, default
+            is all
+
+    returns:
+        counts, dict: keys shared, concordant and opposite, values are
+            comparisons x comparisons dfs of gene counts
+    """
+    rows = _rows(bitsets, comparisons)
+    names = [bitsets['comparisons'][r] for r in rows]
+    sig, up, down = (bitsets[k][rows] for k in ('sig', 'up', 'down'))
+    # Comparisons x comparisons x packed genes
+    shared = sig[:, None] & sig[None, :]
+    concordant = (up[:, None] & up[None, :]) | (down[:, None] & down[None, :])
+    opposite = (up[:, None] & down[None, :]) | (down[:, None] & up[None, :])
+    return {k: pd.DataFrame(popcount(v), index=names, columns=names)
+            for k, v in [('shared', shared), ('concordant', concordant),
+                         ('opposite', opposite)]}
+
+
+def filter_concordant(bitsets, comparisons, reference, suffix='_filtered'):
+    """
+    Drop the genes from each comparison that change in the same direction
+    in a reference comparison (e.g. remove time effects also seen at 21%
+    oxygen), adding the filtered sets as new comparisons.
+
+    parameters:
+        bitsets, dict: output of build_comparison_bitsets
+        comparisons, list of str: comparisons to filter
+        reference, str: comparison to filter by
+        suffix, str: added to the names of the filtered comparisons
+
+    returns:
+        bitsets, dict: copy with the filtered comparisons appended
+    """
+    rows = _rows(bitsets, comparisons)
+    ref = _rows(bitsets, [reference])
+    same_sign = ((bitsets['up'][rows] & bitsets['up'][ref]) |
+                 (bitsets['down'][rows] & bitsets['down'][ref]))
+    keep = bitsets['sig'][rows] & ~same_sign
+    sig = np.vstack([_unpack(bitsets, 'sig', slice(None)),
+                     np.unpackbits(keep, axis=1, count=len(bitsets['genes'])).astype(bool)])
+    lfc = np.hstack([bitsets['lfc'], np.where(sig[len(bitsets['comparisons']):].T,
+                                              bitsets['lfc'][:, rows], np.nan)])
+    names = bitsets['comparisons'] + [c + suffix for c in comparisons]
+    return _pack(bitsets['genes'], names, sig, lfc)
+
+
+def comparison_frame(bitsets, comparison, id_col='gene_id', lfc_col='log2FoldChange'):
+    """
+    The significant genes of one comparison with their log2 fold changes,
+    e.g. for a filtered comparison.
+    """
+    row = _rows(bitsets, [comparison])[0]
+    mask = _unpack(bitsets, 'sig', [row])[0]
+    return pd.DataFrame({id_col: bitsets['genes'][mask],
+                         lfc_col: bitsets['lfc'][mask, row]})
+
+
+def opposite_table(bitsets, comparisons, id_col='gene_id', lfc_col='log2FoldChange'):
+    """
+    Genes significant in both of two comparisons and changing in opposite
+    directions, with one log2 fold change column per comparison, in the
+    format plot_opposite_expression takes.
+
+    parameters:
+        bitsets, dict: output of build_comparison_bitsets
+        comparisons, dict: two comparison names as keys, values are suffixes
+            for the column names, e.g. {'1h_vs_7h_2o2_filtered': '2o2'}
+            gives log2FoldChange_2o2
+
+    returns:
+        opposites, df: id_col plus one column per comparison
+    """
+    (a, b) = _rows(bitsets, list(comparisons))
+    opposite = ((bitsets['up'][a] & bitsets['down'][b]) |
+                (bitsets['down'][a] & bitsets['up'][b]))
+    mask = np.unpackbits(opposite, count=len(bitsets['genes'])).astype(bool)
+    opposites = pd.DataFrame({id_col: bitsets['genes'][mask]})
+    for row, suffix in zip((a, b), comparisons.values()):
+        opposites[f'{lfc_col}_{suffix}'] = bitsets['lfc'][mask, row]
+    return opposites
+
+
+def upset_counts(bitsets, comparisons=None, kind='sig', names=None):
+    """
+    Number of genes in every exclusive intersection of the comparisons'
+    sets, from one pass over the genes. The output can be passed straight
+    to upsetplot.plot, like from_contents output.
+
+    parameters:
+        bitsets, dict: output of build_comparison_bitsets
+        comparisons, list of str: optional, comparisons to include, default
+            is all
+        kind, str: 'sig', 'up' or 'down'
+        names, dict: optional, keys are comparison names, values are names
+            to use as categories (e.g. semantic names)
+
+    returns:
+        counts, Series: indexed by a boolean MultiIndex with one level per
+            comparison, values are gene counts
+    """
+    rows = _rows(bitsets, comparisons)
+    members = _unpack(bitsets, kind, rows)
+    # Encode each gene's membership pattern as one integer
+    codes = np.zeros(members.shape[1], dtype=object if len(rows) > 62 else np.int64)
+    for i in range(len(rows)):
+        codes = codes*2 + members[i]
+    codes, counts = np.unique(codes[members.any(axis=0)], return_counts=True)
+    if codes.dtype == object:
+        patterns = [[bool((int(c) >> (len(rows) - 1 - i)) & 1) for c in codes]
+                    for i in range(len(rows))]
+    else:
+        shifts = np.arange(len(rows) - 1, -1, -1)[:, None]
+        patterns = list(((codes[None, :] >> shifts) & 1).astype(bool))
+    labels = [bitsets['comparisons'][r] for r in rows]
+    if names is not None:
+        labels = [names.get(l, l) for l in labels]
+    index = pd.MultiIndex.from_arrays(patterns, names=labels)
+    return pd.Series(counts, index=index, name='count').sort_index()
+
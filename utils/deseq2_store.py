@@ -0,0 +1,247 @@
+"""
+Store all DESeq2 outputs in one long-format Parquet file, so that subsets
+(e.g. one gene panel across all comparisons) can be read without loading
+every comparison.
+
+Comparison names follow the DESeq2 output file names:
+    <time 1>_vs_<time 2>_<oxygen>o2_... for time comparisons, e.g.
+        1h_vs_7h_21o2
+    <time>_o2_<oxygen 1>_<oxygen 2>_... for oxygen comparisons, e.g.
+        7h_o2_2_21
+
+Author: Serena G. Lotreck
+"""
+import json
+from os import listdir
+from os.path import abspath, getmtime, isfile, splitext
+import pandas as pd
+
+
+def parse_comparison_name(filename):
+    """
+    Parse a DESeq2 output file name.
+
+    parameters:
+        filename, str: name of the file
+
+    returns:
+        comparison, dict: with keys comparison (first four fields of the
+            name), comparison_type ('time', 'oxygen', or None if the name
+            doesn't follow either convention), time_1, time_2, oxygen_1 and
+            oxygen_2 (None where not applicable)
+    """
+    fields = splitext(filename)[0].split('_')
+    comparison = {'comparison': '_'.join(fields[:4]), 'comparison_type': None,
+                  'time_1': None, 'time_2': None, 'oxygen_1': None, 'oxygen_2': None}
+    if len(fields) < 4:
+        return comparison
+    if fields[1] == 'vs':
+        oxygen = fields[3][:-2] if fields[3].endswith('o2') else fields[3]
+        comparison.update({'comparison_type': 'time', 'time_1': fields[0],
+                           'time_2': fields[2], 'oxygen_1': oxygen, 'oxygen_2': oxygen})
+    elif fields[1] == 'o2':
+        comparison.update({'comparison_type': 'oxygen', 'time_1': fields[0],
+                           'time_2': fields[0], 'oxygen_1': fields[2],
+                           'oxygen_2': fields[3]})
+    return comparison
+
+
+def _sources(deseq2_dir):
+    """
+    DESeq2 output files in a directory, with their modification times.
+    """
+    names = sorted(f for f in listdir(deseq2_dir) if splitext(f)[1] == '.csv')
+    return [[f, getmtime(f'{deseq2_dir}/{f}')] for f in names]
+
+
+def build_deseq2_store(deseq2_dir, store_path):
+    """
+    Read every DESeq2 output in a directory into one long table and write it
+    to Parquet, one row group per comparison, sorted by gene_id within each
+    comparison. comparison, comparison_type and gene_id are stored as
+    categoricals. The parsed comparison names and source files are saved
+    with the store.
+
+    parameters:
+        deseq2_dir, str: directory with the DESeq2 output CSVs. Raises if
+            there are none, or two map to the same comparison
+        store_path, str: .parquet file to write
+
+    returns:
+        comparisons, df: one row per comparison, see parse_comparison_name
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    deseq2_dir = abspath(deseq2_dir)
+    sources = _sources(deseq2_dir)
+    comparisons = pd.DataFrame([dict(parse_comparison_name(f), file=f)
+                                for f, _ in sources])
+    if comparisons.empty:
+        raise ValueError(f'No DESeq2 output CSVs in {deseq2_dir}')
+    comparisons = comparisons[comparisons['comparison_type'].notna()].reset_index(drop=True)
+    if comparisons.empty:
+        raise ValueError(f'None of the CSVs in {deseq2_dir} are named like a time or '
+                         'oxygen comparison, e.g. 1h_vs_7h_21o2_... or 7h_o2_2_21_...')
+    duplicated = comparisons[comparisons['comparison'].duplicated(keep=False)]
+    if not duplicated.empty:
+        files = duplicated.groupby('comparison')['file'].agg(list).to_dict()
+        raise ValueError(f'More than one file for the same comparison: {files}')
+
+    # Read everything first so the categories are the same in every row
+    # group
+    frames = []
+    for comp, f in zip(comparisons['comparison'], comparisons['file']):
+        df = pd.read_csv(f'{deseq2_dir}/{f}')
+        if 'gene_id' not in df.columns:
+            df = df.rename(columns={df.columns[0]: 'gene_id'})
+        df.insert(0, 'comparison', comp)
+        frames.append(df.sort_values('gene_id', kind='stable'))
+    long_df = pd.concat(frames, ignore_index=True)
+    for col, categories in [('comparison', comparisons['comparison']),
+                            ('gene_id', sorted(long_df['gene_id'].astype(str).unique()))]:
+        long_df[col] = pd.Categorical(long_df[col].astype(str), categories=categories)
+    long_df.insert(1, 'comparison_type', pd.Categorical(
+        long_df['comparison'].map(comparisons.set_index('comparison')['comparison_type'])
+        .astype(str), categories=['time', 'oxygen']))
+
+    table = pa.Table.from_pandas(long_df, preserve_index=False)
+    metadata = {b'deseq2_sources': json.dumps(sources).encode(),
+                b'deseq2_comparisons': comparisons.to_json(orient='records').encode()}
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+    bounds = long_df['comparison'].cat.codes.searchsorted(range(len(comparisons) + 1))
+    with pq.ParquetWriter(abspath(store_path), table.schema) as writer:
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            writer.write_table(table.slice(start, stop - start))
+
+    return comparisons
+
+
+def store_comparisons(store_path):
+    """
+    The comparisons in a store, read from its metadata only.
+
+    returns:
+        comparisons, df: one row per comparison, see parse_comparison_name
+    """
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(abspath(store_path)).metadata
+    return pd.DataFrame(json.loads(metadata[b'deseq2_comparisons']))
+
+
+def open_deseq2_store(deseq2_dir, store_path):
+    """
+    Get the path to an up to date store, building it if it doesn't exist or
+    the DESeq2 outputs have changed since it was built.
+
+    returns:
+        store_path, str: absolute path to the store
+    """
+    import pyarrow.parquet as pq
+
+    store_path = abspath(store_path)
+    if isfile(store_path):
+        metadata = pq.read_schema(store_path).metadata
+        if json.loads(metadata[b'deseq2_sources']) == _sources(abspath(deseq2_dir)):
+            return store_path
+    build_deseq2_store(deseq2_dir, store_path)
+    return store_path
+
+
+def read_deseq2_store(store_path, columns=None, comparisons=None, genes=None,
+                      comparison_type=None, filters=None):
+    """
+    Read part of a store. Only the requested columns are read, and the
+    comparison, gene and comparison type conditions are pushed down to the
+    Parquet reader, so row groups that can't match are skipped.
+
+    parameters:
+        store_path, str: path to the store
+        columns, list of str: optional, columns to read besides comparison
+            and gene_id, default is all columns
+        comparisons, list of str: optional, comparisons to read
+        genes, list of str: optional, gene IDs to read. Matched as given and
+            upper-cased, since gene sets are often lower-cased
+        comparison_type, str: optional, 'time' or 'oxygen'
+        filters, list of tuples: optional, extra pyarrow filters, e.g.
+            [('padj', '<', 0.05)]
+
+    returns:
+        degs, df: long table with comparison and gene_id first
+    """
+    import pyarrow.parquet as pq
+
+    if columns is not None:
+        columns = ['comparison', 'gene_id'] + [c for c in columns
+                                               if c not in ('comparison', 'gene_id')]
+    conditions = list(filters or [])
+    if comparisons is not None:
+        conditions.append(('comparison', 'in', list(comparisons)))
+    if genes is not None:
+        genes = list(dict.fromkeys([str(g) for g in genes] + [str(g).upper() for g in genes]))
+        conditions.append(('gene_id', 'in', genes))
+    if comparison_type is not None:
+        conditions.append(('comparison_type', '==', comparison_type))
+    table = pq.read_table(abspath(store_path), columns=columns,
+                          filters=conditions or None)
+    degs = table.to_pandas()
+    # Keep only the categories that are left
+    for col in ['comparison', 'gene_id']:
+        if isinstance(degs[col].dtype, pd.CategoricalDtype):
+            degs[col] = degs[col].cat.remove_unused_categories()
+    return degs
+
+
+def comparison_frames(store_path, comparisons=None, genes=None, columns=None,
+                      filters=None):
+    """
+    One df per comparison, in the shape the DESeq2 CSVs were read into (e.g.
+    the deg_dfs argument of makeDEGfigure).
+
+    parameters:
+        see read_deseq2_store
+
+    returns:
+        deg_dfs, dict: keys are comparison names, values are dfs
+    """
+    degs = read_deseq2_store(store_path, columns=columns, comparisons=comparisons,
+                             genes=genes, filters=filters)
+    degs['gene_id'] = degs['gene_id'].astype(str)
+    frames = {comp: df.drop(columns=['comparison', 'comparison_type'], errors='ignore')
+              .reset_index(drop=True)
+              for comp, df in degs.groupby('comparison', observed=True, sort=False)}
+    order = comparisons if comparisons is not None else list(frames)
+    return {comp: frames[comp] for comp in order if comp in frames}
+
+
+def wide_log2fc(store_path, comparisons, genes=None, value='log2FoldChange',
+                how='inner'):
+    """
+    One row per gene and one value column per comparison, e.g. for
+    plot_opposite_expression.
+
+    parameters:
+        store_path, str: path to the store
+        comparisons, dict: keys are comparison names, values are suffixes
+            for the column names, e.g. {'1h_vs_7h_2o2': '2o2'} gives
+            log2FoldChange_2o2
+        genes, list of str: optional, gene IDs to read
+        value, str: column to spread
+        how, str: 'inner' to keep genes in all comparisons, 'outer' to keep
+            genes in any
+
+    returns:
+        wide, df: gene_id column plus one column per comparison
+    """
+    degs = read_deseq2_store(store_path, columns=[value], comparisons=list(comparisons),
+                             genes=genes)
+    degs['gene_id'] = degs['gene_id'].astype(str)
+    degs['comparison'] = degs['comparison'].astype(str)
+    wide = degs.pivot_table(index='gene_id', columns='comparison', values=value,
+                            aggfunc='first', sort=False)
+    wide = wide.reindex(columns=list(comparisons))
+    if how == 'inner':
+        wide = wide.dropna()
+    wide.columns = [f'{value}_{suffix}' for suffix in comparisons.values()]
+    return wide.rename_axis(None, axis=1).reset_index()
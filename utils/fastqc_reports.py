@@ -0,0 +1,228 @@
+"""
+Read FastQC reports straight from the fastqc_data.txt in each FastQC zip
+archive, instead of parsing the HTML reports. Every module is parsed into a
+tidy table with a sample column, so all samples can be compared at once.
+
+Author: Serena G. Lotreck
+"""
+import re
+import json
+import zipfile
+from os import listdir, makedirs
+from os.path import abspath, basename, getmtime, isdir, isfile
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+
+def module_table_name(module):
+    """
+    Snake case table name for a FastQC module, e.g. 'Per base sequence
+    quality' -> 'per_base_sequence_quality'.
+    """
+    return re.sub(r'[^0-9a-z]+', '_', module.lower()).strip('_')
+
+
+_RANGE = r'^\d+(?:\.\d+)?(?:-\d+(?:\.\d+)?)?$'
+
+
+def _typed(df):
+    """
+    Convert the columns that are entirely numbers to numeric dtypes. Columns
+    of numbers and ranges (e.g. Base, 10-14, or Sequence length, 35-151 for
+    trimmed reads) are kept as strings, with the parsed bounds added as
+    <column>_start and <column>_end. Base always gets its bounds.
+
+    Run on whole modules, after the samples are concatenated, so a column
+    gets the same type for every sample.
+    """
+    for col in [c for c in df.columns if c != 'sample']:
+        values = df[col].dropna().astype(str)
+        converted = pd.to_numeric(df[col], errors='coerce')
+        if converted.notna().sum() == len(values) and col != 'Base':
+            df[col] = converted
+        elif len(values) and values.str.match(_RANGE).all():
+            df[col] = df[col].astype('str').where(df[col].notna())
+            bounds = df[col].str.split('-', n=1, expand=True)
+            name = module_table_name(col)
+            df[f'{name}_start'] = pd.to_numeric(bounds[0])
+            df[f'{name}_end'] = pd.to_numeric(bounds[bounds.columns[-1]].fillna(bounds[0]))
+    return df
+
+
+def parse_fastqc_data(text, typed=True):
+    """
+    Parse the contents of a fastqc_data.txt file.
+
+    parameters:
+        text, str: file contents
+        typed, bool: whether or not to convert numeric columns, see _typed.
+            If False every value is a string
+
+    returns:
+        modules, dict: keys are module names, values are dicts with keys
+            status (pass, warn or fail), table (df of the module's rows,
+            numeric columns converted) and meta (dict of extra '#key value'
+            lines, e.g. Total Deduplicated Percentage)
+    """
+    modules = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith('>>END_MODULE'):
+            if current is not None:
+                name, status, header, rows, meta = current
+                table = pd.DataFrame(rows, columns=header) if header else pd.DataFrame(rows)
+                modules[name] = {'status': status, 'meta': meta,
+                                 'table': _typed(table) if typed else table}
+            current = None
+        elif line.startswith('>>'):
+            name, _, status = line[2:].partition('\t')
+            current = (name, status.strip(), None, [], {})
+        elif current is None or not line:
+            continue
+        elif line.startswith('#'):
+            fields = line[1:].split('\t')
+            # The last '#' line before the rows is the header, earlier ones
+            # are key/value pairs
+            if current[2] is not None:
+                current[4][current[2][0]] = current[2][1] if len(current[2]) > 1 else None
+            current = current[:2] + (fields,) + current[3:]
+        else:
+            current[3].append(line.split('\t'))
+    return modules
+
+
+def sample_name(path):
+    """
+    Sample name from a FastQC zip or output directory path.
+    """
+    name = basename(path.rstrip('/'))
+    for suffix in ['.zip', '_fastqc']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def read_fastqc_report(path, typed=True):
+    """
+    Read fastqc_data.txt from a FastQC zip archive or extracted output
+    directory, without extracting anything to disk.
+
+    parameters:
+        path, str: path to the _fastqc.zip file or _fastqc directory
+        typed, bool: see parse_fastqc_data
+
+    returns:
+        sample, str: sample name
+        modules, dict: see parse_fastqc_data
+    """
+    if isdir(path):
+        with open(f'{path}/fastqc_data.txt') as f:
+            text = f.read()
+    else:
+        with zipfile.ZipFile(path) as zf:
+            member = [n for n in zf.namelist() if n.endswith('fastqc_data.txt')][0]
+            text = zf.read(member).decode()
+    return sample_name(path), parse_fastqc_data(text, typed)
+
+
+def _report_tables(path):
+    """
+    Read one report and return its tidy rows as strings, for the process
+    pool. Typed after concatenating, see load_fastqc_reports.
+    """
+    sample, modules = read_fastqc_report(path, typed=False)
+    tables = {'module_status': pd.DataFrame({
+        'sample': sample, 'module': list(modules.keys()),
+        'status': [m['status'] for m in modules.values()]})}
+    for name, module in modules.items():
+        table = module['table']
+        if name == 'Basic Statistics':
+            # One row per sample, one column per measure
+            table = table.set_index(table.columns[0]).T.reset_index(drop=True)
+            table.columns.name = None
+        for key, value in module['meta'].items():
+            table[key] = value
+        table.insert(0, 'sample', sample)
+        tables[module_table_name(name)] = table
+    return tables
+
+
+def fastqc_report_paths(qc_dir):
+    """
+    FastQC zip archives in a directory, plus extracted output directories
+    that don't have a zip.
+    """
+    names = sorted(listdir(qc_dir))
+    zips = [f'{qc_dir}/{n}' for n in names if n.endswith('_fastqc.zip')]
+    have_zip = {sample_name(p) for p in zips}
+    dirs = [f'{qc_dir}/{n}' for n in names if n.endswith('_fastqc')
+            and isfile(f'{qc_dir}/{n}/fastqc_data.txt') and sample_name(n) not in have_zip]
+    return zips + dirs
+
+
+def load_fastqc_reports(qc_dir, n_jobs=None, cache_dir=None):
+    """
+    Parse all FastQC reports in a directory into one tidy table per module,
+    in parallel across samples.
+
+    parameters:
+        qc_dir, str: directory with FastQC output
+        n_jobs, int: number of processes, default is the number of cores
+        cache_dir, str: optional, directory to cache the tables in as
+            Parquet. Reused as long as the same reports with the same
+            modification times are in qc_dir
+
+    returns:
+        tables, dict: keys are snake case module names (e.g.
+            basic_statistics, per_base_sequence_quality,
+            overrepresented_sequences) plus module_status, values are dfs
+            with a sample column
+    """
+    qc_dir = abspath(qc_dir)
+    paths = fastqc_report_paths(qc_dir)
+    sources = [[basename(p), getmtime(p)] for p in paths]
+    if cache_dir is not None:
+        cache_dir = abspath(cache_dir)
+        manifest = f'{cache_dir}/fastqc_sources.json'
+        if isfile(manifest):
+            with open(manifest) as f:
+                cached = json.load(f)
+            if cached['sources'] == sources:
+                return {t: pd.read_parquet(f'{cache_dir}/{t}.parquet')
+                        for t in cached['tables']}
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        reports = list(executor.map(_report_tables, paths))
+    table_names = list(dict.fromkeys(t for r in reports for t in r))
+    tables = {t: _typed(pd.concat([r[t] for r in reports if t in r], ignore_index=True))
+              for t in table_names}
+
+    if cache_dir is not None:
+        makedirs(cache_dir, exist_ok=True)
+        for t, df in tables.items():
+            df.to_parquet(f'{cache_dir}/{t}.parquet', index=False)
+        with open(manifest, 'w') as f:
+            json.dump({'sources': sources, 'tables': table_names}, f)
+
+    return tables
+
+
+def write_overrepresented_fasta(overrep, out_path):
+    """
+    Write the overrepresented sequences of all samples to one FASTA file,
+    e.g. to BLAST them in one query. Sequence IDs are <sample>|<index of the
+    sequence in the sample's table>.
+
+    parameters:
+        overrep, df: the overrepresented_sequences table from
+            load_fastqc_reports
+        out_path, str: path to write the FASTA to
+
+    returns:
+        seq_ids, dict: keys are sequence IDs, values are the sequences
+    """
+    index = overrep.groupby('sample', sort=False).cumcount()
+    seq_ids = overrep['sample'].astype(str) + '|' + index.astype(str)
+    with open(abspath(out_path), 'w') as f:
+        f.writelines(f'>{i}\n{s}\n' for i, s in zip(seq_ids, overrep['Sequence']))
+    return dict(zip(seq_ids, overrep['Sequence']))
@@ -3,24 +3,37 @@ Get metadata associated with TAIR ID's for a list of genes.
 
 Author: Serena G. Lotreck
 """
-from os.path import abspath
+import json
+from os.path import abspath, getmtime, isfile
 import pandas as pd
+import numpy as np
 
 
-def get_arabidopsis_descriptions(gene_list, metadata_paths, gene2GO=None):
+# Loaded annotation tables, keyed on the source files and their mtimes so
+# that edited sources are picked up without restarting the kernel
+_METADATA_CACHE = {}
+
+
+def _source_key(metadata_paths):
     """
-    Get arabidopsis gene metadata.
+    Key for the in-process cache: annotation names, paths and mtimes.
+    """
+    return tuple((ann, abspath(path), getmtime(abspath(path)))
+                 for ann, path in metadata_paths.items())
+
+
+def load_metadata(metadata_paths):
+    """
+    Read and merge the metadata files, and index them by gene_id.
 
     parameters:
-        gene_list, list of str: genes to check
         metadata_paths, dict: keys are annotation names, values are paths to
             a file containing Arabidopsis metadata. Assumes all dfs have the
             same column names
-        gene2GO, df: has columns object_name, GO_term, and GO_ID, provide if GO
-            terms should be included in output
 
     returns:
-        gene_df, pandas df: genes with their associated data
+        all_metadata, df: merged metadata with a gene_id column, sorted by
+            gene_id
     """
     # Process metadata
     metadata_dfs = {}
@@ -28,26 +41,214 @@ def get_arabidopsis_descriptions(gene_list, metadata_paths, gene2GO=None):
         # Read in the file
         metadata = pd.read_csv(abspath(metadata_path), sep='\t', header=0, encoding='Windows-1252')
         metadata_dfs[ann] = metadata
-    # If more than one, merge
-    if len(metadata_dfs) == 2:
-        all_metadata = pd.merge(
-        list(metadata_dfs.values())[0], list(metadata_dfs.values())[1],
-        left_on='name', right_on='name',
-        suffixes=(f'_{list(metadata_dfs.keys())[0]}', f'_{list(metadata_dfs.keys())[1]}'))
-    else:
-        all_metadata = metadata_dfs.values()[0]
+    # If more than one, merge all on name, suffixing columns that appear in
+    # more than one source with the annotation name
+    col_counts = pd.Series([c for df in metadata_dfs.values() for c in df.columns
+                            if c != 'name']).value_counts()
+    shared = set(col_counts[col_counts > 1].index)
+    all_metadata = None
+    for ann, metadata in metadata_dfs.items():
+        if len(metadata_dfs) > 1:
+            metadata = metadata.rename(columns={c: f'{c}_{ann}' for c in shared
+                                                if c in metadata.columns})
+        if all_metadata is None:
+            all_metadata = metadata
+        else:
+            all_metadata = pd.merge(all_metadata, metadata, on='name')
     # Make a new column that can match the candidate genes
-    all_metadata['gene_id'] = all_metadata['name'].str.split('.').str[0]
+    all_metadata['gene_id'] = all_metadata['name'].str.split('.').str[0].fillna('')
+
+    return all_metadata.sort_values('gene_id', kind='stable').reset_index(drop=True)
+
+
+def build_annotation_store(metadata_paths, store_path):
+    """
+    Convert the metadata files into a gene_id-sorted columnar store, so they
+    only have to be parsed and merged once. The source paths and mtimes are
+    saved with the store so it can be checked for staleness.
+
+    parameters:
+        metadata_paths, dict: see load_metadata
+        store_path, str: where to write the store, a .feather file (can be
+            memory-mapped) or a .parquet file
+
+    returns:
+        all_metadata, df: the stored metadata
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    all_metadata = load_metadata(metadata_paths)
+    table = pa.Table.from_pandas(all_metadata, preserve_index=False)
+    sources = json.dumps([list(s) for s in _source_key(metadata_paths)])
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b'annotation_sources': sources.encode()})
+    if store_path.endswith('.parquet'):
+        pq.write_table(table, abspath(store_path))
+    else:
+        feather.write_feather(table, abspath(store_path), compression='uncompressed')
+    _METADATA_CACHE[('store', abspath(store_path))] = (
+        getmtime(abspath(store_path)), all_metadata,
+        [tuple(s) for s in _source_key(metadata_paths)])
+
+    return all_metadata
+
+
+def load_annotation_store(store_path, memory_map=True):
+    """
+    Load a store written by build_annotation_store, reusing the in-process
+    copy if the file hasn't changed.
+
+    parameters:
+        store_path, str: path to the store
+        memory_map, bool: whether or not to memory-map the file
+
+    returns:
+        all_metadata, df: the stored metadata
+        sources, list: (annotation name, path, mtime) of the source files
+    """
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    store_path = abspath(store_path)
+    key = ('store', store_path)
+    mtime = getmtime(store_path)
+    # Only read the file if the in-process copy is missing or out of date
+    if key not in _METADATA_CACHE or _METADATA_CACHE[key][0] != mtime:
+        if store_path.endswith('.parquet'):
+            table = pq.read_table(store_path, memory_map=memory_map)
+        else:
+            table = feather.read_table(store_path, memory_map=memory_map)
+        sources = json.loads(table.schema.metadata.get(b'annotation_sources', b'[]'))
+        _METADATA_CACHE[key] = (mtime, table.to_pandas(), [tuple(s) for s in sources])
+
+    return _METADATA_CACHE[key][1], _METADATA_CACHE[key][2]
+
+
+def _get_metadata(metadata_paths, store_path):
+    """
+    Get the merged metadata from the in-process cache, the store, or the
+    source files, in that order, rebuilding the store if it's stale.
+    """
+    if store_path is not None and isfile(abspath(store_path)):
+        all_metadata, sources = load_annotation_store(store_path)
+        if metadata_paths is None or sources == list(_source_key(metadata_paths)):
+            return all_metadata
+    if metadata_paths is None:
+        raise FileNotFoundError(f'No annotation store at {store_path} and no '
+                                'metadata_paths to build one from')
+    if store_path is not None:
+        return build_annotation_store(metadata_paths, store_path)
+    key = _source_key(metadata_paths)
+    if key not in _METADATA_CACHE:
+        _METADATA_CACHE[key] = load_metadata(metadata_paths)
+    return _METADATA_CACHE[key]
+
 
-    # Add GO terms to metadata
+def aggregate_GO(gene2GO, genes=None):
+    """
+    Collapse gene2GO to one row per gene with lists of GO terms and IDs.
+
+    parameters:
+        gene2GO, df: has columns object_name, GO_term, and GO_ID
+        genes, list of str: optional, only aggregate these genes
+
+    returns:
+        go_df, df: indexed by object_name, with list columns GO_term and
+            GO_ID
+    """
+    if genes is not None:
+        gene2GO = gene2GO.loc[gene2GO['object_name'].isin(genes)]
+    return gene2GO[['object_name', 'GO_term', 'GO_ID']].groupby('object_name').agg(list)
+
+
+def _take_genes(all_metadata, gene_list):
+    """
+    Indexed take of the requested genes from the gene_id-sorted metadata;
+    genes with no metadata get an empty row to preserve IDs for novel
+    genes/chimeras.
+    """
+    sorted_ids = all_metadata['gene_id'].to_numpy(dtype=object)
+    targets = gene_list.astype(str).to_numpy(dtype=object)
+    left = np.searchsorted(sorted_ids, targets, side='left')
+    right = np.searchsorted(sorted_ids, targets, side='right')
+    n_rows = np.maximum(right - left, 1)
+    offsets = np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    rows = np.where(np.repeat(right > left, n_rows), np.repeat(left, n_rows) + offsets, -1)
+    gene_df = all_metadata.drop(columns='gene_id').reindex(rows).reset_index(drop=True)
+    gene_df.insert(0, 'gene_id', np.repeat(gene_list.to_numpy(dtype=object), n_rows))
+
+    return gene_df, n_rows
+
+
+def get_arabidopsis_descriptions_batch(gene_lists, metadata_paths=None,
+                                       gene2GO=None, store_path=None):
+    """
+    Get arabidopsis gene metadata for many gene lists at once. The metadata
+    sources are merged and the GO terms aggregated once for all lists.
+
+    parameters:
+        gene_lists, dict: keys are list names (e.g. comparisons), values are
+            lists of genes
+        metadata_paths, dict: keys are annotation names, values are paths to
+            files containing Arabidopsis metadata. Any number of sources can
+            be given
+        gene2GO, df: has columns object_name, GO_term, and GO_ID, provide if GO
+            terms should be included in output. Added as list columns GO_term
+            and GO_ID for genes that have metadata, genes without metadata
+            get none. object_name isn't included, it's the same as gene_id
+        store_path, str: optional, see get_arabidopsis_descriptions
+
+    returns:
+        gene_dfs, dict: keys are the keys of gene_lists, values are dfs of
+            genes with their associated data
+    """
+    all_metadata = _get_metadata(metadata_paths, store_path)
+
+    # One take for all lists together
+    names = list(gene_lists.keys())
+    lengths = [len(gene_lists[n]) for n in names]
+    all_genes = pd.Series([g for n in names for g in gene_lists[n]], name='gene_id',
+                          dtype=object) # To match with metadata df
+    gene_df, n_rows = _take_genes(all_metadata, all_genes)
+    list_pos = np.repeat(np.repeat(np.arange(len(names)), lengths), n_rows)
+
+    # Add GO terms for just the requested genes. As before, only genes with
+    # metadata get GO terms
     if gene2GO is not None:
-        go_df = gene2GO[['object_name', 'GO_term', 'GO_ID']].groupby('object_name').agg(list)
-        all_metadata = pd.merge(all_metadata, go_df, how='outer', left_on='gene_id', right_on='object_name')
+        go_df = aggregate_GO(gene2GO, all_genes.unique())
+        gene_df = pd.merge(gene_df, go_df, how='left', left_on='gene_id', right_index=True)
+        gene_df.loc[gene_df['name'].isna(), ['GO_term', 'GO_ID']] = np.nan
+
+    gene_df = gene_df.set_index(['gene_id', 'name'])
+    bounds = np.searchsorted(list_pos, np.arange(len(names) + 1))
+    gene_dfs = {n: gene_df.iloc[bounds[i]:bounds[i + 1]] for i, n in enumerate(names)}
 
-    # Make gene_list into a Series
-    gene_list = pd.Series(gene_list, name='gene_id') # To match with metadata df
+    return gene_dfs
 
-    # Subset by gene list; left join to preserve IDs for novel genes/chimeras
-    gene_df = pd.merge(gene_list, all_metadata, how='left', on='gene_id').set_index(['gene_id', 'name'])
 
-    return gene_df
\ No newline at end of file
+def get_arabidopsis_descriptions(gene_list, metadata_paths=None, gene2GO=None,
+                                 store_path=None):
+    """
+    Get arabidopsis gene metadata.
+
+    parameters:
+        gene_list, list of str: genes to check
+        metadata_paths, dict: keys are annotation names, values are paths to
+            a file containing Arabidopsis metadata. Assumes all dfs have the
+            same column names
+        gene2GO, df: has columns object_name, GO_term, and GO_ID, provide if GO
+            terms should be included in output, see
+            get_arabidopsis_descriptions_batch
+        store_path, str: optional, path to a store from
+            build_annotation_store. Built from metadata_paths if it doesn't
+            exist or the sources have changed since it was built
+
+    returns:
+        gene_df, pandas df: genes with their associated data
+    """
+    gene_df = get_arabidopsis_descriptions_batch({'genes': gene_list}, metadata_paths,
+                                                 gene2GO, store_path)['genes']
+
+    return gene_df
@@ -0,0 +1,247 @@
+"""
+Persistent local store for UniProt ID mappings, so that only IDs that haven't
+been mapped before are sent to the UniProt ID mapping service.
+
+Author: Serena G. Lotreck
+"""
+import gzip
+import json
+import time
+import sqlite3
+from os.path import abspath
+import pandas as pd
+from uniprot2araport import map_ids, map_ids_async
+
+
+def _to_id(value):
+    """
+    Text to store for a mapped-to value: strings as they are, the accession
+    of a UniProtKB entry, other JSON values as JSON and missing values as ''.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict) and 'primaryAccession' in value:
+        return value['primaryAccession']
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return json.dumps(value, sort_keys=True)
+
+
+class IDMappingCache:
+    """
+    SQLite-backed mapping store keyed by (from_db, to_db, id). Records both
+    successful mappings and failed IDs, and counts cache hits and misses.
+    Failed IDs are retried once they're older than failed_ttl.
+    """
+
+    def __init__(self, db_path, failed_ttl=7*24*3600):
+        """
+        parameters:
+            db_path, str: path to the SQLite file, created if it doesn't exist
+            failed_ttl, float: seconds a failed ID is cached for before it's
+                treated as a miss again, None to keep failures forever
+        """
+        self.db_path = abspath(db_path)
+        self.failed_ttl = failed_ttl
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS mappings ('
+            'from_db TEXT NOT NULL, to_db TEXT NOT NULL, id TEXT NOT NULL, '
+            "to_id TEXT NOT NULL DEFAULT '', failed INTEGER NOT NULL, "
+            'updated REAL NOT NULL, '
+            'PRIMARY KEY (from_db, to_db, id, to_id))')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        """
+        returns:
+            stats, dict: hits, misses, and the hit rate over all lookups
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def _query(self, ids, from_db, to_db):
+        """
+        Get the cached rows for a list of unique IDs, without counting.
+        """
+        # Join against a temporary table, lists can be longer than the limit
+        # on bound parameters
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS query_ids (id TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM query_ids')
+        self.conn.executemany('INSERT OR IGNORE INTO query_ids VALUES (?)',
+                              ((i,) for i in ids))
+        # Expired failures are left out, so they count as misses
+        expired = -1 if self.failed_ttl is None else time.time() - self.failed_ttl
+        hits = pd.read_sql_query(
+            'SELECT m.id AS "from", m.to_id AS "to", m.failed AS failed '
+            'FROM mappings m JOIN query_ids q ON m.id = q.id '
+            'WHERE m.from_db = ? AND m.to_db = ? AND NOT (m.failed AND m.updated < ?)',
+            self.conn, params=(from_db, to_db, expired))
+        self.conn.execute('DELETE FROM query_ids')
+        hits['failed'] = hits['failed'].astype(bool)
+        hits['to'] = hits['to'].where(~hits['failed'], None)
+        return hits
+
+    def lookup(self, ids, from_db, to_db):
+        """
+        Get the cached mappings for a list of IDs.
+
+        parameters:
+            ids, list of str: IDs to look up
+            from_db, str: database the IDs are from
+            to_db, str: database to map to
+
+        returns:
+            hits, df: columns from, to and failed for IDs in the cache
+            misses, list of str: IDs not in the cache, in input order
+        """
+        ids = list(dict.fromkeys(ids))
+        hits = self._query(ids, from_db, to_db)
+        found = set(hits['from'])
+        misses = [i for i in ids if i not in found]
+        self.hits += len(ids) - len(misses)
+        self.misses += len(misses)
+
+        return hits, misses
+
+    def store(self, table, from_db, to_db, submitted=None):
+        """
+        Add mapping results to the cache, replacing whatever was cached for
+        the same IDs (e.g. an earlier failure).
+
+        parameters:
+            table, df: columns from, to and failed, as returned by map_ids
+            from_db, str: database the IDs are from
+            to_db, str: database they were mapped to
+            submitted, list of str: optional, the IDs that were sent. Any
+                that are in neither the results nor failedIds are recorded
+                as failed so they aren't resubmitted
+        """
+        now = time.time()
+        failed = table['failed'].astype(bool)
+        rows = [(from_db, to_db, f, '' if fl else _to_id(t), int(fl), now)
+                for f, t, fl in zip(table['from'], table['to'], failed)]
+        if submitted is not None:
+            seen = set(table['from'])
+            rows += [(from_db, to_db, i, '', 1, now) for i in submitted if i not in seen]
+        ids = {row[2] for row in rows}
+        with self.conn:
+            self.conn.executemany('DELETE FROM mappings WHERE from_db = ? AND to_db = ? '
+                                  'AND id = ?', ((from_db, to_db, i) for i in ids))
+            self.conn.executemany('INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?, ?)',
+                                  rows)
+
+    def _split(self, id_sets, from_db, to_db):
+        """
+        Look up every ID set, returning the hits and misses per set and the
+        union of all misses.
+        """
+        named = isinstance(id_sets, dict)
+        sets = id_sets if named else {None: id_sets}
+        looked_up = {name: self.lookup(ids, from_db, to_db)
+                     for name, ids in sets.items()}
+        all_misses = [i for _, misses in looked_up.values() for i in misses]
+        return named, looked_up, list(dict.fromkeys(all_misses))
+
+    def _combine(self, named, looked_up, from_db, to_db):
+        """
+        Build the output table once all misses have been mapped and stored.
+        """
+        tables = []
+        for name, (hits, misses) in looked_up.items():
+            table = pd.concat([hits, self._query(misses, from_db, to_db)],
+                              ignore_index=True)
+            if named:
+                table.insert(0, 'id_set', name)
+            tables.append(table)
+        return pd.concat(tables, ignore_index=True)
+
+    def map_ids(self, id_sets, from_db, to_db, offline=False, **kwargs):
+        """
+        Map IDs, returning cached results immediately and only submitting
+        IDs that aren't cached to UniProt.
+
+        parameters:
+            id_sets, list or dict: one list of IDs, or a dict where keys are
+                names and values are lists of IDs
+            from_db, str: database the IDs are from
+            to_db, str: database to map to
+            offline, bool: if True, never contact UniProt, IDs that aren't
+                cached are left out of the output
+            kwargs: passed to uniprot2araport.map_ids
+
+        returns:
+            table, df: columns from, to and failed, plus id_set if id_sets
+                is a dict
+        """
+        named, looked_up, misses = self._split(id_sets, from_db, to_db)
+        if misses and not offline:
+            self.store(map_ids(misses, from_db, to_db, **kwargs), from_db, to_db,
+                       submitted=misses)
+        return self._combine(named, looked_up, from_db, to_db)
+
+    async def map_ids_async(self, id_sets, from_db, to_db, offline=False, **kwargs):
+        """
+        Same as map_ids, for use inside a running event loop (e.g. a
+        notebook).
+        """
+        named, looked_up, misses = self._split(id_sets, from_db, to_db)
+        if misses and not offline:
+            table = await map_ids_async(misses, from_db, to_db, **kwargs)
+            self.store(table, from_db, to_db, submitted=misses)
+        return self._combine(named, looked_up, from_db, to_db)
+
+    def import_idmapping_dump(self, dump_path, id_type, from_db, to_db,
+                              reverse=False, batch_size=100000):
+        """
+        Bulk import a UniProt idmapping dump (e.g. idmapping.dat.gz, tab
+        separated UniProtKB-AC, ID type, ID) for fully offline use.
+
+        parameters:
+            dump_path, str: path to the dump, may be gzipped
+            id_type, str: ID type to import from the second column, e.g.
+                'Araport'
+            from_db, str: from database name to store the mappings under
+            to_db, str: to database name to store the mappings under
+            reverse, bool: if True, map from the ID to the UniProt accession
+                instead
+            batch_size, int: number of rows to insert at a time
+
+        returns:
+            n_imported, int: number of mappings imported
+        """
+        opener = gzip.open if dump_path.endswith('.gz') else open
+        now = time.time()
+        n_imported = 0
+        batch = []
+        with opener(abspath(dump_path), 'rt') as f, self.conn:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) < 3 or parts[1] != id_type:
+                    continue
+                accession, other = parts[0], parts[2]
+                if reverse:
+                    accession, other = other, accession
+                batch.append((from_db, to_db, accession, other, 0, now))
+                if len(batch) >= batch_size:
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?, ?)', batch)
+                    n_imported += len(batch)
+                    batch = []
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?, ?)', batch)
+            n_imported += len(batch)
+        return n_imported
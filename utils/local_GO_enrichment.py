@@ -0,0 +1,299 @@
+"""
+Offline GO enrichment against the gene2GO table, as an alternative to the
+PANTHER API for when it's slow, rate limited or not reachable. Output has the
+same shape as the PANTHER results so it can be passed to processGOenrichments.
+
+Author: Serena G. Lotreck
+"""
+from os import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from scipy import sparse
+from scipy.stats import hypergeom
+from multiple_testing import bh_fdr
+
+
+# TAIR GO files use single letter aspects
+ASPECT_NAMES = {
+    'P': 'biological_process',
+    'F': 'molecular_function',
+    'C': 'cellular_component'
+}
+
+
+def build_GO_index(gene2GO, background=None, aspect_col=None):
+    """
+    Build a sparse gene x term membership matrix from the gene2GO table.
+
+    parameters:
+        gene2GO, df: has columns object_name, GO_term, and GO_ID
+        background, list of str: optional, genes to use as the reference
+            set. Default is all genes in gene2GO. Genes in the background
+            with no annotations still count towards the reference size
+        aspect_col, str: optional, name of a column in gene2GO with the GO
+            aspect of each term. If not provided, all terms are put in one
+            aspect called 'all'
+
+    returns:
+        go_index, dict: with keys matrix (csr bool genes x terms), genes
+            (pd.Index of gene IDs) and terms (df with GO_ID, GO_term, aspect
+            and number_in_reference)
+    """
+    cols = ['object_name', 'GO_term', 'GO_ID']
+    if aspect_col is not None:
+        cols.append(aspect_col)
+    ann = gene2GO[cols].dropna(subset=['object_name', 'GO_ID']).drop_duplicates(
+        subset=['object_name', 'GO_ID'])
+
+    # Gene index
+    if background is None:
+        genes = pd.Index(ann['object_name'].unique())
+    else:
+        genes = pd.Index(pd.unique(pd.Series(background)))
+        ann = ann[ann['object_name'].isin(genes)]
+
+    # Term table
+    terms = ann.drop_duplicates('GO_ID').set_index('GO_ID')
+    if aspect_col is None:
+        aspect = pd.Series('all', index=terms.index)
+    else:
+        aspect = terms[aspect_col].map(lambda a: ASPECT_NAMES.get(a, a))
+    terms = pd.DataFrame({'GO_ID': terms.index, 'GO_term': terms['GO_term'].values,
+                          'aspect': aspect.values})
+
+    rows = genes.get_indexer(ann['object_name'])
+    cols = pd.Index(terms['GO_ID']).get_indexer(ann['GO_ID'])
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                               shape=(len(genes), len(terms)))
+    terms['number_in_reference'] = np.asarray(matrix.sum(axis=0)).ravel()
+
+    return {'matrix': matrix, 'genes': genes, 'terms': terms}
+
+
+def _list_matrix(gene_lists, genes):
+    """
+    Encode gene lists as a sparse lists x genes indicator matrix, dropping
+    genes that aren't in the index.
+    """
+    rows, cols = [], []
+    for i, gene_list in enumerate(gene_lists):
+        idx = genes.get_indexer(pd.unique(pd.Series(gene_list, dtype=object)))
+        idx = idx[idx >= 0]
+        rows.append(np.full(len(idx), i))
+        cols.append(idx)
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=int)
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                             shape=(len(gene_lists), len(genes)))
+
+
+def hypergeom_pvalues(k, N, K, n, alternative='greater'):
+    """
+    Vectorized hypergeometric test p-values. Arrays broadcast against each
+    other.
+
+    parameters:
+        k, array: number of list genes annotated to the term
+        N, int: number of genes in the reference
+        K, array: number of reference genes annotated to the term
+        n, array: number of mapped genes in the list
+        alternative, str: 'greater' for over-representation, 'less' for
+            under-representation, or 'two-sided', which doubles the smaller
+            tail
+
+    returns:
+        pvals, array: p-values
+    """
+    if alternative not in ('greater', 'less', 'two-sided'):
+        raise ValueError(f'alternative must be greater, less or two-sided, got {alternative}')
+    k, K, n = np.broadcast_arrays(k, K, n)
+    # scipy evaluates the tails one element at a time, and the same
+    # (k, K, n) combinations come up over and over, so only do each once
+    base = np.int64(N) + 2
+    keys = (k.ravel().astype(np.int64) + 1) + base*(K.ravel() + base*n.ravel())
+    keys, inverse = np.unique(keys, return_inverse=True)
+    uk, uK, un = keys % base - 1, (keys // base) % base, keys // base**2
+    if alternative == 'greater':
+        pvals = hypergeom.sf(uk - 1, N, uK, un)
+    elif alternative == 'less':
+        pvals = hypergeom.cdf(uk, N, uK, un)
+    else:
+        tails = np.minimum(hypergeom.sf(uk - 1, N, uK, un), hypergeom.cdf(uk, N, uK, un))
+        pvals = np.minimum(1, 2*tails)
+    return pvals[inverse.ravel()].reshape(k.shape)
+
+
+def enrichment_arrays(gene_lists, go_index, alternative='greater'):
+    """
+    Test all GO terms against all gene lists at once.
+
+    parameters:
+        gene_lists, list of lists: genes in each list
+        go_index, dict: output of build_GO_index
+        alternative, str: see hypergeom_pvalues
+
+    returns:
+        counts, array: lists x terms number of list genes in each term
+        n, array: number of mapped genes in each list
+        pvals, array: lists x terms p-values
+        fdr, array: lists x terms BH-FDR, corrected within each aspect
+    """
+    matrix, terms = go_index['matrix'], go_index['terms']
+    lists = _list_matrix(gene_lists, go_index['genes'])
+    counts = (lists @ matrix.astype(np.int32)).toarray()
+    n = np.asarray(lists.sum(axis=1)).ravel()
+    N = len(go_index['genes'])
+    K = terms['number_in_reference'].to_numpy()
+    pvals = hypergeom_pvalues(counts, N, K[None, :], n[:, None], alternative)
+
+    fdr = np.empty_like(pvals)
+    for _, idx in terms.groupby('aspect', sort=False).indices.items():
+        fdr[:, idx] = bh_fdr(pvals[:, idx], axis=1)
+
+    return counts, n, pvals, fdr
+
+
+def local_GO_enrichment(gene_lists, gene2GO=None, go_index=None,
+                        alternative='greater', background=None,
+                        aspect_col=None):
+    """
+    Run GO enrichment for many gene lists without the PANTHER API.
+
+    parameters:
+        gene_lists, dict: keys are comparison groups, values are lists of
+            genes
+        gene2GO, df: has columns object_name, GO_term, and GO_ID. Only needed
+            if go_index isn't provided
+        go_index, dict: optional, output of build_GO_index, pass to avoid
+            rebuilding the matrix across calls
+        alternative, str: see hypergeom_pvalues
+        background, list of str: see build_GO_index, ignored if go_index is
+            provided
+        aspect_col, str: see build_GO_index, ignored if go_index is provided
+
+    returns:
+        enrichments, dict: keys are comparison groups, values are dicts
+            where keys are aspects and values are PANTHER-style results,
+            ready for processGOenrichments
+    """
+    if go_index is None:
+        go_index = build_GO_index(gene2GO, background, aspect_col)
+    groups = list(gene_lists.keys())
+    counts, n, pvals, fdr = enrichment_arrays(
+        [gene_lists[g] for g in groups], go_index, alternative)
+    lists = _list_matrix([gene_lists[g] for g in groups], go_index['genes'])
+
+    terms = go_index['terms']
+    genes = go_index['genes']
+    N = len(genes)
+    K = terms['number_in_reference'].to_numpy()
+    go_ids = terms['GO_ID'].to_numpy(dtype=object)
+    labels = terms['GO_term'].to_numpy(dtype=object)
+    gene_ids = genes.to_numpy(dtype=object)
+    aspects = terms.groupby('aspect', sort=False).indices
+    matrix = go_index['matrix'].tocsc()
+
+    enrichments = {}
+    for i, group in enumerate(groups):
+        expected = K * n[i] / N
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fold = counts[i] / expected
+        plus_minus = np.where(counts[i] >= expected, '+', '-')
+        # Genes per term, only needed for over-represented terms
+        in_list = np.zeros(N, dtype=bool)
+        in_list[lists.getrow(i).indices] = True
+
+        enrichments[group] = {}
+        for aspect, idx in aspects.items():
+            result = []
+            for j in idx[np.argsort(pvals[i, idx], kind='stable')]:
+                term_dict = {
+                    'number_in_list': int(counts[i, j]),
+                    'fold_enrichment': float(fold[j]),
+                    'fdr': float(fdr[i, j]),
+                    'expected': float(expected[j]),
+                    'number_in_reference': int(K[j]),
+                    'pValue': float(pvals[i, j]),
+                    'term': {'id': go_ids[j], 'label': labels[j]},
+                    'plus_minus': str(plus_minus[j])
+                }
+                if plus_minus[j] == '+' and counts[i, j] > 0:
+                    rows = matrix.indices[matrix.indptr[j]:matrix.indptr[j + 1]]
+                    term_dict['input_list'] = {
+                        'number_in_list': int(counts[i, j]),
+                        'mapped_ids': gene_ids[rows[in_list[rows]]].tolist()
+                    }
+                result.append(term_dict)
+            enrichments[group][aspect] = {'result': result}
+
+    return enrichments
+
+
+def _permutation_chunk(args):
+    """
+    Count how many random gene sets of each list's size give a p-value at
+    least as small as the observed one, for one chunk of permutations.
+    """
+    matrix, n, obs_pvals, n_perm, seed, alternative, batch_size = args
+    rng = np.random.default_rng(seed)
+    n_genes = matrix.shape[0]
+    K = np.asarray(matrix.sum(axis=0)).ravel()
+    matrix = matrix.astype(np.int32)
+    exceed = np.zeros(obs_pvals.shape, dtype=np.int64)
+    for i, size in enumerate(n):
+        if size == 0:
+            exceed[i] += n_perm
+            continue
+        done = 0
+        while done < n_perm:
+            b = min(batch_size, n_perm - done)
+            # Sample without replacement for every permutation in the batch
+            cols = rng.random((b, n_genes)).argpartition(size - 1, axis=1)[:, :size].ravel()
+            rows = np.repeat(np.arange(b), size)
+            shuffled = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32),
+                                          (rows, cols)), shape=(b, n_genes))
+            counts = (shuffled @ matrix).toarray()
+            pvals = hypergeom_pvalues(counts, n_genes, K[None, :], size, alternative)
+            exceed[i] += (pvals <= obs_pvals[i][None, :]).sum(axis=0)
+            done += b
+    return exceed
+
+
+def permutation_GO_pvalues(gene_lists, go_index, n_permutations=1000,
+                           alternative='greater', n_jobs=None, seed=None,
+                           batch_size=100):
+    """
+    Empirical p-values for every GO term and gene list, from the p-values of
+    random gene sets of the same size drawn from the reference. Permutations
+    are split across a process pool.
+
+    parameters:
+        gene_lists, dict: keys are comparison groups, values are lists of
+            genes
+        go_index, dict: output of build_GO_index
+        n_permutations, int: number of random gene sets per list
+        alternative, str: see hypergeom_pvalues
+        n_jobs, int: number of processes, default is the number of cores
+        seed, int: seed for reproducible permutations
+        batch_size, int: number of permutations to evaluate at once in each
+            process, bounds memory use
+
+    returns:
+        perm_pvals, df: groups x GO_ID empirical p-values
+    """
+    groups = list(gene_lists.keys())
+    _, n, obs_pvals, _ = enrichment_arrays([gene_lists[g] for g in groups],
+                                           go_index, alternative)
+    n_jobs = n_jobs or cpu_count() or 1
+    chunks = np.array_split(np.arange(n_permutations), n_jobs)
+    chunks = [len(c) for c in chunks if len(c)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [(go_index['matrix'], n, obs_pvals, c, s, alternative, batch_size)
+            for c, s in zip(chunks, seeds)]
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        exceed = sum(executor.map(_permutation_chunk, args))
+
+    perm_pvals = (exceed + 1) / (n_permutations + 1)
+    return pd.DataFrame(perm_pvals, index=groups, columns=go_index['terms']['GO_ID'])
@@ -0,0 +1,327 @@
+"""
+Index of SUBA subcellular localizations. The location columns of the SUBA
+exports (e.g. location_ms, location_consensus) are parsed once into sparse
+gene x compartment boolean matrices, one per kind of evidence, so cleaning
+strategies, compartment overlaps and intersections with gene lists are
+masks over the index instead of string searches.
+
+Location columns list entries separated by ';', each a compartment
+optionally followed by ':' and the supporting references. Besides the
+compartments listed, each evidence column also records the loci whose value
+is a single entry, and those whose value is exactly a compartment name, the
+two tests protein_localization.ipynb cleans the exports with.
+
+Author: Serena G. Lotreck
+"""
+import json
+from os import makedirs
+from os.path import abspath, getmtime, isfile
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+
+# Version of the index layout, saved indexes from other versions are rebuilt
+_INDEX_VERSION = 2
+
+
+def base_locus(loci):
+    """
+    Loci without the isoform suffix, lower-cased, e.g. 'AT1G01010.1' ->
+    'at1g01010', so they match base_accession_num in the proteomics exports
+    whatever its case.
+    """
+    return pd.Series(loci).astype(str).str.replace(r'\..*', '', regex=True).str.lower()
+
+
+def parse_locations(values, sep=';'):
+    """
+    Split a location column into one row per listed compartment.
+
+    parameters:
+        values, Series: location strings, NaN for none
+        sep, str: separator between entries
+
+    returns:
+        rows, array: position in values of each entry
+        compartments, array of str: compartment of each entry
+    """
+    entries = pd.Series(values).reset_index(drop=True).dropna().astype(str)
+    entries = entries.str.split(sep).explode()
+    compartments = entries.str.split(':', n=1).str[0].str.strip()
+    keep = compartments.notna() & (compartments != '')
+    return entries.index[keep].to_numpy(), compartments[keep].to_numpy(dtype=str)
+
+
+def parse_single_locations(values, sep=';'):
+    """
+    Compartment of the values that are a single entry, compared the way
+    protein_localization.ipynb does: the value has no sep, and the
+    compartment is everything before the first ':', not stripped.
+
+    parameters:
+        values, Series: location strings, NaN for none
+        sep, str: separator between entries
+
+    returns:
+        single, tuple of arrays: positions in values and compartments of
+            the single entry values
+        exact, tuple of arrays: positions in values and compartments of the
+            values that are only a compartment name, without references
+    """
+    values = pd.Series(values).reset_index(drop=True).dropna().astype(str)
+    values = values[~values.str.contains(sep, regex=False)]
+    exact = values[~values.str.contains(':', regex=False)]
+    single = values.str.split(':', n=1).str[0]
+    return ((single.index.to_numpy(), single.to_numpy(dtype=str)),
+            (exact.index.to_numpy(), exact.to_numpy(dtype=str)))
+
+
+def _sources(suba_paths):
+    """
+    SUBA exports with their modification times.
+    """
+    return [[name, abspath(path), getmtime(path)] for name, path in suba_paths.items()]
+
+
+def build_localization_index(suba_paths, out_dir=None, locus_col='locus',
+                             evidence=('location_ms', 'location_consensus')):
+    """
+    Parse SUBA exports into a localization index.
+
+    parameters:
+        suba_paths, dict: keys are names for the exports (e.g. 'plastid'),
+            values are paths to the SUBA CSVs
+        out_dir, str: optional, directory to save the index to
+        locus_col, str: name of the column with the loci
+        evidence, tuple of str: location columns to index, each is stored
+            under its name without 'location_' (e.g. ms, consensus)
+
+    returns:
+        index, dict: with keys
+            loci, Index: loci in any of the exports
+            keys, Index: base loci, see base_locus
+            compartments, Index: every compartment in any evidence column
+            sources, Index: export names
+            source, sparse matrix: loci x exports, which exports each locus
+                is in
+            one sparse loci x compartments boolean matrix per evidence
+                column, e.g. ms and consensus, with every listed
+                compartment, plus <name>_single (the value is one entry
+                for the compartment) and <name>_exact (the value is the
+                compartment name), see parse_single_locations
+    """
+    frames = []
+    for name, path in suba_paths.items():
+        df = pd.read_csv(path, usecols=lambda c: c == locus_col or c in evidence)
+        frames.append(df.assign(_source=name))
+    table = pd.concat(frames, ignore_index=True)
+    table = table.dropna(subset=[locus_col])
+
+    loci = pd.Index(sorted(table[locus_col].astype(str).unique()))
+    rows = loci.get_indexer(table[locus_col].astype(str))
+    sources = pd.Index(list(suba_paths))
+    parsed = {col: parse_locations(table[col]) if col in table.columns
+              else (np.zeros(0, dtype=int), np.zeros(0, dtype=str))
+              for col in evidence}
+    compartments = pd.Index(sorted(set().union(*[set(c) for _, c in parsed.values()])))
+
+    index = {'loci': loci, 'keys': pd.Index(base_locus(loci)),
+             'compartments': compartments, 'sources': sources,
+             'source': _boolean_matrix(rows, sources.get_indexer(table['_source']),
+                                       (len(loci), len(sources)))}
+    shape = (len(loci), len(compartments))
+    for col, (entry_rows, entry_comps) in parsed.items():
+        name = col.removeprefix('location_')
+        index[name] = _boolean_matrix(rows[entry_rows],
+                                      compartments.get_indexer(entry_comps), shape)
+        if col not in table.columns:
+            index[f'{name}_single'] = index[f'{name}_exact'] = index[name]
+            continue
+        for kind, (kind_rows, kind_comps) in zip(('single', 'exact'),
+                                                 parse_single_locations(table[col])):
+            # Unstripped names that aren't a compartment can't match one
+            cols = compartments.get_indexer(kind_comps)
+            index[f'{name}_{kind}'] = _boolean_matrix(rows[kind_rows[cols >= 0]],
+                                                      cols[cols >= 0], shape)
+
+    if out_dir is not None:
+        save_localization_index(index, out_dir, _sources(suba_paths))
+    return index
+
+
+def _boolean_matrix(rows, cols, shape):
+    """
+    Sparse boolean matrix with True at (rows, cols), stored by column since
+    queries are mostly for one compartment.
+    """
+    values = np.ones(len(rows), dtype=bool)
+    return sparse.csc_matrix((values, (rows, cols)), shape=shape, dtype=bool)
+
+
+def save_localization_index(index, out_dir, sources=None):
+    """
+    Save an index to a directory, one .npz per matrix plus the IDs as JSON.
+    """
+    out_dir = abspath(out_dir)
+    makedirs(out_dir, exist_ok=True)
+    matrices = [k for k, v in index.items() if sparse.issparse(v)]
+    for name in matrices:
+        sparse.save_npz(f'{out_dir}/{name}.npz', index[name])
+    with open(f'{out_dir}/localization_ids.json', 'w') as f:
+        json.dump({'loci': index['loci'].tolist(),
+                   'compartments': index['compartments'].tolist(),
+                   'sources': index['sources'].tolist(), 'matrices': matrices,
+                   'suba_sources': sources, 'version': _INDEX_VERSION}, f)
+
+
+def load_localization_index(out_dir):
+    """
+    Load an index saved by build_localization_index.
+    """
+    out_dir = abspath(out_dir)
+    with open(f'{out_dir}/localization_ids.json') as f:
+        ids = json.load(f)
+    loci = pd.Index(ids['loci'])
+    index = {'loci': loci, 'keys': pd.Index(base_locus(loci)),
+             'compartments': pd.Index(ids['compartments']),
+             'sources': pd.Index(ids['sources'])}
+    for name in ids['matrices']:
+        index[name] = sparse.load_npz(f'{out_dir}/{name}.npz').tocsc()
+    return index
+
+
+def open_localization_index(suba_paths, out_dir, **kwargs):
+    """
+    Load a saved index, rebuilding it if it doesn't exist, the SUBA exports
+    have changed since it was built, or it was saved by another version.
+
+    parameters:
+        suba_paths, dict: see build_localization_index
+        out_dir, str: directory the index is saved in
+        **kwargs: passed to build_localization_index
+    """
+    ids_path = f'{abspath(out_dir)}/localization_ids.json'
+    if isfile(ids_path):
+        with open(ids_path) as f:
+            saved = json.load(f)
+        if (saved.get('version') == _INDEX_VERSION
+                and saved['suba_sources'] == _sources(suba_paths)):
+            return load_localization_index(out_dir)
+    return build_localization_index(suba_paths, out_dir, **kwargs)
+
+
+def compartment_mask(index, compartment, evidence='ms', match='any', source=None):
+    """
+    Loci with a kind of evidence for a compartment.
+
+    parameters:
+        index, dict: output of build_localization_index
+        compartment, str: compartment name, e.g. 'peroxisome'
+        evidence, str: matrix to use, e.g. 'ms' or 'consensus'
+        match, str: 'any' for loci listing the compartment among their
+            entries, 'single' for loci whose value is one entry, for this
+            compartment, or 'exact' for loci whose value is the compartment
+            name and nothing else
+        source, str: optional, only loci in this SUBA export
+
+    returns:
+        mask, array: boolean, one value per locus in index['loci']
+    """
+    if match not in ('any', 'single', 'exact'):
+        raise ValueError(f'match must be any, single or exact, got {match}')
+    matrix = index[evidence if match == 'any' else f'{evidence}_{match}']
+    j = index['compartments'].get_loc(compartment)
+    mask = matrix[:, j].toarray().ravel()
+    if source is not None:
+        mask &= source_mask(index, source)
+    return mask
+
+
+def source_mask(index, source):
+    """
+    Loci in one SUBA export.
+    """
+    return index['source'][:, index['sources'].get_loc(source)].toarray().ravel()
+
+
+def cleaning_strategies(index, compartment, source=None):
+    """
+    Masks for the ways of cleaning a SUBA export used in
+    protein_localization.ipynb. only_one_ms and consensus select the same
+    loci as the notebook. any_ms matches the parsed compartment names
+    instead of the notebook's substring search, so the compartment name
+    appearing in another entry's references doesn't count.
+
+    parameters:
+        index, dict: output of build_localization_index
+        compartment, str: compartment name, e.g. 'peroxisome'
+        source, str: optional, only loci in this SUBA export, e.g. the
+            export for the compartment
+
+    returns:
+        masks, dict: keys only_one_ms (location_ms is one entry, for this
+            compartment, whatever its references), any_ms (MS evidence for
+            this compartment among others) and consensus (location_consensus
+            is exactly the compartment name), values are masks
+    """
+    return {'only_one_ms': compartment_mask(index, compartment, 'ms', 'single', source),
+            'any_ms': compartment_mask(index, compartment, 'ms', 'any', source),
+            'consensus': compartment_mask(index, compartment, 'consensus', 'exact', source)}
+
+
+def gene_mask(index, genes):
+    """
+    Loci in a gene list (e.g. DEGs or differentially abundant proteins),
+    matched on base loci so case and isoform suffixes don't matter.
+    """
+    return index['keys'].isin(set(base_locus(list(genes))))
+
+
+def loci_where(index, mask):
+    """
+    Loci selected by a mask.
+    """
+    return index['loci'][np.asarray(mask, dtype=bool)].tolist()
+
+
+def overlap_counts(index, evidence='ms', mask=None):
+    """
+    Number of loci with evidence for each pair of compartments, with the
+    number for each compartment on the diagonal.
+
+    parameters:
+        index, dict: output of build_localization_index
+        evidence, str: matrix to use, e.g. 'ms' or 'consensus'
+        mask, array: optional, only count these loci
+
+    returns:
+        counts, df: compartments x compartments
+    """
+    matrix = index[evidence].astype(np.int64)
+    if mask is not None:
+        matrix = matrix[np.flatnonzero(mask)]
+    counts = (matrix.T @ matrix).toarray()
+    return pd.DataFrame(counts, index=index['compartments'],
+                        columns=index['compartments'])
+
+
+def compartment_values(index, masks, df, value_col, id_col='base_accession_num'):
+    """
+    Values (e.g. log2 fold changes) of the proteins or genes in each set of
+    loci, e.g. to compare compartments.
+
+    parameters:
+        index, dict: output of build_localization_index
+        masks, dict: keys are names, values are masks over the loci
+        df, df: one row per protein or gene
+        value_col, str: column with the values
+        id_col, str: column with the IDs, matched on base loci
+
+    returns:
+        values, dict: keys are the names in masks, values are arrays
+    """
+    keys = base_locus(df[id_col]).to_numpy()
+    values = df[value_col].to_numpy()
+    return {name: values[np.isin(keys, index['keys'][np.asarray(mask, dtype=bool)])]
+            for name, mask in masks.items()}
@@ -5,19 +5,213 @@ Author: Serena G. Lotreck
 """
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import ListedColormap
+from matplotlib.patches import Patch
 from collections import defaultdict
 import numpy as np
 
 
+def buildDEGmatrix(deg_dfs, photosynth_sets, id_col='gene_id'):
+    """
+    Pivot all comparisons into one gene x comparison log2FC matrix for the
+    genes in photosynth_sets that are DE in any comparison. Build it once and
+    pass it to makeDEGfigure, or use it directly if only the data is needed.
+
+    parameters:
+        deg_dfs, dict: keys are comparison names, values are dfs with
+            log2FC values for significant DEGs
+        photosynth_sets, dict: keys are set names, values are lists of
+            gene names
+        id_col, str: name of the column with the gene IDs
+
+    returns:
+        deg_matrix, dict: with keys
+            lfc, df: lower-cased gene IDs x comparisons log2FoldChange, 0
+                where the gene isn't DE in that comparison
+            membership, df: lower-cased gene IDs x set names, whether the
+                gene is in the set
+            category, Series: the set each gene is colored by (the last set
+                it appears in)
+    """
+    # Long table of every photosynth gene and its set(s)
+    sets = pd.DataFrame({
+        'gene': [str(g).lower() for gs in photosynth_sets.values() for g in gs],
+        'set': [s for s, gs in photosynth_sets.items() for _ in gs]
+    })
+    # Long table of every DEG in every comparison
+    degs = pd.concat([df[[id_col, 'log2FoldChange']].assign(comparison=name)
+                      for name, df in deg_dfs.items()], ignore_index=True)
+    degs['gene'] = degs[id_col].astype(str).str.lower()
+    degs = degs[degs['gene'].isin(sets['gene'])].drop_duplicates(['comparison', 'gene'])
+
+    # Genes on the x axis are photosynth genes that are DE anywhere, in set
+    # order
+    x_genes = pd.unique(sets.loc[sets['gene'].isin(degs['gene']), 'gene'])
+    lfc = degs.pivot(index='gene', columns='comparison', values='log2FoldChange')
+    lfc = lfc.reindex(index=x_genes, columns=list(deg_dfs.keys())).fillna(0)
+    lfc.index.name = id_col
+    membership = pd.crosstab(sets['gene'], sets['set']).reindex(
+        index=x_genes, columns=list(photosynth_sets.keys()), fill_value=0) > 0
+    category = sets.drop_duplicates('gene', keep='last').set_index('gene')['set']
+    category = category.reindex(x_genes)
+
+    return {'lfc': lfc, 'membership': membership, 'category': category}
+
+
+def semanticGeneLabel(gene, tair2gene):
+    """
+    Tick label for a gene: the upper-cased TAIR ID, followed by the gene
+    name in bold if there is one.
+    """
+    try:
+        return f'{gene.upper()}' + ' (' + r"$\bf{" + f'{tair2gene[gene]}' + "}$" + ')'
+    except KeyError:
+        return f'{gene.upper()}'
+
+
+def _barCollection(ax, heights, colors, width=0.8, rasterized=False):
+    """
+    Draw a bar chart as one PolyCollection instead of one patch per bar.
+    Bars are at x = 0..n-1, like categorical ax.bar.
+    """
+    heights = np.asarray(heights, dtype=float)
+    x = np.arange(len(heights))
+    left, right, base = x - width/2, x + width/2, np.zeros(len(heights))
+    verts = np.stack([np.column_stack([left, base]), np.column_stack([left, heights]),
+                      np.column_stack([right, heights]), np.column_stack([right, base])],
+                     axis=1)
+    bars = PolyCollection(verts, facecolors=colors, edgecolors='none',
+                          rasterized=rasterized)
+    ax.add_collection(bars)
+    ax.set_xlim(-0.5 - (1 - width)/2, len(heights) - 0.5 + (1 - width)/2)
+    ax.autoscale_view(scalex=False)
+    return bars
+
+
+def _columnGroups(deg_matrix, separate_columns):
+    """
+    Genes in each column of the figure, as (group name, gene index) pairs.
+    """
+    lfc = deg_matrix['lfc']
+    if not separate_columns:
+        return [(None, lfc.index)]
+    return [(grp, lfc.index[members.to_numpy()])
+            for grp, members in deg_matrix['membership'].items()]
+
+
+def _plotDEGcollections(deg_matrix, photosynth_colors, semantic_names, tair2gene,
+                        title_name, show_all_x, separate_columns,
+                        rasterize_threshold):
+    """
+    Same layout as the bar figure, with each panel drawn as a single
+    collection and tick labels set once per column.
+    """
+    lfc = deg_matrix['lfc']
+    colors = deg_matrix['category'].map(photosynth_colors)
+    groups = _columnGroups(deg_matrix, separate_columns)
+    if separate_columns:
+        width = len(groups)*5
+    else:
+        width = 20
+    # Columns aren't shared, so that tick objects (the main cost with many
+    # genes) are only made for axes that show labels. Every axis in a column
+    # gets the same x limits from _barCollection
+    fig, axs = plt.subplots(len(lfc.columns), len(groups), sharey=True,
+                            figsize=(width, len(lfc.columns)*5), squeeze=False)
+    xticklabels = [[semanticGeneLabel(g, tair2gene) for g in genes] for _, genes in groups]
+
+    for i, deg_set_name in enumerate(lfc.columns):
+        for j, (grp, genes) in enumerate(groups):
+            ax = axs[i, j]
+            heights = lfc.loc[genes, deg_set_name].to_numpy()
+            nonzero = np.count_nonzero(heights)
+            _barCollection(ax, heights, colors[genes].tolist(),
+                           rasterized=len(genes) > rasterize_threshold)
+            if not separate_columns:
+                ax.set_title(semantic_names[deg_set_name] + f': {nonzero} DE {title_name}')
+            elif i == 0:
+                ax.set_title(f'{grp}\n\n{nonzero} DE {title_name}')
+            else:
+                ax.set_title(f'{nonzero} DE {title_name}')
+            if separate_columns and j == 0:
+                ax.set_ylabel(semantic_names[deg_set_name], fontsize=12)
+            if show_all_x or i == len(lfc.columns) - 1:
+                ax.set_xticks(np.arange(len(genes)), xticklabels[j], rotation=90)
+            else:
+                ax.set_xticks([])
+
+    ax = axs[-1, -1]
+    if not separate_columns:
+        fig.supylabel('log2FoldChange', x=ax.get_position().x0 - 0.05)
+    else:
+        fig.supylabel('log2FoldChange', x=ax.get_position().x0 - 0.7)
+    if show_all_x:
+        plt.subplots_adjust(hspace=1)
+
+
+def _plotDEGheatmap(deg_matrix, photosynth_colors, semantic_names, tair2gene,
+                    title_name, separate_columns, max_gene_labels):
+    """
+    Gene x comparison heatmap of log2FoldChange, with a strip above each
+    column showing the category color of each gene.
+    """
+    lfc = deg_matrix['lfc']
+    categories = [c for c in photosynth_colors if c in set(deg_matrix['category'])]
+    codes = deg_matrix['category'].map({c: i for i, c in enumerate(categories)})
+    category_cmap = ListedColormap([photosynth_colors[c] for c in categories])
+    groups = _columnGroups(deg_matrix, separate_columns)
+    vmax = np.abs(lfc.to_numpy()).max() if lfc.size else 1
+    vmax = vmax if vmax > 0 else 1
+
+    n_genes = sum(len(genes) for _, genes in groups)
+    fig, axs = plt.subplots(2, len(groups), sharex='col', squeeze=False,
+                            figsize=(min(max(10, n_genes*0.12), 60),
+                                     len(lfc.columns)*0.5 + 4),
+                            gridspec_kw={'height_ratios': [1, max(len(lfc.columns), 1)*4],
+                                         'width_ratios': [max(len(g), 1) for _, g in groups],
+                                         'hspace': 0.02})
+
+    for j, (grp, genes) in enumerate(groups):
+        strip_ax, ax = axs[0, j], axs[1, j]
+        strip_ax.imshow(codes[genes].to_numpy(dtype=float)[None, :], cmap=category_cmap,
+                        vmin=-0.5, vmax=len(categories) - 0.5, aspect='auto',
+                        interpolation='nearest')
+        strip_ax.set_yticks([])
+        strip_ax.tick_params(axis='x', labelbottom=False, bottom=False)
+        values = lfc.loc[genes].to_numpy().T
+        im = ax.imshow(values, cmap='RdBu_r', vmin=-vmax, vmax=vmax, aspect='auto',
+                       interpolation='nearest')
+        nonzero = np.count_nonzero(values)
+        if separate_columns:
+            strip_ax.set_title(f'{grp}\n\n{nonzero} DE {title_name}')
+        else:
+            strip_ax.set_title(f'{len(genes)} {title_name}, {nonzero} DE')
+        ax.set_yticks(np.arange(len(lfc.columns)),
+                      [semantic_names[c] for c in lfc.columns] if j == 0 else [])
+        if len(genes) <= max_gene_labels:
+            ax.set_xticks(np.arange(len(genes)),
+                          [semanticGeneLabel(g, tair2gene) for g in genes], rotation=90)
+        else:
+            ax.set_xticks([])
+            ax.set_xlabel(f'{len(genes)} {title_name}')
+
+    fig.colorbar(im, ax=axs[1, :].tolist(), label='log2FoldChange', fraction=0.05)
+    fig.legend(handles=[Patch(color=photosynth_colors[c], label=c) for c in categories],
+               loc='upper right')
+
+
 def makeDEGfigure(deg_dfs, photosynth_sets, photosynth_colors, semantic_names,
                   tair2gene, id_col='gene_id', title_name='genes', show_all_x=True,
-                 separate_columns=False):
+                 separate_columns=False, deg_matrix=None, render='bars',
+                 heatmap_threshold=300, rasterize_threshold=500, max_gene_labels=150):
     """
     Maked stacked expresion figure.
 
     parameters:
         deg_dfs, dict: keys are comparison names, values are dfs with
-            log2FC values for significant DEGs
+            log2FC values for significant DEGs. Can be None if deg_matrix is
+            provided
         photosynth_sets, dict: keys are set names, values are lists of
             gene names
         photosynth_colors, dict: keys are photosynth gene categories,
@@ -30,48 +224,48 @@ def makeDEGfigure(deg_dfs, photosynth_sets, photosynth_colors, semantic_names,
         show_all_x, bool: whether or not to put tick labels on all subplots
         separate_columns, vool: whether or not to plot all groups on the
             same set of plots
+        deg_matrix, dict: optional, output of buildDEGmatrix, to avoid
+            rebuilding it for every figure
+        render, str: 'bars' (default) for one ax.bar per subplot,
+            'collection' to draw each subplot as a single collection,
+            'heatmap' for a gene x comparison heatmap, or 'auto' to use
+            'collection' up to heatmap_threshold genes and 'heatmap' above
+            it. The faster modes are opt-in since they change how the
+            figure looks
+        heatmap_threshold, int: number of genes above which 'auto' switches
+            to a heatmap
+        rasterize_threshold, int: number of bars above which a subplot is
+            rasterized in 'collection' mode, to keep vector files small
+        max_gene_labels, int: number of genes above which a heatmap column
+            gets no gene tick labels
     """
-    # Capitalize the photosynthesis genes
-    # Get the overall list of all photosynth genes that appear in any DEG set
-    # These will be the x axis for all plots
-    # If separate columns, all_photosynth is a dict instead of one list
-    if separate_columns:
-        all_photosynth = {}
-        for s, p in photosynth_sets.items():
-            these_photosynth = [str(g).upper() for g in p]
-            these_degs = [str(g).upper() for g_list in [df[id_col].tolist() for df in deg_dfs.values()] for g in g_list]
-            x_genes = set(these_photosynth).intersection(these_degs)
-            all_photosynth[s] = x_genes
-    else:
-        all_photosynth = [str(g).upper() for s in photosynth_sets.values() for g in s]
-        all_degs = [str(g).upper() for g_list in [df[id_col].tolist() for df in deg_dfs.values()] for g in g_list]
-        x_genes = set(all_photosynth).intersection(all_degs)
-    
-    # Make a color dict for all the sets
-    g_to_group = {}
-    for ph, gs in photosynth_sets.items():
-        for g in gs:
-            g_to_group[g] = ph
-    color_dict = {g: photosynth_colors[ph] for g, ph in g_to_group.items()}
-    
-    # Get the intersections of the photosynth sets with the DEG conditions
+    if deg_matrix is None:
+        deg_matrix = buildDEGmatrix(deg_dfs, photosynth_sets, id_col)
+    if render == 'auto':
+        render = 'heatmap' if len(deg_matrix['lfc']) > heatmap_threshold else 'collection'
+    if render not in ('bars', 'collection', 'heatmap'):
+        raise ValueError(f'Unknown render mode {render}')
+    if render == 'collection':
+        return _plotDEGcollections(deg_matrix, photosynth_colors, semantic_names,
+                                   tair2gene, title_name, show_all_x, separate_columns,
+                                   rasterize_threshold)
+    if render == 'heatmap':
+        return _plotDEGheatmap(deg_matrix, photosynth_colors, semantic_names, tair2gene,
+                               title_name, separate_columns, max_gene_labels)
+    lfc = deg_matrix['lfc']
+    g_to_group = deg_matrix['category'].to_dict()
+    color_dict = deg_matrix['category'].map(photosynth_colors).to_dict()
+
+    # Slice the matrix into one df per comparison (and group, if separate
+    # columns) for plotting
     to_plot = defaultdict(dict)
-    for deg_set_name, deg_set in deg_dfs.items():
-        if not separate_columns: # Also hideous, *sigh*
-            photosynth = deg_set[deg_set[id_col].isin(all_photosynth)][[id_col, 'log2FoldChange']]
-            not_present = {id_col: [g for g in x_genes if g not in photosynth[id_col].tolist()]}
-            not_present['log2FoldChange'] = [0]* len(not_present[id_col])
-            to_plot_df = pd.concat([photosynth, pd.DataFrame(not_present)])
-            to_plot_df[id_col] = to_plot_df[id_col].str.lower()
-            to_plot[deg_set_name] = to_plot_df
-        if separate_columns:
-            for grp, grp_members in all_photosynth.items():
-                photosynth = deg_set[deg_set[id_col].isin(grp_members)][[id_col, 'log2FoldChange']]
-                not_present = {id_col: [g for g in grp_members if g not in photosynth[id_col].tolist()]}
-                not_present['log2FoldChange'] = [0]* len(not_present[id_col])
-                to_plot_df = pd.concat([photosynth, pd.DataFrame(not_present)])
-                to_plot_df[id_col] = to_plot_df[id_col].str.lower()
-                to_plot[deg_set_name][grp] = to_plot_df
+    for deg_set_name in lfc.columns:
+        current_set = lfc[deg_set_name].rename('log2FoldChange').rename_axis(id_col)
+        if not separate_columns:
+            to_plot[deg_set_name] = current_set.reset_index()
+        else:
+            for grp, members in deg_matrix['membership'].items():
+                to_plot[deg_set_name][grp] = current_set[members].reset_index()
 
     # Plot
     if separate_columns:
@@ -5,14 +5,302 @@ the nf-core/rnaseq pipeline.
 Author: Serena G. Lotreck
 """
 import argparse
-from os import listdir, extsep
-from os.path import abspath
+from os import scandir, stat, extsep
+from os.path import abspath, basename, dirname, isfile
+import re
 import json
+import gzip
+import zlib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
 import pandas as pd
 import warnings
 
 
-def main(data_dir, semantic_names, skip_missing, out_loc):
+# Read number in Illumina-style names, e.g. sample_S1_L001_R1_001.fastq.gz,
+# or sample.R1.fastq.gz
+READ_PATTERN = re.compile(r'[_.]R([12])(?=[_.])')
+
+
+class HashingReader:
+    """
+    File wrapper that updates a checksum with the raw bytes as they are read,
+    so the file only has to be read once to both checksum and decompress it.
+    """
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def read_id(header):
+    """
+    Get the read ID from a FASTQ header line, without the mate suffix.
+    """
+    read_id = header.split(maxsplit=1)[0] if header.strip() else b''
+    if read_id.endswith((b'/1', b'/2')):
+        read_id = read_id[:-2]
+    return read_id
+
+
+def validate_fastq_pair(fastq_1, fastq_2, chunk_size=2**20):
+    """
+    Stream a pair of fastq.gz files in lockstep, counting reads, checking
+    that the read IDs match and that both files are complete, and computing
+    the md5 of each file. Memory use is constant per pair.
+
+    parameters:
+        fastq_1, str: path to the R1 file
+        fastq_2, str: path to the R2 file
+        chunk_size, int: size of the read buffer
+
+    returns:
+        result, dict: reads_1, reads_2, md5_1, md5_2 and status, which is
+            'ok', or describes the first problem found
+    """
+    raw = [HashingReader(fastq_1), HashingReader(fastq_2)]
+    streams = [gzip.open(r, 'rb') for r in raw]
+    counts = [0, 0]
+    problems = []
+    records = [[], []]
+    done = [False, False]
+    try:
+        while not all(done):
+            # Read one record from each file that isn't finished
+            for i in (0, 1):
+                if done[i]:
+                    continue
+                record = [streams[i].readline() for _ in range(4)]
+                if not record[0]:
+                    done[i] = True
+                    records[i] = None
+                    continue
+                if (not record[0].startswith(b'@') or not record[2].startswith(b'+')
+                        or not record[3]):
+                    problems.append(f'malformed record {counts[i] + 1} in R{i + 1}')
+                    done[i] = True
+                    records[i] = None
+                    continue
+                counts[i] += 1
+                records[i] = record
+            if (records[0] is not None and records[1] is not None and not problems
+                    and read_id(records[0][0]) != read_id(records[1][0])):
+                problems.append(f'read ID mismatch at read {counts[0]}')
+    except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+        problems.append(f'truncated or corrupt gzip in R{i + 1} ({e})')
+    try:
+        # Hash anything that wasn't read while decompressing
+        for r in raw:
+            while r.read(chunk_size):
+                pass
+    finally:
+        for stream, r in zip(streams, raw):
+            stream.close()
+            r.close()
+    if not problems and counts[0] != counts[1]:
+        problems.append('read count mismatch')
+
+    return {
+        'reads_1': counts[0],
+        'reads_2': counts[1],
+        'md5_1': raw[0].md5.hexdigest(),
+        'md5_2': raw[1].md5.hexdigest(),
+        'status': problems[0] if problems else 'ok'
+    }
+
+
+def _validate_pair(pair):
+    """
+    Unpack arguments for the process pool.
+    """
+    return validate_fastq_pair(*pair)
+
+
+def validate_samplesheet(samplesheet_df, n_jobs=None):
+    """
+    Validate every pair of files in a samplesheet in parallel.
+
+    parameters:
+        samplesheet_df, df: samplesheet with columns fastq_1 and fastq_2
+        n_jobs, int: number of processes, default is the number of cores
+
+    returns:
+        samplesheet_df, df: with the added columns reads_1, reads_2, md5_1,
+            md5_2 and status
+    """
+    pairs = list(zip(samplesheet_df['fastq_1'], samplesheet_df['fastq_2']))
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(_validate_pair, pairs))
+    validation = pd.DataFrame(results, index=samplesheet_df.index,
+                              columns=['reads_1', 'reads_2', 'md5_1', 'md5_2', 'status'])
+    for samp, status in zip(samplesheet_df['sample'], validation['status']):
+        if status != 'ok':
+            warnings.warn(f'Sample {samp} failed validation: {status}')
+
+    return pd.concat([samplesheet_df, validation], axis=1)
+
+
+def parse_fastq_name(filename):
+    """
+    Parse a fastq.gz filename into its sample name, the key shared by the
+    two mates, and which read it is.
+
+    parameters:
+        filename, str: name of the file, e.g. 2-1h_S1_L001_R1_001.fastq.gz
+
+    returns:
+        parsed, tuple or None: (sample, pair_key, read), where read is 1 or
+            2, or None if the file isn't a fastq.gz or has no R1/R2 token
+    """
+    if not filename.endswith(f'{extsep}fastq{extsep}gz'):
+        return None
+    matches = list(READ_PATTERN.finditer(filename))
+    if not matches:
+        return None
+    # The read number is the last R1/R2 token, sample names may contain one
+    match = matches[-1]
+    pair_key = filename[:match.start(1)] + '?' + filename[match.end(1):]
+    return filename[:match.start()].split('_')[0], pair_key, int(match.group(1))
+
+
+def scan_fastq(data_dirs, skip=frozenset()):
+    """
+    Recursively find fastq.gz files in one or more directories.
+
+    parameters:
+        data_dirs, list of str: directories to scan
+        skip, set of str: absolute paths to leave out, e.g. files that are
+            already in the samplesheet
+
+    returns:
+        paths, list of str: absolute paths of the fastq.gz files found
+    """
+    paths = []
+    to_scan = [abspath(d) for d in data_dirs]
+    while to_scan:
+        with scandir(to_scan.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=True):
+                    to_scan.append(entry.path)
+                elif (entry.name.endswith(f'{extsep}fastq{extsep}gz')
+                        and entry.path not in skip):
+                    paths.append(entry.path)
+    return paths
+
+
+def _pair_sorted_names(paths):
+    """
+    Pair files without an R1/R2 token the way the samplesheet always has:
+    sorted by name, a file is paired with the next one if the first three
+    '_' separated fields of their names match.
+
+    returns:
+        pairs, list of tuple: (sample, fastq_1, fastq_2)
+        unpaired, list of str: paths of files without a mate
+    """
+    pairs, unpaired = [], []
+    paths = sorted(paths, key=basename)
+    i = 0
+    while i < len(paths):
+        name = basename(paths[i])
+        if (i + 1 < len(paths)
+                and name.split('_')[:3] == basename(paths[i + 1]).split('_')[:3]):
+            pairs.append((name.split('_')[0], paths[i], paths[i + 1]))
+            i += 2
+        else:
+            unpaired.append(paths[i])
+            i += 1
+    return pairs, unpaired
+
+
+def pair_fastq(paths, skip_missing):
+    """
+    Pair R1 and R2 files on their parsed names. Files without an R1/R2
+    token are paired by sorted name within their directory, see
+    _pair_sorted_names. A missing mate only affects its own sample.
+
+    parameters:
+        paths, list of str: absolute paths of the fastq.gz files
+        skip_missing, bool: whether or not to skip files that are missing
+            pairs instead of raising an error
+
+    returns:
+        pairs, list of tuple: (sample, fastq_1, fastq_2), sorted by fastq_1
+        unpaired, list of str: paths of files without a mate
+    """
+    mates = defaultdict(dict)
+    no_token = defaultdict(list)
+    for path in paths:
+        parsed = parse_fastq_name(basename(path))
+        if parsed is None:
+            no_token[dirname(path)].append(path)
+            continue
+        sample, pair_key, read = parsed
+        # Include the directory so runs with the same file names stay apart
+        mates[(dirname(path), pair_key)][read] = (sample, path)
+
+    pairs = []
+    unpaired = []
+    for key in sorted(mates):
+        found = mates[key]
+        if 1 not in found or 2 not in found:
+            unpaired.append(next(iter(found.values()))[1])
+            continue
+        pairs.append((found[1][0], found[1][1], found[2][1]))
+    for directory in sorted(no_token):
+        dir_pairs, dir_unpaired = _pair_sorted_names(no_token[directory])
+        pairs.extend(dir_pairs)
+        unpaired.extend(dir_unpaired)
+
+    for path in unpaired:
+        if not skip_missing:
+            raise ValueError(f'File {path} is missing its paired counterpart')
+        warnings.warn(f'File {path} is missing its paired counterpart, '
+                'this sample will be skipped')
+
+    return sorted(pairs, key=lambda p: p[1]), unpaired
+
+
+def _file_stat(path):
+    """
+    Size and modification time of a file, None if it doesn't exist.
+    """
+    try:
+        file_stat = stat(path)
+    except FileNotFoundError:
+        return None
+    return [file_stat.st_size, file_stat.st_mtime]
+
+
+def unchanged_rows(samplesheet_df, manifest):
+    """
+    Rows of an existing samplesheet whose files both still have the size
+    and modification time recorded in the manifest. Pairs where either file
+    was re-delivered, truncated or removed are re-processed.
+
+    parameters:
+        samplesheet_df, df: existing samplesheet
+        manifest, dict: keys are paths, values are [size, mtime]
+
+    returns:
+        keep, Series: boolean, one value per row
+    """
+    def unchanged(path):
+        return path in manifest and _file_stat(path) == manifest[path]
+
+    return samplesheet_df['fastq_1'].map(unchanged) & samplesheet_df['fastq_2'].map(unchanged)
+
+
+def main(data_dir, semantic_names, skip_missing, out_loc, validate=False,
+         n_jobs=None, incremental=False):
 
     print('\nReading in data...')
 
@@ -21,6 +309,22 @@ def main(data_dir, semantic_names, skip_missing, out_loc):
         with open(semantic_names) as f:
             semantic_dict = json.load(f)
 
+    # Samples already in the samplesheet from a previous run, whose files
+    # haven't changed since
+    data_dirs = [data_dir] if isinstance(data_dir, str) else list(data_dir)
+    out_path = f'{out_loc}/samplesheet.csv'
+    manifest_path = f'{out_loc}/samplesheet_manifest.json'
+    manifest = {}
+    existing_df = None
+    if incremental and isfile(manifest_path) and isfile(out_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        existing_df = pd.read_csv(out_path)
+        keep = unchanged_rows(existing_df, manifest)
+        print(f'\nFound {keep.sum()} previously processed samples, '
+              f'{(~keep).sum()} changed since')
+        existing_df = existing_df[keep]
+
     # Set up dataframe structure
     samples = {'sample': [],
             'fastq_1': [],
@@ -29,54 +333,57 @@ def main(data_dir, semantic_names, skip_missing, out_loc):
 
     # Get the pairs of filenames
     print('\nPairing filenames...')
-    all_fastq = []
-    for f in listdir(data_dir):
-        try:
-            if f.split(extsep, 1)[1] == 'fastq.gz':
-                all_fastq.append(f)
-        except IndexError:
-            continue
-    all_fastq.sort()
-    first_even = True
-    for i, elt in enumerate(all_fastq):
-        if (first_even and i % 2 == 0) or (not first_even and i % 2 != 0):
-            # Check for the paired files
-            if elt.split('_')[:3] != all_fastq[i+1].split('_')[:3]:
-                if not skip_missing:
-                    assert elt.split('_')[:3] != all_fastq[i+1].split('_')[:3], (
-                        f'File {elt} is missing its paired counterpart')
-                else:
-                    warning = (f'File {elt} is missing its paired counterpart, '
-                        'this sample will be skipped')
-                    warnings.warn(warning)
-                first_even = not first_even
-                continue
-            # Semantic name conversion if requested
-            if semantic_names != '':
-                samp_name = semantic_dict[elt.split('_')[0]]
-            else:
-                samp_name = elt.split('_')[0]
-            samples['sample'].append(samp_name)
-            samples['fastq_1'].append(abspath(f'{data_dir}/{elt}')) # Generate absolute paths for fastq files
-            samples['fastq_2'].append(abspath(f'{data_dir}/{all_fastq[i+1]}'))
-            samples['strandedness'].append('auto')
+    skip = set() if existing_df is None else set(existing_df['fastq_1']) | set(existing_df['fastq_2'])
+    all_fastq = scan_fastq(data_dirs, skip=skip)
+    pairs, _ = pair_fastq(all_fastq, skip_missing)
+    for samp_name, fastq_1, fastq_2 in pairs:
+        # Semantic name conversion if requested
+        if semantic_names != '':
+            samp_name = semantic_dict[samp_name]
+        samples['sample'].append(samp_name)
+        samples['fastq_1'].append(fastq_1) # Absolute paths for fastq files
+        samples['fastq_2'].append(fastq_2)
+        samples['strandedness'].append('auto')
 
     # Make dataframe
     print('\nMaking dataframe...')
     samplesheet_df = pd.DataFrame(samples)
+    if existing_df is not None and samplesheet_df.empty and len(existing_df) == len(keep):
+        print('\nNo new or changed samples, samplesheet is up to date')
+        return
+
+    # Check the files if requested
+    if validate:
+        print('\nValidating fastq files...')
+        samplesheet_df = validate_samplesheet(samplesheet_df, n_jobs)
     print(f'\nSnapshot of samplesheet:\n{samplesheet_df.head()}')
 
-    # Save
-    print(f'\nSaving as {out_loc}/samplesheet.csv...')
-    samplesheet_df.to_csv(f'{out_loc}/samplesheet.csv', index=False)
+    # Save, with the unchanged samples from the existing samplesheet first.
+    # Columns only one of them has (e.g. validation results) are kept
+    if existing_df is not None:
+        print(f'\nRewriting {out_path} with {len(existing_df)} unchanged and '
+              f'{len(samplesheet_df)} new or changed samples...')
+        samplesheet_df = pd.concat([existing_df, samplesheet_df], ignore_index=True)
+    else:
+        print(f'\nSaving as {out_path}...')
+    samplesheet_df.to_csv(out_path, index=False)
+
+    # Record the paired files so they aren't processed again unless they
+    # change
+    if incremental:
+        manifest = {path: _file_stat(path) for path in
+                    samplesheet_df['fastq_1'].tolist() + samplesheet_df['fastq_2'].tolist()}
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
     print('\Done!')
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Make samplesheet')
 
-    parser.add_argument('data_dir', type=abspath,
-            help='Directory containing RNAseq files to use')
+    parser.add_argument('data_dir', type=abspath, nargs='+',
+            help='Directories containing RNAseq files to use, searched '
+            'recursively. Multiple sequencing run directories can be given')
     parser.add_argument('-semantic_names', type=str, default='',
             help='Optionally, provide a mapping between the sample '
             'names as present in data_dir and a semantic naming to '
@@ -87,10 +394,22 @@ if __name__ == "__main__":
             help='Whether or not to skip files that are missing pairs')
     parser.add_argument('out_loc', type=abspath,
             help='Where to write output samplesheet')
+    parser.add_argument('--validate', action='store_true',
+            help='Whether or not to check every pair of files for truncation, '
+            'matching read counts and read IDs, and add read counts, md5 '
+            'checksums and a status to the samplesheet')
+    parser.add_argument('--incremental', action='store_true',
+            help='Whether or not to only add samples that aren\'t already in '
+            'the samplesheet in out_loc, or whose files changed size or '
+            'modification time, using the manifest written next to it')
+    parser.add_argument('-n_jobs', type=int, default=None,
+            help='Number of processes to use for validation, default is the '
+            'number of cores')
 
     args = parser.parse_args()
 
     if args.semantic_names != '':
         args.semantic_names = abspath(args.semantic_names)
 
-    main(args.data_dir, args.semantic_names, args.skip_missing, args.out_loc)
+    main(args.data_dir, args.semantic_names, args.skip_missing, args.out_loc,
+            args.validate, args.n_jobs, args.incremental)
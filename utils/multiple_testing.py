@@ -0,0 +1,124 @@
+"""
+Multiple testing corrections shared by the enrichment and co-abundance
+code: Benjamini-Hochberg FDR for arrays in memory, and a blocked version for
+p-values in memory-mapped matrices that are too big to sort in RAM.
+
+Author: Serena G. Lotreck
+"""
+import numpy as np
+
+
+# Histogram bins for the blocked BH correction: log-spaced for the small
+# p-values, linear above 1e-4, so no bin holds a large share of the tests
+P_EDGES = np.concatenate([[0.0], np.geomspace(1e-300, 1e-4, 2048, endpoint=False),
+                          np.linspace(1e-4, 1, 8193)])
+
+
+def bh_fdr(pvals, axis=-1):
+    """
+    Benjamini-Hochberg FDR along one axis of an array of p-values.
+
+    parameters:
+        pvals, array: p-values
+        axis, int: axis holding the tests to correct together
+
+    returns:
+        fdr, array: adjusted p-values, same shape as pvals
+    """
+    pvals = np.moveaxis(np.asarray(pvals, dtype=float), axis, -1)
+    m = pvals.shape[-1]
+    if m == 0:
+        return np.moveaxis(pvals, -1, axis)
+    order = np.argsort(pvals, axis=-1)
+    ranked = np.take_along_axis(pvals, order, axis=-1) * m / np.arange(1, m + 1)
+    ranked = np.minimum.accumulate(ranked[..., ::-1], axis=-1)[..., ::-1]
+    fdr = np.empty_like(ranked)
+    np.put_along_axis(fdr, order, np.minimum(ranked, 1), axis=-1)
+    return np.moveaxis(fdr, -1, axis)
+
+
+def _p_bins(pvals):
+    """
+    Bin of each p-value in P_EDGES.
+    """
+    return np.clip(np.searchsorted(P_EDGES, pvals, side='right') - 1, 0, len(P_EDGES) - 2)
+
+
+def _tested_values(p, start, stop, tested):
+    """
+    Positions in the flattened block and values of the tested, non-NaN
+    p-values in rows start:stop.
+    """
+    block = np.asarray(p[start:stop]).reshape(-1)
+    positions = np.flatnonzero(tested(start, stop).reshape(-1) & ~np.isnan(block))
+    return positions, block[positions]
+
+
+def bh_fdr_blocks(p, q, blocks, tested, max_values=2**22):
+    """
+    Benjamini-Hochberg FDR over a subset of the entries of a 2D array of
+    p-values, reading and writing one block of rows at a time, so neither
+    the p-values nor their ranks have to fit in memory. Gives the same
+    values as bh_fdr on the tested entries.
+
+    The ranks come from a histogram of the p-values (one pass), then the
+    bins are corrected in groups of at most max_values p-values, from the
+    largest down, one pass per group.
+
+    parameters:
+        p, array: p-values, e.g. a read-only memmap
+        q, array: same shape as p, written to, e.g. a memmap opened r+.
+            NaN where an entry isn't tested or its p-value is NaN
+        blocks, list of tuple: (start, stop) row ranges covering p
+        tested, function: called with start and stop, returns a boolean
+            mask over rows start:stop of the entries to correct together
+        max_values, int: maximum number of p-values held at once, a bin
+            with more is still done in one go
+    """
+    n_bins = len(P_EDGES) - 1
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for start, stop in blocks:
+        _, values = _tested_values(p, start, stop, tested)
+        counts += np.bincount(_p_bins(values), minlength=n_bins)
+        q[start:stop] = np.nan
+    m = counts.sum()
+    if m == 0:
+        return
+    n_below = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    # Groups of consecutive bins, largest p-values first
+    groups = []
+    hi = n_bins - 1
+    while hi >= 0:
+        lo, size = hi, counts[hi]
+        while lo > 0 and size + counts[lo - 1] <= max_values:
+            lo -= 1
+            size += counts[lo]
+        groups.append((lo, hi))
+        hi = lo - 1
+
+    running = np.inf
+    for lo, hi in groups:
+        if counts[lo:hi + 1].sum() == 0:
+            continue
+        found, values = [], []
+        for start, stop in blocks:
+            positions, block_values = _tested_values(p, start, stop, tested)
+            bins = _p_bins(block_values)
+            keep = (bins >= lo) & (bins <= hi)
+            found.append((start, stop, positions[keep]))
+            values.append(block_values[keep])
+        values = np.concatenate(values)
+        order = np.argsort(values, kind='stable')
+        ranks = n_below[lo] + np.arange(1, len(values) + 1)
+        ranked = values[order] * m / ranks
+        ranked = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], running)
+        running = ranked[0]
+        q_values = np.empty_like(ranked)
+        q_values[order] = np.minimum(ranked, 1)
+        offset = 0
+        for start, stop, positions in found:
+            q_block = np.asarray(q[start:stop]).copy()
+            q_block.reshape(-1)[positions] = q_values[offset:offset + len(positions)]
+            q[start:stop] = q_block
+            offset += len(positions)
@@ -0,0 +1,354 @@
+"""
+Minimal pipeline runner. Steps are declared as a DAG, and each step's output
+is cached under a key made from its code (the step function and the project
+modules it uses), its parameters, the contents of its input files and the
+keys of the steps it depends on. Steps whose key is already in the cache are
+skipped, and steps that don't depend on each other run in parallel
+processes.
+
+Author: Serena G. Lotreck
+"""
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import inspect
+from os import listdir, makedirs
+from os.path import abspath, basename, dirname, getmtime, getsize, isdir, isfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def hash_path(path, content=True, chunk_size=1 << 20):
+    """
+    Hash a file, or all files under a directory.
+
+    parameters:
+        path, str: file or directory
+        content, bool: if True hash file contents, otherwise only names,
+            sizes and modification times (e.g. for directories of large
+            fastq files)
+        chunk_size, int: bytes to read at a time
+
+    returns:
+        digest, str: SHA-256 hex digest
+    """
+    digest = hashlib.sha256()
+    path = abspath(path)
+    if isdir(path):
+        for name in sorted(listdir(path)):
+            digest.update(name.encode())
+            digest.update(hash_path(f'{path}/{name}', content, chunk_size).encode())
+    elif not content:
+        digest.update(f'{getsize(path)}:{getmtime(path)}'.encode())
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_paths(value, content):
+    """
+    Hash a path, or every path in a list or dict of paths.
+    """
+    if isinstance(value, dict):
+        return {k: _hash_paths(v, content) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_hash_paths(v, content) for v in value]
+    if value is None:
+        return None
+    return hash_path(value, content)
+
+
+def _referenced_names(code):
+    """
+    Global names used by a code object, including nested functions and
+    comprehensions.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _referenced_names(const)
+    return names
+
+
+def _code_sources(func):
+    """
+    Source the output of a step depends on: the step function, the
+    functions from its own module that it calls, and the files of the
+    project modules (those next to the step's module, e.g. utils) it uses,
+    followed through their own imports.
+
+    returns:
+        sources, dict: keys are function or file names, values are source
+    """
+    root = dirname(abspath(inspect.getfile(func)))
+    own_module = inspect.getmodule(func)
+    sources = {}
+    to_visit = [func]
+    seen = set()
+
+    def project_module(obj):
+        module = obj if inspect.ismodule(obj) else inspect.getmodule(obj)
+        path = getattr(module, '__file__', None)
+        if path is None or dirname(abspath(path)) != root:
+            return None
+        return module
+
+    while to_visit:
+        obj = to_visit.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        module = project_module(obj)
+        if module is None:
+            continue
+        if module is own_module and inspect.isfunction(obj):
+            sources[obj.__qualname__] = inspect.getsource(obj)
+            to_visit.extend(obj.__globals__[n] for n in _referenced_names(obj.__code__)
+                            if n in obj.__globals__)
+        elif module is not own_module and basename(module.__file__) not in sources:
+            with open(module.__file__) as f:
+                sources[basename(module.__file__)] = f.read()
+            to_visit.extend(vars(module).values())
+    return sources
+
+
+def _code_hash(func):
+    """
+    Hash of the code a step runs, see _code_sources, so changing the step or
+    the utils it calls invalidates its cache.
+    """
+    try:
+        sources = _code_sources(func)
+    except (OSError, TypeError):
+        sources = {'name': f'{func.__module__}.{func.__qualname__}'}
+    encoded = json.dumps(sources, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _safe_name(name):
+    """
+    Step name usable as a directory name.
+    """
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', name)
+
+
+def _execute(func, params, dep_paths, out_path, out_dir):
+    """
+    Run one step: load the outputs it depends on from the cache, call the
+    step function and write its output to the cache. Runs in a worker
+    process, so only paths are passed back and forth.
+    """
+    kwargs = dict(params)
+    for kwarg, paths in dep_paths.items():
+        if isinstance(paths, dict):
+            kwargs[kwarg] = {name: _load(p) for name, p in paths.items()}
+        else:
+            kwargs[kwarg] = _load(paths)
+    if out_dir is not None:
+        makedirs(out_dir, exist_ok=True)
+        kwargs['out_dir'] = out_dir
+    start = time.perf_counter()
+    output = func(**kwargs)
+    seconds = time.perf_counter() - start
+    makedirs(os.path.dirname(out_path), exist_ok=True)
+    # Write then rename, so an interrupted step never leaves a partial cache
+    # entry behind
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, out_path)
+    return seconds
+
+
+def _load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class Pipeline:
+    """
+    DAG of steps with a content-addressed output cache.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        parameters:
+            cache_dir, str: directory to cache step outputs in, created if it
+                doesn't exist
+        """
+        self.cache_dir = abspath(cache_dir)
+        self.steps = {}
+
+    def add(self, name, func, deps=None, params=None, files=(), stat_files=(),
+            writes_files=False, version=None):
+        """
+        Add a step.
+
+        parameters:
+            name, str: unique step name, e.g. 'annotate:1h_vs_7h_2o2'
+            func, function: module-level function to run, called with params
+                and the outputs of deps as keyword arguments
+            deps, dict: keys are keyword arguments of func, values are the
+                name of a step (func gets its output) or a list of step names
+                (func gets a dict of step name to output)
+            params, dict: keyword arguments for func, must be JSON
+                serializable
+            files, tuple of str: keys of params that are paths (or lists or
+                dicts of paths) to files or directories, hashed by content
+            stat_files, tuple of str: like files, but hashed by name, size
+                and modification time only
+            writes_files, bool: if True, func also gets an out_dir argument,
+                a directory in the cache unique to this step's key, to write
+                figures and tables to
+            version, str or int: optional, part of the cache key but not
+                passed to func, change it to re-run the step after changes
+                the cache key can't see (e.g. an updated external tool)
+
+        returns:
+            name, str: the step name, for use in deps of later steps
+        """
+        assert name not in self.steps, f'Step {name} was already added'
+        deps = dict(deps or {})
+        for dep in self._dep_names(deps):
+            assert dep in self.steps, f'Step {name} depends on unknown step {dep}'
+        self.steps[name] = {'func': func, 'deps': deps, 'params': dict(params or {}),
+                            'files': tuple(files), 'stat_files': tuple(stat_files),
+                            'writes_files': writes_files, 'version': version}
+        return name
+
+    @staticmethod
+    def _dep_names(deps):
+        names = []
+        for dep in deps.values():
+            names.extend([dep] if isinstance(dep, str) else dep)
+        return names
+
+    def _order(self, targets=None):
+        """
+        Steps needed for the targets, dependencies first.
+        """
+        targets = list(self.steps) if targets is None else list(targets)
+        order, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for dep in self._dep_names(self.steps[name]['deps']):
+                visit(dep)
+            order.append(name)
+
+        for target in targets:
+            assert target in self.steps, f'Unknown step {target}'
+            visit(target)
+        return order
+
+    def keys(self, targets=None):
+        """
+        Cache key of every step needed for the targets.
+
+        returns:
+            keys, dict: keys are step names, values are hex digests
+        """
+        keys = {}
+        for name in self._order(targets):
+            step = self.steps[name]
+            spec = {'name': name, 'code': _code_hash(step['func']),
+                    'version': step['version'], 'params': step['params'],
+                    'files': {p: _hash_paths(step['params'][p], True) for p in step['files']},
+                    'stat_files': {p: _hash_paths(step['params'][p], False)
+                                   for p in step['stat_files']},
+                    'deps': {kwarg: keys[dep] if isinstance(dep, str) else
+                             {d: keys[d] for d in dep}
+                             for kwarg, dep in sorted(step['deps'].items())}}
+            encoded = json.dumps(spec, sort_keys=True, default=str).encode()
+            keys[name] = hashlib.sha256(encoded).hexdigest()
+        return keys
+
+    def output_path(self, name, key):
+        return f'{self.cache_dir}/{_safe_name(name)}/{key}.pkl'
+
+    def output_dir(self, name, key):
+        return f'{self.cache_dir}/{_safe_name(name)}/{key}'
+
+    def load(self, name, keys=None):
+        """
+        Cached output of a step.
+        """
+        keys = keys or self.keys([name])
+        return _load(self.output_path(name, keys[name]))
+
+    def run(self, targets=None, n_jobs=None, force=(), dry_run=False):
+        """
+        Run the steps needed for the targets that aren't cached, each as
+        soon as the steps it depends on are done.
+
+        parameters:
+            targets, list of str: optional, steps to run (with their
+                dependencies), default is all steps
+            n_jobs, int: number of processes, default is the number of
+                cores. 1 runs every step in this process
+            force, list of str: steps to re-run even if they're cached
+            dry_run, bool: if True, only report what would run
+
+        returns:
+            keys, dict: keys are step names, values are cache keys, pass to
+                load to get the outputs
+        """
+        keys = self.keys(targets)
+        order = list(keys)
+        cached = {n for n in order if n not in set(force)
+                  and isfile(self.output_path(n, keys[n]))}
+        to_run = [n for n in order if n not in cached]
+        print(f'\n{len(order)} steps, {len(cached)} cached, {len(to_run)} to run')
+        if dry_run:
+            for name in order:
+                print(f'{"cached" if name in cached else "run":>8}  {name}')
+            return keys
+
+        done = set(cached)
+        if n_jobs == 1:
+            for name in to_run:
+                self._report(name, _execute(*self._task(name, keys)))
+            return keys
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            running = {}
+            while to_run or running:
+                ready = [n for n in to_run
+                         if all(d in done for d in self._dep_names(self.steps[n]['deps']))]
+                for name in ready:
+                    to_run.remove(name)
+                    running[executor.submit(_execute, *self._task(name, keys))] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        seconds = future.result()
+                    except Exception:
+                        print(f'\nStep {name} failed, stopping')
+                        executor.shutdown(cancel_futures=True)
+                        raise
+                    self._report(name, seconds)
+                    done.add(name)
+        return keys
+
+    def _task(self, name, keys):
+        """
+        Arguments to _execute for a step.
+        """
+        step = self.steps[name]
+        dep_paths = {kwarg: self.output_path(dep, keys[dep]) if isinstance(dep, str)
+                     else {d: self.output_path(d, keys[d]) for d in dep}
+                     for kwarg, dep in step['deps'].items()}
+        out_dir = self.output_dir(name, keys[name]) if step['writes_files'] else None
+        return (step['func'], step['params'], dep_paths,
+                self.output_path(name, keys[name]), out_dir)
+
+    @staticmethod
+    def _report(name, seconds):
+        print(f'Finished {name} in {seconds:.1f}s', flush=True)
@@ -4,111 +4,225 @@ Code to make an arrow table of opposite expression.
 Author: Serena G. Lotreck
 """
 import pandas as pd
-import matplotlib.patches as mpatches
+from matplotlib.collections import PolyCollection
+from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 import numpy as np
 
-def plot_opposite_expression(log2fc_df, cols_to_plot, gene_name_map=None,
-                             scale_factor=50, normalize=False, title=None, dark=False):
+
+def normalize_log2fc(log2fc_df, cols_to_plot):
     """
-    Plot arrows for opposite expression.
+    Normalize the columns to plot between -1 and 1, using the min and max
+    over all of them and ignoring NaN.
 
     parameters:
         log2fc_df, df: dataframe with log2FoldChange values to plot
         cols_to_plot, dict: keys are the semantic column header name
             to be used, values are the column names in log2fc_df
-        gene_name_map, dict: keys are TAIR locus ID's, values are some
-            semantic name to be added to the table
-        scale_factor, int: amount to multiply the normalized expression value
-            to determine arrow thickness
-        normalize, bool: whether or not to normalize between -1 and 1. Default
-            is False, assumes data has already been normalized
-        title, str: optional, string to use for the title
-        dark, bool: whether or not to use matplotlib dark background
 
-    returns: None
+    returns:
+        log2fc_df, df: copy with a <col>_NORMALIZED column for each column
+        cols_to_plot, dict: with values pointing to the normalized columns
     """
-    if dark:
-        plt.style.use('dark_background')
+    log2fc_df = log2fc_df.copy(deep=True)
+    all_exp = log2fc_df[list(cols_to_plot.values())].to_numpy(dtype=float)
+    if np.isnan(all_exp).all():
+        # Nothing to normalize, e.g. no rows
+        normalized = all_exp
     else:
-        plt.rcdefaults()
+        exp_min, exp_max = np.nanmin(all_exp), np.nanmax(all_exp)
+        normalized = 2*((all_exp - exp_min) / (exp_max - exp_min)) - 1
+    norm_cols = {sem_col: col + '_NORMALIZED' for sem_col, col in cols_to_plot.items()}
+    log2fc_df[list(norm_cols.values())] = normalized
 
-    # Normalize data if requested
-    if normalize:
-        cols_to_plot = dict(cols_to_plot)
-        log2fc_df = log2fc_df.copy(deep=True)
-        all_exp = log2fc_df[list(cols_to_plot.values())].to_numpy().flatten()
-        # Drop nan before getting min and max, for some reason this only causes problems some of the time
-        all_exp = [i for i in all_exp if not np.isnan(i)]
-        norm_denom = max(all_exp) - min(all_exp)
-        for sem_col, col in cols_to_plot.items():
-            log2fc_df.loc[:, col + '_NORMALIZED'] = 2*((log2fc_df[col] - min(all_exp)) / norm_denom) - 1
-            cols_to_plot[sem_col] = col + '_NORMALIZED'
-
-    fig, ax = plt.subplots(figsize=(8,6))
+    return log2fc_df, norm_cols
+
+
+def arrow_polygons(values, x, y, scale_factor, x_per_pt, y_per_pt):
+    """
+    Vertices of vertical arrows in data coordinates, matching the shape of a
+    FancyArrowPatch with the default 'simple' style. Arrows point up for
+    positive values and down otherwise, have a length of abs(value) and
+    are abs(value)*scale_factor points wide.
 
+    parameters:
+        values, array: values, NaN gives a zero-length arrow
+        x, array: x position of each arrow
+        y, array: y position of the center of each arrow
+        scale_factor, int: multiplied with abs(value) to get the mutation
+            scale in points
+        x_per_pt, float: data units per point along x
+        y_per_pt, float: data units per point along y
+
+    returns:
+        verts, array: shape (n, 7, 2), polygon for each arrow
+    """
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    size = np.abs(values)
+    direction = np.where(values > 0, 1.0, -1.0)
+    mutation = size*scale_factor
+    # The patch shrinks 2 points from each end. If what's left is shorter
+    # than the head, the head is kept whole and the tail collapses
+    length = np.maximum(size - 4*y_per_pt, 0)
+    head_length = 0.5*mutation*y_per_pt
+    half_head = 0.25*mutation*x_per_pt
+    half_tail = 0.1*mutation*x_per_pt
+    tip = y + direction*length/2
+    neck = tip - direction*head_length
+    start = np.where(length > head_length, y - direction*length/2, neck)
+    verts = np.stack([
+        np.column_stack([x - half_tail, start]),
+        np.column_stack([x - half_tail, neck]),
+        np.column_stack([x - half_head, neck]),
+        np.column_stack([x, tip]),
+        np.column_stack([x + half_head, neck]),
+        np.column_stack([x + half_tail, neck]),
+        np.column_stack([x + half_tail, start]),
+    ], axis=1)
+
+    return verts
+
+
+class ArrowCollection(PolyCollection):
+    """
+    Arrows from arrow_polygons, with their points-to-data scale taken from
+    the axes each time they're drawn, so they keep their shape if the
+    figure is resized after they're added.
+    """
+
+    def __init__(self, values, x, y, scale_factor, **kwargs):
+        """
+        parameters:
+            values, x, y, scale_factor: see arrow_polygons
+            **kwargs: passed to PolyCollection, e.g. facecolors
+        """
+        self._arrows = (values, x, y, scale_factor)
+        super().__init__([], **kwargs)
+
+    def draw(self, renderer):
+        bbox = self.axes.get_window_extent(renderer)
+        x_min, x_max = self.axes.get_xlim()
+        y_min, y_max = self.axes.get_ylim()
+        pts_per_px = 72/self.figure.dpi
+        x_per_pt = (x_max - x_min) / (bbox.width*pts_per_px)
+        y_per_pt = (y_max - y_min) / (bbox.height*pts_per_px)
+        self.set_verts(arrow_polygons(*self._arrows, x_per_pt, y_per_pt))
+        super().draw(renderer)
+
+
+def gene_labels(gene_ids, gene_name_map=None):
+    """
+    Row labels, with the semantic name in bold where there is one.
+    """
+    gene_ids = pd.Series(gene_ids, dtype=object).astype(str)
+    if gene_name_map is None:
+        return gene_ids.tolist()
+    names = gene_ids.map(gene_name_map)
+    return gene_ids.where(names.isna(),
+                          r"$\bf{" + names.astype(str) + "}$ (" + gene_ids + ')').tolist()
+
+
+def _draw_page(log2fc_df, cols_to_plot, labels, scale_factor, title):
+    """
+    Draw one arrow table figure for the rows of log2fc_df.
+    """
     rows = len(log2fc_df)
     cols = len(cols_to_plot) + 1
-    
+    # Keep the original size for short tables, and grow for long ones so
+    # rows don't overlap
+    fig, ax = plt.subplots(figsize=(8, max(6, 0.25*(rows + 2))))
+
     ax.set_ylim(-1, rows + 1)
     ax.set_xlim(0, cols + .5)
-    
-    for i, row in log2fc_df.iterrows():
-    
-        # Add gene name
-        if gene_name_map == None:
-            s = row.gene_id
-        else:
-            try:
-                s = r"$\bf{" + gene_name_map[row.gene_id] + "}$ (" + row.gene_id + ')'
-            except KeyError:
-                s = row.gene_id
+
+    # Add gene names, one per row in data coordinates so they stay on the
+    # same rows as the arrows
+    y = np.arange(rows)
+    for i, s in zip(y, labels):
         ax.text(x=0.5, y=i, s=s, verticalalignment='center')
-    
-        # Add arrows
-        for j, to_plot in enumerate(cols_to_plot.keys()):
-            
-            arrow_dir = 'up' if row[cols_to_plot[to_plot]] > 0 else 'down'
-            arrow_len = abs(row[cols_to_plot[to_plot]])
-            if np.isnan(arrow_len):
-                arrow_len = 0
-            if arrow_dir == 'up':
-                start_coords = (j + 2, i - 0.5*arrow_len)
-                end_coords = (j + 2, i + 0.5*arrow_len)
-                color = 'blue'
-            else:
-                start_coords = (j + 2, i + 0.5*arrow_len)
-                end_coords = (j + 2, i - 0.5*arrow_len)
-                color = 'red'
-            arrow = mpatches.FancyArrowPatch(start_coords, end_coords,
-                                         mutation_scale=abs(row[cols_to_plot[to_plot]])*scale_factor,
-                                         color=color)
-            ax.add_patch(arrow)
-    
+
+    # Add all arrows as one collection, sized in points like FancyArrowPatch
+    values = log2fc_df[list(cols_to_plot.values())].to_numpy(dtype=float)
+    xs = np.broadcast_to(np.arange(len(cols_to_plot)) + 2, values.shape).ravel()
+    ys = np.broadcast_to(y[:, None], values.shape).ravel()
+    values = values.ravel()
+    keep = np.nan_to_num(values) != 0
+    colors = np.where(values[keep] > 0, 'blue', 'red')
+    ax.add_collection(ArrowCollection(values[keep], xs[keep], ys[keep], scale_factor,
+                                      facecolors=colors, edgecolors=colors))
+
     # Add column headers
     ax.text(0.7, rows - 0.25, 'Gene', weight='bold', ha='center')
     for k, col in enumerate(cols_to_plot.keys()):
         ax.text(k + 2, rows - 0.25, col, weight='bold', ha='center')
-    
+
     # Add gridlines
-    for row in range(rows):
-        ax.plot(
-        	[0, cols + 1],
-        	[row -.5, row - .5],
-        	ls=':',
-        	lw='.5',
-        	c='grey'
-        )
+    ax.hlines(y - .5, 0, cols + 1, linestyles=':', lw=.5, colors='grey')
     ax.plot([0, cols + 1], [rows - 0.5, rows - 0.5], lw='.5', c='black')
-    
+
     # Turn of axes
     ax.axis('off')
 
     # Add title if requested
     if title is not None:
         ax.set_title(
-        	title,
-        	loc='center',
-        	fontsize=16,
-        	weight='bold'
-        )
\ No newline at end of file
+            title,
+            loc='center',
+            fontsize=16,
+            weight='bold'
+        )
+
+    return fig
+
+
+def plot_opposite_expression(log2fc_df, cols_to_plot, gene_name_map=None,
+                             scale_factor=50, normalize=False, title=None, dark=False,
+                             pdf_path=None, rows_per_page=40):
+    """
+    Plot arrows for opposite expression.
+
+    parameters:
+        log2fc_df, df: dataframe with log2FoldChange values to plot
+        cols_to_plot, dict: keys are the semantic column header name
+            to be used, values are the column names in log2fc_df
+        gene_name_map, dict: keys are TAIR locus ID's, values are some
+            semantic name to be added to the table
+        scale_factor, int: amount to multiply the normalized expression value
+            to determine arrow thickness
+        normalize, bool: whether or not to normalize between -1 and 1. Default
+            is False, assumes data has already been normalized
+        title, str: optional, string to use for the title
+        dark, bool: whether or not to use matplotlib dark background
+        pdf_path, str: optional, write the table to this multi-page PDF
+            with rows_per_page genes per page instead of making one figure.
+            Pages are written and closed one at a time
+        rows_per_page, int: number of genes per page when writing a PDF
+
+    returns: None
+    """
+    if dark:
+        plt.style.use('dark_background')
+    else:
+        plt.rcdefaults()
+
+    # Normalize data if requested, over all rows so pages are comparable
+    if normalize:
+        log2fc_df, cols_to_plot = normalize_log2fc(log2fc_df, cols_to_plot)
+
+    labels = gene_labels(log2fc_df['gene_id'], gene_name_map)
+
+    if pdf_path is None:
+        _draw_page(log2fc_df, cols_to_plot, labels, scale_factor, title)
+        return
+
+    n_pages = max(int(np.ceil(len(log2fc_df) / rows_per_page)), 1)
+    with PdfPages(pdf_path) as pdf:
+        for page in range(n_pages):
+            start = page*rows_per_page
+            page_title = title
+            if n_pages > 1:
+                page_title = f'{title} ({page + 1}/{n_pages})' if title else f'{page + 1}/{n_pages}'
+            fig = _draw_page(log2fc_df.iloc[start:start + rows_per_page], cols_to_plot,
+                             labels[start:start + rows_per_page], scale_factor, page_title)
+            pdf.savefig(fig, bbox_inches='tight')
+            plt.close(fig)
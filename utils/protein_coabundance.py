@@ -0,0 +1,291 @@
+"""
+Co-abundance of all proteins in the proteomics data with each other (or with
+a panel of proteins of interest), computed in blocks and saved to disk with
+a top-k neighbor index so "what co-varies with X" can be looked up without
+recomputing.
+
+Author: Serena G. Lotreck
+"""
+import re
+import json
+from os import cpu_count, makedirs
+from os.path import abspath
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from scipy.stats import t
+from multiple_testing import bh_fdr_blocks
+
+
+# Sample columns of the normalized intensity export, e.g. 21A or 2D. The
+# export also has numeric columns that aren't samples (#, Molecular Weight,
+# Std Dev(21A))
+SAMPLE_PATTERN = r'^\d+[A-Z]$'
+
+
+def intensity_matrix(intensity_df, sample_cols=None, id_col='base_accession_num',
+                     sample_pattern=SAMPLE_PATTERN):
+    """
+    Get a numeric proteins x samples matrix from the intensity table, with
+    'No data' (and anything else that isn't a number) as NaN.
+
+    parameters:
+        intensity_df, df: one row per protein
+        sample_cols, list of str: columns with the intensities, default is
+            the columns whose names match sample_pattern
+        id_col, str: name of the column with the protein IDs
+        sample_pattern, str: regex for the names of the sample columns when
+            sample_cols isn't given
+
+    returns:
+        matrix, df: proteins x samples float matrix indexed by id_col
+    """
+    if sample_cols is None:
+        sample_cols = [c for c in intensity_df.columns
+                       if c != id_col and re.match(sample_pattern, str(c))]
+        if not sample_cols:
+            raise ValueError(f'No columns match {sample_pattern}, pass sample_cols')
+    matrix = intensity_df.set_index(id_col)[sample_cols]
+    matrix = matrix.apply(pd.to_numeric, errors='coerce').astype(float)
+    # The same protein can be reported for more than one accession version
+    return matrix[~matrix.index.duplicated()]
+
+
+def pairwise_correlation(X, Y):
+    """
+    Pearson correlation between every row of X and every row of Y, using
+    only the samples observed in both rows.
+
+    parameters:
+        X, array: rows x samples, NaN for missing
+        Y, array: rows x samples, NaN for missing
+
+    returns:
+        r, array: rows of X x rows of Y correlations, NaN where fewer than 3
+            samples are shared or a row is constant
+        n, array: number of shared samples
+    """
+    mx, my = ~np.isnan(X), ~np.isnan(Y)
+    X, Y = np.where(mx, X, 0), np.where(my, Y, 0)
+    mx, my = mx.astype(float), my.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Center each row first, correlation doesn't change and the sums
+        # below lose less precision
+        X = np.where(mx > 0, X - np.nan_to_num(X.sum(1) / mx.sum(1))[:, None], 0)
+        Y = np.where(my > 0, Y - np.nan_to_num(Y.sum(1) / my.sum(1))[:, None], 0)
+        n = mx @ my.T
+        sx, sy = X @ my.T, mx @ Y.T
+        cov = X @ Y.T - sx*sy/n
+        var_x = (X**2) @ my.T - sx**2/n
+        var_y = mx @ (Y**2).T - sy**2/n
+        r = cov / np.sqrt(var_x*var_y)
+    r = np.where(n >= 3, np.clip(r, -1, 1), np.nan)
+    return r, n
+
+
+def correlation_pvalues(r, n):
+    """
+    Two-sided p-values for Pearson correlations, the same as f_regression
+    gives for a single regressor.
+    """
+    dF = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_value = np.abs(r)*np.sqrt(dF / (1 - r**2))
+        return np.where(dF > 0, 2*t.sf(t_value, dF), np.nan)
+
+
+def _top_k(values, indices, k):
+    """
+    Keep the k entries with the largest absolute value in each row, sorted
+    by decreasing absolute value, NaN last.
+    """
+    key = np.where(np.isnan(values), -1, np.abs(values))
+    if values.shape[1] > k:
+        keep = np.argpartition(-key, k - 1, axis=1)[:, :k]
+        values, indices, key = (np.take_along_axis(a, keep, axis=1)
+                                for a in (values, indices, key))
+    order = np.argsort(-key, axis=1, kind='stable')
+    return (np.take_along_axis(values, order, axis=1),
+            np.take_along_axis(indices, order, axis=1))
+
+
+def _correlation_rows(args):
+    """
+    Correlate one block of rows against all columns, one column block at a
+    time, writing into the memory-mapped outputs. Returns the top-k
+    neighbors of each row.
+    """
+    X, Y, start, stop, out_dir, block_size, top_k, self_cols = args
+    r_out = np.load(f'{out_dir}/r.npy', mmap_mode='r+')
+    p_out = np.load(f'{out_dir}/p.npy', mmap_mode='r+')
+    n_out = np.load(f'{out_dir}/n.npy', mmap_mode='r+')
+    rows = np.arange(start, stop)
+    best_r = np.full((len(rows), 0), np.nan)
+    best_i = np.zeros((len(rows), 0), dtype=np.int64)
+    for c_start in range(0, Y.shape[0], block_size):
+        c_stop = min(c_start + block_size, Y.shape[0])
+        r, n = pairwise_correlation(X[start:stop], Y[c_start:c_stop])
+        cols = np.arange(c_start, c_stop)
+        if self_cols is not None:
+            # A protein's correlation with itself isn't a neighbor
+            r_k = np.where(self_cols[cols][None, :] == rows[:, None], np.nan, r)
+        else:
+            r_k = r
+        r_out[start:stop, c_start:c_stop] = r
+        p_out[start:stop, c_start:c_stop] = correlation_pvalues(r, n)
+        n_out[start:stop, c_start:c_stop] = n
+        best_r, best_i = _top_k(np.hstack([best_r, r_k]),
+                                np.hstack([best_i, np.broadcast_to(cols, r.shape)]),
+                                top_k)
+    r_out.flush()
+    p_out.flush()
+    n_out.flush()
+    return start, best_r, best_i
+
+
+def _tested_mask(start, stop, positions, panel_cols):
+    """
+    Which entries in a block of rows are counted in the FDR correction. A
+    pair of panel proteins is in the matrix twice, once per direction, and
+    only counted in the row of the first of the two.
+    """
+    rows = np.arange(start, stop)
+    return (positions[None, :] > rows[:, None]) | (panel_cols[rows] < 0)[:, None]
+
+
+def build_coabundance_index(matrix, out_dir, panel=None, block_size=512, top_k=50,
+                            n_jobs=None, max_fdr_values=2**22):
+    """
+    Correlate every protein with every other protein (or with a panel of
+    proteins), in blocks across a process pool. Results are written to
+    memory-mapped .npy files in out_dir: r (correlation), p, q (Benjamini-
+    Hochberg FDR) and n (number of shared samples), plus a top-k neighbor
+    index by absolute correlation.
+
+    parameters:
+        matrix, df: proteins x samples, as returned by intensity_matrix
+        out_dir, str: directory to write the index to
+        panel, list of str: optional, IDs of proteins to correlate against,
+            default is all proteins
+        block_size, int: number of proteins per block, bounds memory use
+        top_k, int: number of neighbors to keep for each protein
+        n_jobs, int: number of processes, default is the number of cores
+        max_fdr_values, int: maximum number of p-values held in memory at
+            once for the FDR correction, see multiple_testing.bh_fdr_blocks
+
+    returns:
+        index, dict: see load_coabundance_index
+    """
+    out_dir = abspath(out_dir)
+    makedirs(out_dir, exist_ok=True)
+    proteins = [str(p) for p in matrix.index]
+    panel = proteins if panel is None else [p for p in dict.fromkeys(panel) if p in set(proteins)]
+    X = matrix.to_numpy(dtype=float)
+    Y = matrix.loc[panel].to_numpy(dtype=float)
+    # Row in X of each panel protein, to leave out self-correlations
+    positions = pd.Index(proteins).get_indexer(panel)
+    shape = (len(proteins), len(panel))
+    for name, dtype in [('r', np.float32), ('p', np.float64), ('q', np.float64),
+                        ('n', np.int32)]:
+        np.lib.format.open_memmap(f'{out_dir}/{name}.npy', mode='w+', dtype=dtype,
+                                  shape=shape).flush()
+
+    args = [(X, Y, start, min(start + block_size, len(proteins)), out_dir, block_size,
+             min(top_k, len(panel)), positions)
+            for start in range(0, len(proteins), block_size)]
+    best_r = np.full((len(proteins), min(top_k, len(panel))), np.nan, dtype=np.float32)
+    best_i = np.zeros(best_r.shape, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=n_jobs or cpu_count() or 1) as executor:
+        for start, r, i in executor.map(_correlation_rows, args):
+            best_r[start:start + len(r)] = r
+            best_i[start:start + len(r)] = i
+
+    # FDR over each distinct pair once: pairs of panel proteins are only
+    # counted in one direction (the upper triangle for all vs all), and
+    # self-correlations not at all
+    panel_cols = np.full(len(proteins), -1)
+    panel_cols[positions] = np.arange(len(panel))
+    p = np.load(f'{out_dir}/p.npy', mmap_mode='r')
+    q = np.load(f'{out_dir}/q.npy', mmap_mode='r+')
+    blocks = [(start, min(start + block_size, len(proteins)))
+              for start in range(0, len(proteins), block_size)]
+    bh_fdr_blocks(p, q, blocks,
+                  lambda start, stop: _tested_mask(start, stop, positions, panel_cols),
+                  max_fdr_values)
+    # Copy q to the other direction of each panel pair
+    for start, stop in blocks:
+        in_panel = np.flatnonzero(panel_cols[start:stop] >= 0)
+        if len(in_panel) == 0:
+            continue
+        rows = start + in_panel
+        q_block = np.asarray(q[start:stop]).copy()
+        mirrored = np.asarray(q[:, panel_cols[rows]])[positions].T
+        other = positions[None, :] < rows[:, None]
+        q_rows = q_block[in_panel]
+        q_rows[other] = mirrored[other]
+        q_block[in_panel] = q_rows
+        q[start:stop] = q_block
+    q.flush()
+    del p, q
+
+    np.save(f'{out_dir}/topk_r.npy', best_r)
+    np.save(f'{out_dir}/topk_index.npy', best_i)
+    with open(f'{out_dir}/proteins.json', 'w') as f:
+        json.dump({'proteins': proteins, 'panel': panel}, f)
+
+    return load_coabundance_index(out_dir)
+
+
+def load_coabundance_index(out_dir, mmap_mode='r'):
+    """
+    Open an index written by build_coabundance_index. The matrices are
+    memory-mapped, so only the rows that are used are read.
+
+    parameters:
+        out_dir, str: directory the index was written to
+        mmap_mode, str: passed to np.load
+
+    returns:
+        index, dict: with keys proteins and panel (Index of row and column
+            IDs), r, p, q and n (proteins x panel arrays), and topk_r and
+            topk_index (proteins x k, neighbors by decreasing absolute
+            correlation, as positions in panel)
+    """
+    out_dir = abspath(out_dir)
+    with open(f'{out_dir}/proteins.json') as f:
+        ids = json.load(f)
+    index = {'proteins': pd.Index(ids['proteins']), 'panel': pd.Index(ids['panel'])}
+    for name in ['r', 'p', 'q', 'n', 'topk_r', 'topk_index']:
+        index[name] = np.load(f'{out_dir}/{name}.npy', mmap_mode=mmap_mode)
+    return index
+
+
+def coabundant_proteins(index, protein, k=10, fdr=None):
+    """
+    The proteins that co-vary most strongly with one protein.
+
+    parameters:
+        index, dict: output of build_coabundance_index or
+            load_coabundance_index
+        protein, str: ID of the protein to look up
+        k, int: maximum number of neighbors to return, at most the top_k
+            the index was built with
+        fdr, float: optional, only return neighbors with q below this
+
+    returns:
+        neighbors, df: columns protein, r, p, q and n, by decreasing
+            absolute correlation
+    """
+    row = index['proteins'].get_loc(protein)
+    cols = np.asarray(index['topk_index'][row, :k])
+    cols = cols[~np.isnan(index['topk_r'][row, :k])]
+    neighbors = pd.DataFrame({
+        'protein': index['panel'][cols],
+        'r': np.asarray(index['r'][row, cols]),
+        'p': np.asarray(index['p'][row, cols]),
+        'q': np.asarray(index['q'][row, cols]),
+        'n': np.asarray(index['n'][row, cols])
+    })
+    if fdr is not None:
+        neighbors = neighbors[neighbors['q'] < fdr].reset_index(drop=True)
+    return neighbors
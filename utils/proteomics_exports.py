@@ -0,0 +1,207 @@
+"""
+Read the CSVs exported from the proteomics software (differential abundance
+tests and normalized intensities). The exports start with a block of
+metadata lines before the table, and use strings for censored and missing
+values ('< 0.0001', '--', 'No data'). This finds the table, converts the
+values to numbers and adds base accession numbers, and can cache the result
+as Parquet so it's only parsed once per file.
+
+Author: Serena G. Lotreck
+"""
+import re
+import csv
+import hashlib
+import json
+from os import makedirs
+from os.path import abspath, basename, isfile, splitext
+import pandas as pd
+import numpy as np
+
+
+# Version of the parsing below, part of the cache key so old caches aren't
+# reused after it changes
+_PARSER_VERSION = 2
+
+_CENSORED = re.compile(r'^\s*<\s*([0-9.]+(?:[eE][-+]?[0-9]+)?)\s*$')
+
+
+def find_header_row(path, marker='Accession Number', max_lines=1000):
+    """
+    Find the line the table starts on, i.e. the first line with a field equal
+    to marker.
+
+    parameters:
+        path, str: path to the export
+        marker, str: name of a column in the table
+        max_lines, int: number of lines to look through
+
+    returns:
+        skiprows, int: number of lines before the table header
+    """
+    with open(path, newline='', errors='replace') as f:
+        reader = csv.reader(f)
+        consumed = 0
+        for row in reader:
+            if marker in (field.strip() for field in row):
+                return consumed
+            consumed = reader.line_num
+            if consumed >= max_lines:
+                break
+    raise ValueError(f'No line with a {marker} column in the first {max_lines} '
+                     f'lines of {path}')
+
+
+def base_accession(accessions, lower=False):
+    """
+    Accession numbers without the isoform suffix, e.g. 'ATCG00490.1' ->
+    'ATCG00490'.
+
+    parameters:
+        accessions, Series: accession numbers
+        lower, bool: whether to also lower-case them, e.g. to match gene
+            IDs from the DESeq2 results
+
+    returns:
+        base, Series: base accession numbers
+    """
+    base = accessions.astype(str).str.replace(r'\..*', '', regex=True)
+    return base.str.lower() if lower else base
+
+
+def coerce_numeric(df, missing=('--',), censored_factor=0.9):
+    """
+    Convert every column that only has numbers, missing markers and censored
+    values (e.g. '< 0.0001') to float. Censored values become
+    censored_factor times their bound, so '< 0.0001' is 0.00009, and a
+    boolean <column>_censored column is added for each column that had any.
+
+    parameters:
+        df, df: table with string columns
+        missing, tuple of str: values to treat as NaN
+        censored_factor, float: what to multiply the bound of censored values
+            by
+
+    returns:
+        df, df: copy with numeric columns converted
+    """
+    df = df.copy()
+    for col in list(df.columns):
+        if pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        values = df[col].astype('string').str.strip()
+        values = values.mask(values.isin(missing))
+        bounds = values.str.extract(_CENSORED, expand=False)
+        is_censored = bounds.notna()
+        converted = pd.to_numeric(values.mask(is_censored, bounds), errors='coerce')
+        if converted.notna().sum() != values.notna().sum():
+            # Not a numeric column
+            continue
+        converted = converted.astype(float)
+        df[col] = np.where(is_censored, converted*censored_factor, converted)
+        if is_censored.any():
+            df[f'{col}_censored'] = is_censored.to_numpy(dtype=bool)
+    return df
+
+
+def parse_proteomics_export(path, marker='Accession Number', drop_no_data=True,
+                            missing=('--',), censored_factor=0.9,
+                            accession_col='Accession Number', lower_accessions=False):
+    """
+    Parse one export without caching.
+
+    parameters:
+        path, str: path to the export
+        marker, str: name of a column in the table, used to find the header
+        drop_no_data, bool: whether to drop rows with 'No data' in any column
+        missing, tuple of str: values to treat as NaN
+        censored_factor, float: see coerce_numeric
+        accession_col, str: column with the accession numbers, used for
+            base_accession_num. Rows without one (e.g. trailing notes) are
+            dropped
+        lower_accessions, bool: whether to lower-case base_accession_num,
+            see base_accession
+
+    returns:
+        export, df: the table with numeric columns as floats, plus
+            base_accession_num
+    """
+    skiprows = find_header_row(path, marker)
+    with open(path, newline='') as f:
+        # Skip physical lines, read_csv would count a quoted multi-line field
+        # in the metadata as one
+        for _ in range(skiprows):
+            f.readline()
+        df = pd.read_csv(f, dtype=str, keep_default_na=False, na_values=[''])
+    df = df.dropna(axis=1, how='all')
+    if accession_col in df.columns:
+        df = df[df[accession_col].notna()]
+    if drop_no_data:
+        df = df[~(df == 'No data').any(axis=1)]
+    df = coerce_numeric(df.reset_index(drop=True), missing, censored_factor)
+    if accession_col in df.columns:
+        df['base_accession_num'] = base_accession(df[accession_col], lower_accessions)
+    return df
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_proteomics_export(path, cache_dir=None, **kwargs):
+    """
+    Parse an export, or read it from the cache if the same file (by content)
+    was parsed before with the same options.
+
+    parameters:
+        path, str: path to the export
+        cache_dir, str: optional, directory to cache parsed exports in as
+            Parquet
+        **kwargs: passed to parse_proteomics_export
+
+    returns:
+        export, df: see parse_proteomics_export
+    """
+    path = abspath(path)
+    if cache_dir is None:
+        return parse_proteomics_export(path, **kwargs)
+
+    options = json.dumps(dict(kwargs, version=_PARSER_VERSION), sort_keys=True,
+                         default=list)
+    key = hashlib.sha256(f'{file_hash(path)}{options}'.encode()).hexdigest()[:16]
+    cache_dir = abspath(cache_dir)
+    cache_path = f'{cache_dir}/{splitext(basename(path))[0]}_{key}.parquet'
+    if isfile(cache_path):
+        return pd.read_parquet(cache_path, memory_map=True)
+
+    export = parse_proteomics_export(path, **kwargs)
+    makedirs(cache_dir, exist_ok=True)
+    export.to_parquet(cache_path, index=False)
+    return export
+
+
+def export_columns(export):
+    """
+    Find the fold change and p-value columns of a differential abundance
+    export, and the significance cutoff given in the p-value column name,
+    e.g. 'Permutation Test (p-value) Benjamini-Hochberg (p < 0.00290)'.
+
+    returns:
+        columns, dict: with keys lfc_name, pval_col_name (None if not found)
+            and pval_cutoff (None if not in the name)
+    """
+    lfc = [c for c in export.columns if 'Fold Change' in c and not c.endswith('_censored')]
+    pval = [c for c in export.columns if 'p-value' in c and not c.endswith('_censored')]
+    columns = {'lfc_name': lfc[0] if lfc else None,
+               'pval_col_name': pval[0] if pval else None, 'pval_cutoff': None}
+    if pval:
+        cutoff = re.search(r'p\s*<\s*([0-9.]+(?:[eE][-+]?[0-9]+)?)', pval[0])
+        if cutoff is not None:
+            columns['pval_cutoff'] = float(cutoff.group(1))
+    return columns
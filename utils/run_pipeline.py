@@ -0,0 +1,444 @@
+"""
+Run the analysis chain from the notebooks headlessly, as a cached pipeline:
+
+    samplesheet
+    DESeq2 outputs -> filtering -> per comparison annotation
+                                -> per comparison GO enrichment -> GO summary
+                                -> DEG figure
+                                -> opposite expression tables
+
+DESeq2 itself is run in R (transcriptomics.Rmd) on the nf-core/rnaseq
+outputs, so the pipeline starts again from its output CSVs. Steps are only
+re-run when their code, parameters, input files or upstream steps change,
+and the per comparison steps run in parallel. Final outputs are copied to
+out_loc.
+
+The config is a JSON file, paths are relative to the config's directory.
+Only deseq2_dir is required, a section being absent skips its steps:
+    {
+        "deseq2_dir": "deseq2_output",
+        "comparisons": ["1h_vs_7h_2o2", "1h_vs_7h_40o2", "1h_vs_7h_21o2"],
+        "samplesheet": {"data_dir": ["run_1", "run_2"],
+                        "semantic_names": "semantic_names.json",
+                        "skip_missing": true, "validate": false},
+        "filter": {"comparisons": ["1h_vs_7h_2o2", "1h_vs_7h_40o2"],
+                   "reference": "1h_vs_7h_21o2", "suffix": "_filtered"},
+        "semantic_names": {"1h_vs_7h_2o2_filtered": "1h vs 7h, 2% O2"},
+        "annotation": {"metadata_paths": {"araport": "Araport11_annotation.txt"},
+                       "gene2GO": "ATH_GO_GOSLIM.txt"},
+        "enrichment": {"method": "panther", "fdr_threshold": 0.05},
+        "deg_figure": {"gene_sets": "photosynth_sets.json",
+                       "gene_aliases": "gene_aliases_20241231.txt",
+                       "separate_columns": true},
+        "opposites": [{"comparisons": {"1h_vs_7h_2o2_filtered": "2o2",
+                                       "1h_vs_7h_40o2_filtered": "40o2"},
+                       "title": "Opposite expression, 2% vs 40% O2"}],
+        "versions": {"enrich": 2}
+    }
+gene_sets is a JSON file with keys sets (set name to list of genes) and
+colors (set name to color). enrichment method is panther (the PANTHER API,
+see PANTHER_QUERY) or local (local_GO_enrichment on the annotation gene2GO
+table). Step caches are keyed on the code of the utils each step uses;
+versions re-runs steps for changes outside the repo (e.g. a PANTHER data
+release), keyed by step name or by the part before ':' (e.g. enrich for
+every enrich:<comparison> step).
+
+Author: Serena G. Lotreck
+"""
+import json
+import shutil
+import argparse
+from os import listdir, makedirs
+from os.path import abspath, basename, dirname, isabs, splitext
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from pipeline import Pipeline
+import make_samplesheet
+import deseq2_store
+import comparison_sets
+import get_arabidopsis_descriptions as gad
+import GO_enrichment_API_functions as go_api
+import local_GO_enrichment
+import make_DEG_figure
+import plot_opposite_expression as poe
+
+
+PANTHER_QUERY = ('https://pantherdb.org/services/oai/pantherdb/enrich/overrep?'
+                 'geneInputList={genes}&organism=3702&annotDataSet={aspect}'
+                 '&enrichmentTestType=FISHER&correction=FDR')
+PANTHER_ASPECTS = {'biological_process': 'GO:0008150',
+                   'molecular_function': 'GO:0003674',
+                   'cellular_component': 'GO:0005575'}
+
+
+def read_table(path):
+    """
+    Read a tab-separated (.txt, .tsv) or comma-separated table.
+    """
+    sep = '\t' if splitext(path)[1] in ('.txt', '.tsv') else ','
+    return pd.read_csv(path, sep=sep)
+
+
+def step_samplesheet(data_dir, semantic_names, skip_missing, validate, out_dir):
+    """
+    Make the nf-core/rnaseq samplesheet.
+
+    returns:
+        paths, list of str: the samplesheet
+    """
+    make_samplesheet.main(data_dir, semantic_names, skip_missing, out_dir, validate)
+    return [f'{out_dir}/samplesheet.csv']
+
+
+def step_deseq2(deseq2_dir, comparisons, out_dir):
+    """
+    Read the DESeq2 outputs through a columnar store.
+
+    returns:
+        deg_dfs, dict: keys are comparison names, values are dfs
+    """
+    store_path = f'{out_dir}/deseq2.parquet'
+    deseq2_store.build_deseq2_store(deseq2_dir, store_path)
+    return deseq2_store.comparison_frames(store_path, comparisons=comparisons)
+
+
+def step_filter(deg_dfs, comparisons, reference, suffix, padj_col, alpha):
+    """
+    Drop the genes that change in the same direction in a reference
+    comparison, see comparison_sets.filter_concordant.
+
+    returns:
+        degs, dict: with keys deg_dfs (every comparison, filtered ones
+            included, keeping the DESeq2 columns) and bitsets (output of
+            comparison_sets.build_comparison_bitsets)
+    """
+    bitsets = comparison_sets.build_comparison_bitsets(deg_dfs, padj_col=padj_col,
+                                                       alpha=alpha)
+    if comparisons:
+        bitsets = comparison_sets.filter_concordant(bitsets, comparisons, reference,
+                                                    suffix)
+    filtered = {}
+    for comp in bitsets['comparisons']:
+        source = comp[:-len(suffix)] if comp not in deg_dfs else comp
+        genes = comparison_sets.genes_in(bitsets, comp)
+        df = deg_dfs[source]
+        filtered[comp] = df[df['gene_id'].isin(genes)].reset_index(drop=True)
+    return {'deg_dfs': filtered, 'bitsets': bitsets}
+
+
+def step_gene2GO(gene2GO):
+    """
+    Read the gene to GO term table.
+    """
+    return read_table(gene2GO)
+
+
+def step_annotation_store(metadata_paths, out_dir):
+    """
+    Parse the annotation files once into a store for the annotate steps.
+
+    returns:
+        store_path, str
+    """
+    store_path = f'{out_dir}/annotation.feather'
+    gad.build_annotation_store(metadata_paths, store_path)
+    return store_path
+
+
+def step_annotate(degs, comparison, store_path, out_dir, gene2GO=None):
+    """
+    Get the descriptions of the genes in one comparison.
+
+    returns:
+        paths, list of str: the descriptions CSV
+    """
+    genes = degs['deg_dfs'][comparison]['gene_id'].tolist()
+    gene_df = gad.get_arabidopsis_descriptions(genes, gene2GO=gene2GO,
+                                               store_path=store_path)
+    path = f'{out_dir}/{comparison}_descriptions.csv'
+    gene_df.to_csv(path)
+    return [path]
+
+
+def step_panther(degs, comparison, query, aspects, max_workers):
+    """
+    PANTHER enrichment of the genes in one comparison.
+
+    returns:
+        enrichment, dict: keys are aspects, values are PANTHER results
+    """
+    genes = ','.join(degs['deg_dfs'][comparison]['gene_id'])
+    queries = {comparison: {aspect: query.format(genes=genes, aspect=annot)
+                            for aspect, annot in aspects.items()}}
+    return go_api.getPANTHERbatch(queries, max_workers=max_workers)[comparison]
+
+
+def step_local_enrichment(degs, comparison, gene2GO, aspect_col):
+    """
+    Local GO enrichment of the genes in one comparison.
+
+    returns:
+        enrichment, dict: keys are aspects, values are PANTHER-style results
+    """
+    genes = degs['deg_dfs'][comparison]['gene_id'].tolist()
+    return local_GO_enrichment.local_GO_enrichment({comparison: genes}, gene2GO,
+                                                   aspect_col=aspect_col)[comparison]
+
+
+def step_go_summary(enrichments, degs, semantic_names, fdr_threshold, out_dir):
+    """
+    Summarize the enriched terms of every comparison.
+
+    returns:
+        paths, list of str: enriched terms and the term to gene table
+    """
+    enrichments = {name.split(':', 1)[1]: res for name, res in enrichments.items()}
+    data = {comp: degs['deg_dfs'][comp]['gene_id'].tolist() for comp in enrichments}
+    conditions_semantic = {comp: semantic_names.get(comp, comp) for comp in enrichments}
+    go_results, gene_go = go_api.processGOenrichments(enrichments, data,
+                                                      conditions_semantic,
+                                                      fdr_threshold, long_form=True)
+    paths = [f'{out_dir}/GO_enrichment.csv', f'{out_dir}/GO_enrichment_genes.csv']
+    go_results.to_csv(paths[0])
+    gene_go.to_csv(paths[1], index=False)
+    return paths
+
+
+def step_gene_names(gene_aliases):
+    """
+    Gene symbols keyed by lower-cased TAIR ID, like tair2gene in the
+    notebooks.
+    """
+    ara = pd.read_csv(gene_aliases, sep='\t', header=0, encoding='Windows-1252')
+    return {k.lower(): v for k, v in
+            ara.set_index('locus_name')['symbol'].to_dict().items()}
+
+
+def step_deg_figure(degs, tair2gene, comparisons, gene_sets, semantic_names,
+                    figure_kwargs, out_dir):
+    """
+    Stacked expression figure of the gene sets.
+
+    returns:
+        paths, list of str: the figure
+    """
+    with open(gene_sets) as f:
+        sets = json.load(f)
+    deg_dfs = {comp: degs['deg_dfs'][comp] for comp in comparisons}
+    names = {comp: semantic_names.get(comp, comp) for comp in comparisons}
+    make_DEG_figure.makeDEGfigure(deg_dfs, sets['sets'], sets['colors'], names,
+                                  tair2gene, **figure_kwargs)
+    path = f'{out_dir}/degs_expression.png'
+    plt.savefig(path, format='png', dpi=600, bbox_inches='tight')
+    plt.close('all')
+    return [path]
+
+
+def step_opposites(degs, tair2gene, comparisons, title, normalize, out_dir):
+    """
+    Table of the genes that change in opposite directions in two
+    comparisons.
+
+    returns:
+        paths, list of str: the genes and their log2 fold changes, and the
+            arrow table PDF if there are any genes
+    """
+    opposites = comparison_sets.opposite_table(degs['bitsets'], comparisons)
+    name = '_'.join(comparisons.values())
+    paths = [f'{out_dir}/opposites_{name}.csv', f'{out_dir}/opposites_{name}.pdf']
+    opposites.to_csv(paths[0], index=False)
+    if opposites.empty:
+        print(f'No genes change in opposite directions in {name}, skipping the plot')
+        return paths[:1]
+    cols_to_plot = {suffix: f'log2FoldChange_{suffix}' for suffix in comparisons.values()}
+    gene_name_map = {g: tair2gene[g.lower()] for g in opposites['gene_id']
+                     if g.lower() in tair2gene}
+    poe.plot_opposite_expression(opposites, cols_to_plot,
+                                 gene_name_map=gene_name_map, normalize=normalize,
+                                 title=title, pdf_path=paths[1])
+    return paths
+
+
+def _resolve(path, base):
+    """
+    Make paths in the config relative to the config's directory absolute.
+    """
+    if isinstance(path, dict):
+        return {k: _resolve(v, base) for k, v in path.items()}
+    if isinstance(path, list):
+        return [_resolve(p, base) for p in path]
+    if not path or isabs(path):
+        return path
+    return abspath(f'{base}/{path}')
+
+
+def build_pipeline(config, base, cache_dir):
+    """
+    Declare the steps for a config.
+
+    parameters:
+        config, dict: see module docstring
+        base, str: directory the config's paths are relative to
+        cache_dir, str: directory to cache step outputs in
+
+    returns:
+        pipe, Pipeline
+    """
+    pipe = Pipeline(cache_dir)
+    versions = config.get('versions', {})
+
+    def add(name, func, **kwargs):
+        # Steps can be versioned by name, or all steps of a kind by the part
+        # of the name before ':', e.g. enrich
+        version = versions.get(name, versions.get(name.split(':')[0]))
+        return pipe.add(name, func, version=version, **kwargs)
+
+    semantic_names = config.get('semantic_names', {})
+
+    if 'samplesheet' in config:
+        sheet = config['samplesheet']
+        params = {'data_dir': _resolve(sheet['data_dir'], base),
+                  'semantic_names': _resolve(sheet.get('semantic_names', ''), base),
+                  'skip_missing': sheet.get('skip_missing', False),
+                  'validate': sheet.get('validate', False)}
+        add('samplesheet', step_samplesheet, params=params,
+            files=('semantic_names',) if params['semantic_names'] else (),
+            stat_files=('data_dir',), writes_files=True)
+
+    deseq2_dir = _resolve(config['deseq2_dir'], base)
+    comparisons = config.get('comparisons')
+    if comparisons is None:
+        parsed = [deseq2_store.parse_comparison_name(f) for f in sorted(listdir(deseq2_dir))
+                  if splitext(f)[1] == '.csv']
+        comparisons = [p['comparison'] for p in parsed if p['comparison_type'] is not None]
+    add('deseq2', step_deseq2, params={'deseq2_dir': deseq2_dir,
+                                       'comparisons': comparisons},
+        files=('deseq2_dir',), writes_files=True)
+
+    filt = config.get('filter', {})
+    suffix = filt.get('suffix', '_filtered')
+    add('filter', step_filter, deps={'deg_dfs': 'deseq2'},
+        params={'comparisons': filt.get('comparisons', []),
+                'reference': filt.get('reference'), 'suffix': suffix,
+                'padj_col': filt.get('padj_col'), 'alpha': filt.get('alpha', 0.05)})
+    analyzed = comparisons + [c + suffix for c in filt.get('comparisons', [])]
+
+    annotation = config.get('annotation', {})
+    if annotation.get('gene2GO'):
+        add('gene2GO', step_gene2GO,
+            params={'gene2GO': _resolve(annotation['gene2GO'], base)},
+            files=('gene2GO',))
+    if 'metadata_paths' in annotation:
+        add('annotation_store', step_annotation_store,
+            params={'metadata_paths': _resolve(annotation['metadata_paths'], base)},
+            files=('metadata_paths',), writes_files=True)
+        for comp in analyzed:
+            deps = {'degs': 'filter', 'store_path': 'annotation_store'}
+            if 'gene2GO' in pipe.steps:
+                deps['gene2GO'] = 'gene2GO'
+            add(f'annotate:{comp}', step_annotate, deps=deps,
+                params={'comparison': comp}, writes_files=True)
+
+    if 'enrichment' in config:
+        enrichment = config['enrichment']
+        for comp in analyzed:
+            if enrichment.get('method', 'panther') == 'local':
+                assert 'gene2GO' in pipe.steps, 'Local enrichment needs annotation gene2GO'
+                add(f'enrich:{comp}', step_local_enrichment,
+                    deps={'degs': 'filter', 'gene2GO': 'gene2GO'},
+                    params={'comparison': comp,
+                            'aspect_col': enrichment.get('aspect_col')})
+            else:
+                add(f'enrich:{comp}', step_panther, deps={'degs': 'filter'},
+                    params={'comparison': comp,
+                            'query': enrichment.get('query', PANTHER_QUERY),
+                            'aspects': enrichment.get('aspects', PANTHER_ASPECTS),
+                            'max_workers': enrichment.get('max_workers', 3)})
+        add('go_summary', step_go_summary,
+            deps={'enrichments': [f'enrich:{comp}' for comp in analyzed],
+                  'degs': 'filter'},
+            params={'semantic_names': semantic_names,
+                    'fdr_threshold': enrichment.get('fdr_threshold', 0.05)},
+            writes_files=True)
+
+    figure = dict(config.get('deg_figure', {}))
+    if figure or 'opposites' in config:
+        aliases = figure.pop('gene_aliases', config.get('gene_aliases'))
+        add('gene_names', step_gene_names,
+            params={'gene_aliases': _resolve(aliases, base)}, files=('gene_aliases',))
+    if figure:
+        add('deg_figure', step_deg_figure,
+            deps={'degs': 'filter', 'tair2gene': 'gene_names'},
+            params={'comparisons': figure.pop('comparisons', analyzed),
+                    'gene_sets': _resolve(figure.pop('gene_sets'), base),
+                    'semantic_names': semantic_names,
+                    'figure_kwargs': dict({'show_all_x': False}, **figure)},
+            files=('gene_sets',), writes_files=True)
+    for pair in config.get('opposites', []):
+        name = '_'.join(pair['comparisons'].values())
+        add(f'opposites:{name}', step_opposites,
+            deps={'degs': 'filter', 'tair2gene': 'gene_names'},
+            params={'comparisons': pair['comparisons'], 'title': pair.get('title'),
+                    'normalize': pair.get('normalize', True)},
+            writes_files=True)
+
+    return pipe
+
+
+def main(config_path, cache_dir, out_loc, n_jobs=None, targets=None, force=(),
+         dry_run=False):
+
+    print('\nReading config...')
+    with open(config_path) as f:
+        config = json.load(f)
+    base = dirname(abspath(config_path))
+    pipe = build_pipeline(config, base, cache_dir)
+
+    print('\nRunning pipeline...')
+    keys = pipe.run(targets, n_jobs=n_jobs, force=force, dry_run=dry_run)
+    if dry_run:
+        return
+
+    # Copy the tables and figures the steps wrote to the output directory,
+    # intermediate stores stay in the cache
+    print(f'\nCopying outputs to {out_loc}...')
+    makedirs(out_loc, exist_ok=True)
+    for name in keys:
+        if pipe.steps[name]['writes_files']:
+            output = pipe.load(name, keys)
+            if isinstance(output, list):
+                for path in output:
+                    shutil.copy2(path, f'{out_loc}/{basename(path)}')
+
+    print('\nDone!')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run the analysis pipeline')
+
+    parser.add_argument('config', type=str,
+            help='Path to the pipeline config JSON')
+    parser.add_argument('out_loc', type=str,
+            help='Path to save the final outputs')
+    parser.add_argument('-cache_dir', type=str, default='.pipeline_cache',
+            help='Directory to cache step outputs in')
+    parser.add_argument('-n_jobs', type=int, default=None,
+            help='Number of processes, default is the number of cores')
+    parser.add_argument('-targets', nargs='+', default=None,
+            help='Steps to run with their dependencies, default is all steps')
+    parser.add_argument('-force', nargs='+', default=[],
+            help='Steps to re-run even if they are cached')
+    parser.add_argument('--dry_run', action='store_true',
+            help='Only list the steps and whether they are cached')
+
+    args = parser.parse_args()
+
+    args.config = abspath(args.config)
+    args.out_loc = abspath(args.out_loc)
+    args.cache_dir = abspath(args.cache_dir)
+
+    main(args.config, args.cache_dir, args.out_loc, args.n_jobs, args.targets,
+         args.force, args.dry_run)
@@ -0,0 +1,167 @@
+"""
+Subsample the paired read files in a samplesheet for a quick pilot run of the
+nf-core/rnaseq pipeline, and write a matching pilot samplesheet.
+
+Author: Serena G. Lotreck
+"""
+import argparse
+import gzip
+import random
+from os import makedirs
+from os.path import abspath, basename
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+
+def read_record(f):
+    """
+    Read one FASTQ record (four lines) from an open file, or None at the end
+    of the file.
+    """
+    record = [f.readline() for _ in range(4)]
+    if not record[0]:
+        return None
+    return record
+
+
+def _check_outputs(inputs, outputs):
+    """
+    Raise if an output would overwrite an input, which would truncate it
+    before it's read.
+    """
+    overwritten = sorted({abspath(o) for o in outputs} & {abspath(i) for i in inputs})
+    if overwritten:
+        raise ValueError(f'Output would overwrite input file(s) {overwritten}, '
+                         'use a different out_loc')
+
+
+def subsample_pair(fastq_1, fastq_2, out_1, out_2, fraction=None, n_reads=None,
+                   seed=None):
+    """
+    Subsample read pairs from R1 and R2 in lockstep in a single pass, so
+    that mates stay together. Either keeps each pair with probability
+    fraction (constant memory), or a uniform random n_reads pairs with
+    reservoir sampling (memory bounded by n_reads).
+
+    parameters:
+        fastq_1, str: path to the R1 fastq.gz
+        fastq_2, str: path to the R2 fastq.gz
+        out_1, str: path to write subsampled R1 to
+        out_2, str: path to write subsampled R2 to
+        fraction, float: fraction of read pairs to keep
+        n_reads, int: number of read pairs to keep
+        seed, str or int: seed for the random number generator, output is
+            the same for the same seed and input
+
+    returns:
+        n_kept, int: number of read pairs written
+        n_total, int: number of read pairs in the input
+    """
+    if (fraction is None) == (n_reads is None):
+        raise ValueError('Provide exactly one of fraction or n_reads')
+    _check_outputs([fastq_1, fastq_2], [out_1, out_2])
+    rng = random.Random(seed)
+    n_total = 0
+    n_kept = 0
+    reservoir = []
+    # mtime=0 keeps the gzip header, and so the output, reproducible
+    with gzip.open(fastq_1, 'rb') as in_1, gzip.open(fastq_2, 'rb') as in_2, \
+            gzip.GzipFile(out_1, 'wb', compresslevel=4, mtime=0) as w_1, \
+            gzip.GzipFile(out_2, 'wb', compresslevel=4, mtime=0) as w_2:
+        while True:
+            rec_1, rec_2 = read_record(in_1), read_record(in_2)
+            if rec_1 is None or rec_2 is None:
+                if rec_1 is not None or rec_2 is not None:
+                    raise ValueError(
+                        f'{fastq_1} and {fastq_2} have different numbers of reads')
+                break
+            if fraction is not None:
+                if rng.random() < fraction:
+                    w_1.writelines(rec_1)
+                    w_2.writelines(rec_2)
+                    n_kept += 1
+            elif n_total < n_reads:
+                reservoir.append((n_total, rec_1, rec_2))
+            else:
+                j = rng.randrange(n_total + 1)
+                if j < n_reads:
+                    reservoir[j] = (n_total, rec_1, rec_2)
+            n_total += 1
+        # Write reservoir samples in their original order
+        for _, rec_1, rec_2 in sorted(reservoir, key=lambda r: r[0]):
+            w_1.writelines(rec_1)
+            w_2.writelines(rec_2)
+            n_kept += 1
+
+    return n_kept, n_total
+
+
+def _subsample_pair(args):
+    """
+    Unpack arguments for the process pool.
+    """
+    return subsample_pair(*args)
+
+
+def main(samplesheet, out_loc, fraction=None, n_reads=None, seed=0, n_jobs=None):
+
+    print('\nReading in samplesheet...')
+    samplesheet_df = pd.read_csv(samplesheet)
+    makedirs(out_loc, exist_ok=True)
+
+    # Each file pair gets its own seed from the global seed and its name, so
+    # output doesn't depend on which process handles it
+    print('\nSubsampling reads...')
+    jobs = []
+    seen = set()
+    for i, (fastq_1, fastq_2) in enumerate(zip(samplesheet_df['fastq_1'],
+                                               samplesheet_df['fastq_2'])):
+        # Files from different runs can share a name
+        prefix = f'{i}_' if basename(fastq_1) in seen else ''
+        seen.add(basename(fastq_1))
+        out_1 = f'{out_loc}/{prefix}{basename(fastq_1)}'
+        out_2 = f'{out_loc}/{prefix}{basename(fastq_2)}'
+        jobs.append((fastq_1, fastq_2, out_1, out_2, fraction, n_reads,
+                     f'{seed}-{prefix}{basename(fastq_1)}'))
+    _check_outputs([p for j in jobs for p in j[:2]], [p for j in jobs for p in j[2:4]])
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(_subsample_pair, jobs))
+
+    # Make pilot samplesheet
+    print('\nMaking pilot samplesheet...')
+    pilot_df = pd.DataFrame({
+        'sample': samplesheet_df['sample'],
+        'fastq_1': [j[2] for j in jobs],
+        'fastq_2': [j[3] for j in jobs],
+        'strandedness': samplesheet_df['strandedness']
+    })
+    for samp, (n_kept, n_total) in zip(pilot_df['sample'], results):
+        print(f'{samp}: kept {n_kept} of {n_total} read pairs')
+
+    # Save
+    print(f'\nSaving as {out_loc}/pilot_samplesheet.csv...')
+    pilot_df.to_csv(f'{out_loc}/pilot_samplesheet.csv', index=False)
+    print('\nDone!')
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Subsample reads for a pilot run')
+
+    parser.add_argument('samplesheet', type=abspath,
+            help='Samplesheet made by make_samplesheet.py')
+    parser.add_argument('out_loc', type=abspath,
+            help='Where to write the subsampled files and pilot samplesheet')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-fraction', type=float,
+            help='Fraction of read pairs to keep')
+    group.add_argument('-n_reads', type=int,
+            help='Number of read pairs to keep from each sample')
+    parser.add_argument('-seed', type=int, default=0,
+            help='Random seed, the same seed gives the same output')
+    parser.add_argument('-n_jobs', type=int, default=None,
+            help='Number of processes to use, default is the number of cores')
+
+    args = parser.parse_args()
+
+    main(args.samplesheet, args.out_loc, args.fraction, args.n_reads, args.seed,
+            args.n_jobs)
@@ -0,0 +1,272 @@
+"""
+Test whether curves (e.g. photosynthetic measurements over time) differ
+between conditions using the method described in:
+
+Hristova, Kalina, and William C. Wimley. "Determining the statistical
+significance of the difference between arbitrary curves: A spreadsheet
+method." Plos one 18.10 (2023): e0289619.
+https://pmc.ncbi.nlm.nih.gov/articles/PMC10617697/
+
+Summary statistics are computed once, and every condition pair, measurement
+and time window is tested in one array computation.
+
+Author: Serena G. Lotreck
+"""
+from os import cpu_count
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from scipy.stats import t
+from scipy.stats.distributions import chi2
+
+
+def curve_summary(curves, x, measurements, condition):
+    """
+    Per condition and x value count, mean and standard error of every
+    measurement, from a single groupby.
+
+    parameters:
+        curves, df: one row per sample, with columns for x, the condition and
+            the measurements
+        x, str: name of the df column specifying the x variable
+        measurements, list of str: column names for y-values
+        condition, str: name of the column specifying the conditions
+
+    returns:
+        summary, dict: with keys conditions and x (sorted unique values),
+            and count, mean and sem, arrays of shape conditions x x values x
+            measurements. Missing combinations have a count of 0 and NaN
+            mean and sem
+    """
+    stats = curves.groupby([condition, x])[list(measurements)].agg(['count', 'mean', 'sem'])
+    conditions = np.sort(curves[condition].dropna().unique())
+    x_vals = np.sort(curves[x].dropna().unique())
+    stats = stats.reindex(pd.MultiIndex.from_product([conditions, x_vals]))
+    shape = (len(conditions), len(x_vals), len(measurements))
+    summary = {'conditions': conditions, 'x': x_vals}
+    for stat in ['count', 'mean', 'sem']:
+        values = stats.xs(stat, axis=1, level=1)[list(measurements)].to_numpy(dtype=float)
+        summary[stat] = values.reshape(shape)
+    summary['count'] = np.nan_to_num(summary['count'])
+
+    return summary
+
+
+def window_masks(x_vals, windows=None):
+    """
+    Boolean mask over x values for each window.
+
+    parameters:
+        x_vals, array: sorted x values
+        windows, dict: keys are window names, values are (start, stop)
+            tuples, a window includes x values with start <= x < stop.
+            Either can be None for no bound. Default is one window 'all'
+
+    returns:
+        names, list of str: window names
+        masks, array: windows x x values
+    """
+    windows = windows or {'all': (None, None)}
+    masks = np.ones((len(windows), len(x_vals)), dtype=bool)
+    for i, (start, stop) in enumerate(windows.values()):
+        if start is not None:
+            masks[i] &= x_vals >= start
+        if stop is not None:
+            masks[i] &= x_vals < stop
+    return list(windows.keys()), masks
+
+
+def chi2_terms(count_1, mean_1, sem_1, count_2, mean_2, sem_2):
+    """
+    Per-point chi-squared values for the difference between two curves,
+    elementwise over arrays of any (broadcastable) shape.
+
+    returns:
+        terms, array: chi-squared value (1 degree of freedom) of each point,
+            0 where the point isn't in both curves
+        valid, array: whether the point is in both curves
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        difference = np.abs(mean_1 - mean_2)
+        se_difference = np.sqrt(sem_1**2 + sem_2**2)
+        t_value = difference / se_difference
+        dF = 2*np.minimum(count_1, count_2) - 2
+        prob = 2*t.sf(t_value, dF)
+        terms = chi2.isf(prob, 1)
+    valid = (count_1 > 0) & (count_2 > 0)
+    # NaN points (e.g. a single sample) add nothing to the sum but still
+    # count towards the degrees of freedom
+    terms = np.where(valid & ~np.isnan(terms), terms, 0)
+    return terms, valid
+
+
+def _pair_statistics(summary, pairs, masks):
+    """
+    Summed chi-squared values and degrees of freedom for every pair,
+    measurement and window.
+
+    returns:
+        sum_chi2, array: pairs x measurements x windows
+        chi2_df, array: pairs x measurements x windows
+    """
+    i, j = np.array(pairs).T
+    # Pairs x measurements x x values
+    stats = [np.moveaxis(summary[s][idx], 1, 2) for idx in (i, j)
+             for s in ('count', 'mean', 'sem')]
+    terms, valid = chi2_terms(*stats)
+    return terms @ masks.T.astype(float), valid.astype(float) @ masks.T.astype(float)
+
+
+def _group_stats(group, values, n_groups):
+    """
+    Count, mean and standard error of each column of values for each group,
+    ignoring NaN. Resample batches are handled by offsetting the group
+    numbers of each batch.
+    """
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0)
+    shape = (n_groups, values.shape[1])
+    count = np.empty(shape)
+    mean = np.empty(shape)
+    sem = np.empty(shape)
+    for m in range(values.shape[1]):
+        count[:, m] = np.bincount(group, weights=valid[:, m], minlength=n_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean[:, m] = np.bincount(group, weights=filled[:, m], minlength=n_groups) / count[:, m]
+            sq_dev = np.where(valid[:, m], (values[:, m] - mean[group, m])**2, 0)
+            var = np.bincount(group, weights=sq_dev, minlength=n_groups) / (count[:, m] - 1)
+            sem[:, m] = np.sqrt(var / count[:, m])
+    return count, mean, sem
+
+
+def _resample_chunk(args):
+    """
+    Count how many resampled datasets give a summed chi-squared at least as
+    large as the observed one, for one chunk of resamples.
+    """
+    (x_idx, cond_idx, values, pairs, masks, n_x, obs, n_resamples, seed,
+     method, batch_size) = args
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(obs.shape, dtype=np.int64)
+    mask_t = masks.T.astype(float)
+    for p, (a, b) in enumerate(pairs):
+        sel = (cond_idx == a) | (cond_idx == b)
+        xi, side, y = x_idx[sel], (cond_idx[sel] == b).astype(np.int64), values[sel]
+        # Sort samples into (x, condition) cells
+        order = np.lexsort((side, xi))
+        xi, side, y = xi[order], side[order], y[order]
+        cell = xi*2 + side
+        n = len(xi)
+        if method == 'bootstrap':
+            # Impose the null by shifting both conditions to the pooled mean
+            # at each x, then resample with replacement within each cell
+            _, cell_mean, _ = _group_stats(cell, y, n_x*2)
+            _, pooled_mean, _ = _group_stats(xi, y, n_x)
+            y = y - cell_mean[cell] + pooled_mean[xi]
+            cell_size = np.bincount(cell, minlength=n_x*2)
+            cell_start = np.cumsum(cell_size) - cell_size
+        done = 0
+        while done < n_resamples:
+            B = min(batch_size, n_resamples - done)
+            if method == 'permutation':
+                # Shuffle condition labels among the samples at each x
+                shuffled = np.lexsort((rng.random((B, n)), np.broadcast_to(xi, (B, n))),
+                                      axis=-1)
+                groups = xi*2 + side[shuffled]
+                y_b = np.broadcast_to(y, (B,) + y.shape)
+            else:
+                picks = cell_start[cell] + np.floor(
+                    rng.random((B, n))*cell_size[cell]).astype(np.int64)
+                groups = np.broadcast_to(cell, (B, n))
+                y_b = y[picks]
+            groups = (groups + (np.arange(B)*n_x*2)[:, None]).ravel()
+            count, mean, sem = _group_stats(groups, y_b.reshape(B*n, -1), B*n_x*2)
+            # Batch x measurements x x values, for each condition
+            stats = [np.moveaxis(s.reshape(B, n_x, 2, -1)[:, :, k], 1, 2)
+                     for k in (0, 1) for s in (count, mean, sem)]
+            terms, _ = chi2_terms(*stats)
+            exceed[p] += (terms @ mask_t >= obs[p][None]).sum(axis=0)
+            done += B
+    return exceed
+
+
+def two_curve_test(curves, x, measurements, condition, windows=None, pairs=None,
+                   n_resamples=0, method='permutation', n_jobs=None, seed=None,
+                   batch_size=100):
+    """
+    Test whether the curves of every pair of conditions are significantly
+    different, for each measurement and window of x values. P-values are
+    Bonferroni corrected over condition pairs within each measurement and
+    window.
+
+    parameters:
+        curves, df: one row per sample, with columns for x, the condition and
+            the measurements
+        x, str: name of the df column specifying the x variable
+        measurements, str or list of str: column name(s) for y-values
+        condition, str: name of the column specifying a condition for which
+            curves should be compared
+        windows, dict: optional, see window_masks
+        pairs, list of tuple: optional, condition pairs to compare, default
+            is all pairs
+        n_resamples, int: if more than 0, also compute empirical p-values
+            from this many resampled datasets, split across a process pool
+        method, str: 'permutation' to shuffle condition labels at each x,
+            or 'bootstrap' to resample within each condition and x after
+            shifting both curves to their pooled mean
+        n_jobs, int: number of processes, default is the number of cores
+        seed, int: seed for reproducible resampling
+        batch_size, int: number of resamples to evaluate at once in each
+            process, bounds memory use
+
+    returns:
+        results, df: one row per measurement, window and pair, with the
+            summed chi-squared, its degrees of freedom (number of shared x
+            values), pval and pval_bonferroni, plus pval_resampled and
+            pval_resampled_bonferroni if n_resamples > 0
+    """
+    if method not in ('permutation', 'bootstrap'):
+        raise ValueError(f'method must be permutation or bootstrap, got {method}')
+    measurements = [measurements] if isinstance(measurements, str) else list(measurements)
+    curves = curves.dropna(subset=[x, condition])
+    summary = curve_summary(curves, x, measurements, condition)
+    conditions = list(summary['conditions'])
+    if pairs is None:
+        pair_idx = list(combinations(range(len(conditions)), 2))
+    else:
+        pair_idx = [(conditions.index(a), conditions.index(b)) for a, b in pairs]
+    window_names, masks = window_masks(summary['x'], windows)
+
+    sum_chi2, chi2_df = _pair_statistics(summary, pair_idx, masks)
+    pvals = chi2.sf(sum_chi2, chi2_df)
+    n_tests = len(pair_idx)
+
+    # Measurements x windows x pairs, flattened in that order
+    index = pd.MultiIndex.from_product([measurements, window_names, range(n_tests)],
+                                       names=['measurement', 'window', 'pair'])
+    results = pd.DataFrame({'chi2': np.moveaxis(sum_chi2, 0, -1).ravel(),
+                            'chi2_df': np.moveaxis(chi2_df, 0, -1).ravel(),
+                            'pval': np.moveaxis(pvals, 0, -1).ravel()},
+                           index=index).reset_index()
+    results.insert(2, 'condition_1', [conditions[pair_idx[p][0]] for p in results['pair']])
+    results.insert(3, 'condition_2', [conditions[pair_idx[p][1]] for p in results['pair']])
+    results['pval_bonferroni'] = np.minimum(results['pval']*n_tests, 1)
+
+    if n_resamples > 0:
+        x_idx = np.searchsorted(summary['x'], curves[x].to_numpy())
+        cond_idx = np.searchsorted(summary['conditions'], curves[condition].to_numpy())
+        values = curves[measurements].to_numpy(dtype=float)
+        n_jobs = n_jobs or cpu_count() or 1
+        chunks = [len(c) for c in np.array_split(np.arange(n_resamples), n_jobs) if len(c)]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        args = [(x_idx, cond_idx, values, pair_idx, masks, len(summary['x']), sum_chi2,
+                 c, s, method, batch_size) for c, s in zip(chunks, seeds)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            exceed = sum(executor.map(_resample_chunk, args))
+        results['pval_resampled'] = np.moveaxis((exceed + 1) / (n_resamples + 1),
+                                                0, -1).ravel()
+        results['pval_resampled_bonferroni'] = np.minimum(
+            results['pval_resampled']*n_tests, 1)
+
+    return results.drop(columns='pair')
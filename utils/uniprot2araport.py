@@ -6,14 +6,22 @@ import re
 import time
 import json
 import zlib
+import io
+import codecs
+import asyncio
+from html import escape
 from xml.etree import ElementTree
 from urllib.parse import urlparse, parse_qs, urlencode
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from requests.adapters import HTTPAdapter, Retry
+import pandas as pd
 
 
 POLLING_INTERVAL = 3
 API_URL = "https://rest.uniprot.org"
+# Maximum number of IDs the service accepts in one mapping job
+ID_MAPPING_LIMIT = 100000
 
 
 retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[500, 502, 503, 504])
@@ -30,7 +38,7 @@ def check_response(response):
 
 
 def submit_id_mapping(from_db, to_db, ids):
-    request = requests.post(
+    request = session.post(
         f"{API_URL}/idmapping/run",
         data={"from": from_db, "to": to_db, "ids": ",".join(ids)},
     )
@@ -61,27 +69,63 @@ def check_id_mapping_results_ready(job_id):
             return bool(j["results"] or j["failedIds"])
 
 
+def get_page(batch_url):
+    batch_response = session.get(batch_url)
+    batch_response.raise_for_status()
+    return batch_response
+
+
+def iter_batch_responses(batch_response):
+    # The next link is in the headers, so the next page can be downloading
+    # while the current one is used
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        batch_url = get_next_link(batch_response.headers)
+        next_page = executor.submit(get_page, batch_url) if batch_url else None
+        while next_page is not None:
+            batch_response = next_page.result()
+            batch_url = get_next_link(batch_response.headers)
+            next_page = executor.submit(get_page, batch_url) if batch_url else None
+            yield batch_response
+
+
 def get_batch(batch_response, file_format, compressed):
-    batch_url = get_next_link(batch_response.headers)
-    while batch_url:
-        batch_response = session.get(batch_url)
-        batch_response.raise_for_status()
+    for batch_response in iter_batch_responses(batch_response):
         yield decode_results(batch_response, file_format, compressed)
-        batch_url = get_next_link(batch_response.headers)
+
+
+def get_batch_with_size(batch_response, file_format, compressed):
+    # Like get_batch, but yields the decoded page and its size in bytes, for
+    # throughput reporting
+    for batch_response in iter_batch_responses(batch_response):
+        yield (
+            decode_results(batch_response, file_format, compressed),
+            len(batch_response.content),
+        )
 
 
 def combine_batches(all_results, batch_results, file_format):
+    # Extends all_results in place, so combining n pages is linear
     if file_format == "json":
         for key in ("results", "failedIds"):
             if key in batch_results and batch_results[key]:
-                all_results[key] += batch_results[key]
+                all_results.setdefault(key, []).extend(batch_results[key])
     elif file_format == "tsv":
-        return all_results + batch_results[1:]
+        all_results.extend(batch_results[1:])
     else:
-        return all_results + batch_results
+        all_results.extend(batch_results)
     return all_results
 
 
+def count_rows(batch_results, file_format, size):
+    if file_format == "json":
+        return len(batch_results.get("results", [])) + len(
+            batch_results.get("failedIds", [])
+        )
+    elif file_format == "tsv":
+        return max(len(batch_results) - 1, 0)
+    return size
+
+
 def get_id_mapping_results_link(job_id):
     url = f"{API_URL}/idmapping/details/{job_id}"
     request = session.get(url)
@@ -129,12 +173,100 @@ def merge_xml_results(xml_results):
     return ElementTree.tostring(merged_root, encoding="utf-8", xml_declaration=True)
 
 
+def _qualified_name(tag, namespaces):
+    m = re.match(r"\{(.*)\}(.*)", tag)
+    if not m:
+        return tag
+    prefix = namespaces.get(m.group(1), "")
+    return f"{prefix}:{m.group(2)}" if prefix else m.group(2)
+
+
+def merge_xml_results_stream(xml_pages, sink, entry_tag="{http://uniprot.org/uniprot}entry"):
+    # Merge XML pages by streaming each entry straight to sink (a path or a
+    # binary file-like object) with iterparse, clearing elements as they're
+    # written so memory doesn't grow with the number of entries. The root
+    # element and any non-entry children (e.g. copyright) are taken from the
+    # first page. Returns the number of entries written
+    own_sink = isinstance(sink, str)
+    out = open(sink, "wb") if own_sink else sink
+    n_entries = 0
+    trailer = []
+    default_ns = b""
+    try:
+        for page_index, page in enumerate(xml_pages):
+            if isinstance(page, str):
+                page = page.encode("utf-8")
+            namespaces = {}
+            depth = 0
+            root = None
+            for event, elem in ElementTree.iterparse(
+                io.BytesIO(page), events=("start-ns", "start", "end")
+            ):
+                if event == "start-ns":
+                    prefix, uri = elem
+                    namespaces[uri] = prefix
+                    if prefix == "" or page_index == 0:
+                        ElementTree.register_namespace(prefix, uri)
+                    if prefix == "":
+                        default_ns = f' xmlns="{uri}"'.encode("utf-8")
+                    continue
+                if event == "start":
+                    depth += 1
+                    if depth == 1:
+                        root = elem
+                        if page_index == 0:
+                            attrs = "".join(
+                                f' xmlns:{p}="{u}"' if p else f' xmlns="{u}"'
+                                for u, p in namespaces.items()
+                            )
+                            attrs += "".join(
+                                f' {_qualified_name(k, namespaces)}="{escape(v, quote=True)}"'
+                                for k, v in elem.attrib.items()
+                            )
+                            out.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+                            out.write(f"<{_qualified_name(elem.tag, namespaces)}{attrs}>".encode("utf-8"))
+                    continue
+                depth -= 1
+                if depth == 1:
+                    # Children are serialized on their own, so drop the
+                    # default namespace declaration that the root already has
+                    child = ElementTree.tostring(elem, encoding="utf-8", xml_declaration=False)
+                    child = child.replace(default_ns, b"", 1)
+                    if elem.tag == entry_tag:
+                        out.write(child)
+                        n_entries += 1
+                    elif page_index == 0:
+                        trailer.append(child)
+                    # Drop the finished child from the root entirely
+                    root.remove(elem)
+        if root is not None:
+            out.writelines(trailer)
+            root_tag = _qualified_name(root.tag, namespaces)
+            out.write(f"</{root_tag}>".encode("utf-8"))
+    finally:
+        if own_sink:
+            out.close()
+    return n_entries
+
+
 def print_progress_batches(batch_index, size, total):
     n_fetched = min((batch_index + 1) * size, total)
     print(f"Fetched: {n_fetched} / {total}")
 
 
-def get_id_mapping_results_search(url):
+def print_progress_throughput(n_fetched, total, n_bytes, start):
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    n_fetched = min(n_fetched, total)
+    print(
+        f"Fetched: {n_fetched} / {total} "
+        f"({n_fetched / elapsed:.0f} rows/s, {n_bytes / elapsed / 1e6:.2f} MB/s)"
+    )
+
+
+def get_id_mapping_results_search(url, xml_sink=None):
+    # For XML results, pass xml_sink (a path or binary file-like object) to
+    # stream entries to it page by page instead of merging in memory. The
+    # number of entries written is returned instead of the merged document
     parsed = urlparse(url)
     query = parse_qs(parsed.query)
     file_format = query["format"][0] if "format" in query else "json"
@@ -148,14 +280,33 @@ def get_id_mapping_results_search(url):
     )
     parsed = parsed._replace(query=urlencode(query, doseq=True))
     url = parsed.geturl()
+    start = time.perf_counter()
     request = session.get(url)
     check_response(request)
     results = decode_results(request, file_format, compressed)
     total = int(request.headers["x-total-results"])
-    print_progress_batches(0, size, total)
-    for i, batch in enumerate(get_batch(request, file_format, compressed), 1):
+    n_fetched = count_rows(results, file_format, size)
+    n_bytes = len(request.content)
+    print_progress_throughput(n_fetched, total, n_bytes, start)
+    if file_format == "xml" and xml_sink is not None:
+        first_page = results[0]
+        del results
+
+        def pages():
+            nonlocal n_fetched, n_bytes
+            yield first_page
+            for batch, batch_bytes in get_batch_with_size(request, file_format, compressed):
+                n_fetched += count_rows(batch, file_format, size)
+                n_bytes += batch_bytes
+                print_progress_throughput(n_fetched, total, n_bytes, start)
+                yield batch[0]
+
+        return merge_xml_results_stream(pages(), xml_sink)
+    for batch, batch_bytes in get_batch_with_size(request, file_format, compressed):
         results = combine_batches(results, batch, file_format)
-        print_progress_batches(i, size, total)
+        n_fetched += count_rows(batch, file_format, size)
+        n_bytes += batch_bytes
+        print_progress_throughput(n_fetched, total, n_bytes, start)
     if file_format == "xml":
         return merge_xml_results(results)
     return results
@@ -173,3 +324,291 @@ def get_id_mapping_results_stream(url):
         query["compressed"][0].lower() == "true" if "compressed" in query else False
     )
     return decode_results(request, file_format, compressed)
+
+
+def iter_decoded_chunks(response, compressed, chunk_size=2**16):
+    # Decompress gzip incrementally as the body arrives, handling responses
+    # made of several concatenated gzip members
+    if not compressed:
+        for chunk in response.iter_content(chunk_size):
+            yield chunk
+        return
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in response.iter_content(chunk_size):
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decompressor.flush()
+
+
+def iter_lines(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    remainder = ""
+    for chunk in chunks:
+        lines = (remainder + decoder.decode(chunk)).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    remainder += decoder.decode(b"", final=True)
+    if remainder:
+        yield remainder
+
+
+def iter_json_arrays(chunks):
+    # Yields (key, item) for every item of every top level array in a JSON
+    # object, e.g. ("results", {...}) and ("failedIds", "P12345"), without
+    # holding more than one item's text in memory. Values are parsed with
+    # raw_decode on a rolling buffer; a value cut off at the end of the buffer
+    # is retried once the unparsed text has doubled, so a large record isn't
+    # re-parsed per chunk
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    json_decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
+    exhausted = False
+
+    def fill(min_length):
+        # Drop parsed text and read until min_length characters are unparsed
+        nonlocal buffer, pos, exhausted
+        buffer = buffer[pos:]
+        pos = 0
+        while not exhausted and len(buffer) < min_length:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+                buffer += decoder.decode(b"", final=True)
+            else:
+                buffer += decoder.decode(chunk)
+
+    def skip(chars):
+        # Move past chars, returns the next character
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if exhausted:
+                raise ValueError("JSON stream ended before the end of the object")
+            fill(1)
+
+    def value():
+        nonlocal pos
+        while True:
+            try:
+                item, end = json_decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            else:
+                # A number can decode from a prefix of itself, e.g. 2.5 from
+                # 2.5e-3, so only accept a value followed by a delimiter
+                if exhausted or (end < len(buffer) and buffer[end] in " \t\r\n,]}"):
+                    pos = end
+                    return item
+            unparsed = len(buffer) - pos
+            fill(2 * unparsed + 1)
+
+    if skip(" \t\r\n") != "{":
+        raise ValueError("Expected a JSON object")
+    pos += 1
+    while skip(" \t\r\n,") != "}":
+        key = value()
+        if skip(" \t\r\n:") != "[":
+            # Skip over non-array values
+            value()
+            continue
+        pos += 1
+        while skip(" \t\r\n,") != "]":
+            yield key, value()
+        pos += 1
+
+
+def iter_id_mapping_results_stream(url, chunk_size=2**16):
+    # Generator version of get_id_mapping_results_stream. TSV results are
+    # yielded as dicts keyed by the header, JSON results as the records under
+    # "results", with failed IDs yielded as {"from": id, "failed": True}
+    if "/stream/" not in url:
+        url = url.replace("/results/", "/results/stream/")
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    file_format = query["format"][0] if "format" in query else "json"
+    compressed = (
+        query["compressed"][0].lower() == "true" if "compressed" in query else False
+    )
+    if file_format not in ("json", "tsv"):
+        raise ValueError(f"Streaming is only supported for json and tsv, got {file_format}")
+    with session.get(url, stream=True) as request:
+        check_response(request)
+        chunks = iter_decoded_chunks(request, compressed, chunk_size)
+        if file_format == "tsv":
+            lines = iter_lines(chunks)
+            header = next(lines, "").split("\t")
+            for line in lines:
+                yield dict(zip(header, line.split("\t")))
+        else:
+            for key, item in iter_json_arrays(chunks):
+                if key == "results":
+                    yield item
+                elif key == "failedIds":
+                    yield {"from": item, "failed": True}
+
+
+def _stream_rows_to_frame(rows):
+    frame = pd.DataFrame(rows)
+    # Nested JSON records (e.g. full UniProtKB entries) are kept as JSON text
+    # so every chunk has the same flat string schema
+    for col in frame.columns:
+        if col != "failed":
+            frame[col] = frame[col].map(
+                lambda v: v if v is None or isinstance(v, str) else json.dumps(v)
+            )
+    if "failed" in frame.columns:
+        frame["failed"] = frame["failed"].fillna(False).astype(bool)
+    return frame
+
+
+def write_id_mapping_results_stream(url, out_path, chunk_rows=50000, chunk_size=2**16):
+    # Stream results straight to a .parquet, .csv or .tsv file, chunk_rows
+    # rows at a time, so memory is bounded by the chunk and not the result
+    # size. Returns the number of rows written
+    if out_path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    sep = "\t" if out_path.endswith(".tsv") else ","
+    writer = None
+    columns = None
+    n_rows = 0
+    rows = []
+
+    def flush(rows):
+        nonlocal writer, columns
+        frame = _stream_rows_to_frame(rows)
+        if columns is None:
+            columns = list(frame.columns)
+            if "from" in columns:
+                columns += [c for c in ("to", "failed") if c not in columns]
+        # The file's columns are fixed by the first chunk, so fail rather
+        # than drop fields that only appear in later records
+        new_columns = [c for c in frame.columns if c not in columns]
+        if new_columns:
+            raise ValueError(
+                f"Fields {new_columns} first appear after row {n_rows} and aren't "
+                f"in the columns already written to {out_path} ({columns}), "
+                "use a larger chunk_rows"
+            )
+        frame = frame.reindex(columns=columns)
+        if "failed" in columns:
+            frame["failed"] = frame["failed"].fillna(False).astype(bool)
+        if out_path.endswith(".parquet"):
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if writer is None:
+                schema = pa.schema([
+                    pa.field(c, pa.bool_() if c == "failed" else pa.string())
+                    for c in columns
+                ])
+                writer = pq.ParquetWriter(out_path, schema)
+            writer.write_table(table.cast(writer.schema))
+        else:
+            frame.to_csv(out_path, sep=sep, index=False,
+                         mode="w" if writer is None else "a", header=writer is None)
+            writer = True
+
+    try:
+        for row in iter_id_mapping_results_stream(url, chunk_size):
+            rows.append(row)
+            if len(rows) >= chunk_rows:
+                flush(rows)
+                n_rows += len(rows)
+                rows = []
+        if rows or writer is None:
+            flush(rows)
+            n_rows += len(rows)
+    finally:
+        if out_path.endswith(".parquet") and writer is not None:
+            writer.close()
+    return n_rows
+
+
+def chunk_ids(ids, chunk_size=ID_MAPPING_LIMIT):
+    ids = list(dict.fromkeys(ids))
+    return [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+
+async def wait_for_id_mapping_async(
+    job_id, min_interval=0.25, max_interval=POLLING_INTERVAL * 5, backoff=1.5
+):
+    # Poll quickly at first since small jobs finish in well under a second,
+    # then back off so long jobs don't hammer the status endpoint
+    interval = min_interval
+    while True:
+        request = await asyncio.to_thread(
+            session.get, f"{API_URL}/idmapping/status/{job_id}"
+        )
+        check_response(request)
+        j = request.json()
+        if "jobStatus" in j:
+            if j["jobStatus"] in ("NEW", "RUNNING"):
+                await asyncio.sleep(interval)
+                interval = min(interval * backoff, max_interval)
+            elif j["jobStatus"] == "FINISHED":
+                return True
+            else:
+                raise Exception(j["jobStatus"])
+        else:
+            return bool(j["results"] or j["failedIds"])
+
+
+async def run_id_mapping_job_async(from_db, to_db, ids, semaphore):
+    async with semaphore:
+        job_id = await asyncio.to_thread(submit_id_mapping, from_db, to_db, ids)
+        if not await wait_for_id_mapping_async(job_id):
+            return {"results": [], "failedIds": []}
+        link = await asyncio.to_thread(get_id_mapping_results_link, job_id)
+        return await asyncio.to_thread(get_id_mapping_results_search, link)
+
+
+def results_to_table(results, id_set=None):
+    table = pd.DataFrame(results.get("results", []), columns=["from", "to"])
+    failed = pd.DataFrame({"from": results.get("failedIds", []), "to": None})
+    table = pd.concat([table.assign(failed=False), failed.assign(failed=True)],
+                      ignore_index=True)
+    if id_set is not None:
+        table.insert(0, "id_set", id_set)
+    return table
+
+
+async def map_ids_async(
+    id_sets, from_db, to_db, max_concurrent_jobs=4, chunk_size=ID_MAPPING_LIMIT
+):
+    # id_sets is either one list of IDs, or a dict of name to list of IDs for
+    # mapping several exports at once. Lists longer than chunk_size are split
+    # into separate jobs, and all jobs run concurrently up to
+    # max_concurrent_jobs. In a notebook, await this directly instead of
+    # calling map_ids
+    named = isinstance(id_sets, dict)
+    if not named:
+        id_sets = {None: id_sets}
+    semaphore = asyncio.Semaphore(max_concurrent_jobs)
+    jobs, names = [], []
+    for name, ids in id_sets.items():
+        for chunk in chunk_ids(ids, chunk_size):
+            jobs.append(run_id_mapping_job_async(from_db, to_db, chunk, semaphore))
+            names.append(name)
+    results = await asyncio.gather(*jobs)
+    tables = [results_to_table(r, name if named else None)
+              for name, r in zip(names, results)]
+    if not tables:
+        columns = (["id_set"] if named else []) + ["from", "to", "failed"]
+        return pd.DataFrame(columns=columns)
+    return pd.concat(tables, ignore_index=True)
+
+
+def map_ids(id_sets, from_db, to_db, max_concurrent_jobs=4, chunk_size=ID_MAPPING_LIMIT):
+    return asyncio.run(
+        map_ids_async(id_sets, from_db, to_db, max_concurrent_jobs, chunk_size)
+    )